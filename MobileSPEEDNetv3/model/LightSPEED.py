@@ -7,6 +7,7 @@ from torch import nn
 # baseblock
 from timm.layers.conv_bn_act import ConvBnAct
 from .LightSPEEDBlock import *
+from .fuse import fuse_conv_bn, switch_to_deploy, measure_latency
 
 # n
 BackboneWidths = [16, 64, 64, 64, 128, 128, 160, 160, 256, 256]
@@ -52,11 +53,20 @@ class LightSPEED(nn.Module):
             pitch_dim=int(180 // config["stride"] + 1 + 2 * config["n"]),
             roll_dim=int(360 // config["stride"] + 1 + 2 * config["n"])
         )
+        self.deploy = False
 
     def forward_once(self, x):
-        p3 = self.features[:6](x)
-        p4 = self.features[6:8](p3)
-        p5 = self.features[8:](p4)
+        if x.dtype == torch.uint8:
+            # uint8传输的图片在模型内归一化到[0, 1]
+            x = x.to(self.SPPF.conv1.conv.weight.dtype) / 255
+        if self.deploy:
+            p3 = self.stages[0](x)
+            p4 = self.stages[1](p3)
+            p5 = self.stages[2](p4)
+        else:
+            p3 = self.features[:6](x)
+            p4 = self.features[6:8](p3)
+            p5 = self.features[8:](p4)
         p5 = self.SPPF(p5)
         
         p3, p4, p5 = self.neck([p3, p4, p5])
@@ -69,5 +79,27 @@ class LightSPEED(nn.Module):
     
     def forward(self, x1, x2=None):
         if self.supervised:
-            return [self.forward_once(x1), self.forward_once(x2)]
-        return self.forward_once(x1)
\ No newline at end of file
+            # 两个视图拼接为一个批次只前向一次, 再拆分输出
+            outputs = self.forward_once(torch.cat([x1, x2]))
+            return list(zip(*(output.split(x1.shape[0]) for output in outputs)))
+        return self.forward_once(x1)
+
+    def fuse_for_inference(self, imgsz: List[int] = [480, 768], verbose: bool = True, benchmark: bool = True) -> dict:
+        # 部署前的融合, 融合后不能再训练:
+        # BN折叠进卷积, RepVGGplusBlock重参数化, 合并Head的yaw/pitch/roll全连接层, 预先切分backbone的三个stage
+        if self.deploy:
+            return {}
+        self.eval()
+        shape = (1, 3, *imgsz)
+        latency_before = measure_latency(self, shape) if benchmark else None
+        num_bn = fuse_conv_bn(self)
+        num_deploy = switch_to_deploy(self)
+        self.stages = nn.ModuleList([self.features[:6], self.features[6:8], self.features[8:]])
+        self.__delattr__('features')
+        self.deploy = True
+        latency_after = measure_latency(self, shape) if benchmark else None
+        report = {"fused_bn": num_bn, "deployed": num_deploy, "latency_before(ms)": latency_before, "latency_after(ms)": latency_after}
+        if verbose:
+            print(f"fuse_for_inference: folded {num_bn} BN, switched {num_deploy} modules to deploy"
+                  + (f", batch 1 latency {latency_before:.2f} ms -> {latency_after:.2f} ms" if benchmark else ""))
+        return report
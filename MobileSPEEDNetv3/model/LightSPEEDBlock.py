@@ -7,6 +7,8 @@ from torch import nn
 from timm.layers.conv_bn_act import ConvBnAct
 
 from fightingcv_attention.rep.repvgg import RepBlock
+
+from .fuse import merge_linear
 # =======================block=========================
 
 class DownSample3x3(nn.Module):
@@ -147,12 +149,27 @@ class Head(nn.Module):
         self.roll_fc = nn.Sequential(
             nn.Linear(self.ori_hide_features, roll_dim),
         )
+        self.deploy = False
     
     def forward(self, x):
         x = self.fc(x)
         pos_feature, ori_feature = torch.split(x, [self.pos_hide_features, self.ori_hide_features], dim=1)
         pos = self.pos_fc(pos_feature)
+        if self.deploy:
+            ori = self.ori_fc(ori_feature).type(torch.float32)
+            yaw, pitch, roll = (F.softmax(o, dim=1) for o in ori.split(self.ori_dims, dim=1))
+            return pos, yaw, pitch, roll
         yaw = F.softmax(self.yaw_fc(ori_feature).type(torch.float32), dim=1)
         pitch = F.softmax(self.pitch_fc(ori_feature).type(torch.float32), dim=1)
         roll = F.softmax(self.roll_fc(ori_feature).type(torch.float32), dim=1)
         return pos, yaw, pitch, roll
+
+    def switch_to_deploy(self):
+        # 将yaw/pitch/roll三个全连接层合并为一个, 推理时只做一次矩阵乘法
+        if self.deploy:
+            return
+        self.ori_fc, self.ori_dims = merge_linear([self.yaw_fc[0], self.pitch_fc[0], self.roll_fc[0]])
+        self.__delattr__('yaw_fc')
+        self.__delattr__('pitch_fc')
+        self.__delattr__('roll_fc')
+        self.deploy = True
@@ -5,6 +5,7 @@ from typing import List, Union
 from torch import Tensor
 
 from .block import FPNPAN, RepECPHead, Conv2dNormActivation, TriFPN, TriFPNAtt, CoSE
+from .fuse import fuse_conv_bn, switch_to_deploy, measure_latency
 from torchvision.models import mobilenet_v3_large, MobileNet_V3_Large_Weights
 
 from rich import print
@@ -49,16 +50,51 @@ class Mobile_SPEEDv3(nn.Module):
                                 yaw_dim=int(360 // config["stride"] + 1 + 2 * config["n"]),
                                 pitch_dim=int(180 // config["stride"] + 1 + 2 * config["n"]),
                                 roll_dim=int(360 // config["stride"] + 1 + 2 * config["n"]))
+        self.deploy = False
         
     
     def forward(self, x: Tensor):
+        if x.dtype == torch.uint8:
+            # uint8传输的图片在模型内归一化到[0, 1]
+            x = x.to(self.expand2rgb_conv[0].weight.dtype) / 255
+        return self.forward_float(x)
+    
+    def forward_float(self, x: Tensor):
+        # 归一化之后的前向, 不含对dtype的判断, deploy后可以被FX追踪(量化)
         x = self.expand2rgb_conv(x)
-        features = [self.features[:self.stage[0]](x)]
-        for i in range(len(self.stage)-1):
-            features.append(self.features[self.stage[i]:self.stage[i+1]](features[-1]))
-        features.append(self.features[self.stage[-1]:](features[-1]))
+        if self.deploy:
+            features = []
+            for stage in self.stages:
+                x = stage(x)
+                features.append(x)
+        else:
+            features = [self.features[:self.stage[0]](x)]
+            for i in range(len(self.stage)-1):
+                features.append(self.features[self.stage[i]:self.stage[i+1]](features[-1]))
+            features.append(self.features[self.stage[-1]:](features[-1]))
         
         features = self.neck(features)
         
         pos, yaw, pitch, roll = self.head(features)
-        return pos, yaw, pitch, roll
\ No newline at end of file
+        return pos, yaw, pitch, roll
+    
+    def fuse_for_inference(self, imgsz: List[int] = [480, 768], verbose: bool = True, benchmark: bool = True) -> dict:
+        # 部署前的融合, 融合后没有BN, 只适合以小学习率微调(QAT):
+        # BN折叠进卷积, RepVGGplusBlock重参数化, 合并Head的yaw/pitch/roll全连接层, 按self.stage预先切分backbone
+        if self.deploy:
+            return {}
+        self.eval()
+        shape = (1, 1, *imgsz)
+        latency_before = measure_latency(self, shape) if benchmark else None
+        num_bn = fuse_conv_bn(self)
+        num_deploy = switch_to_deploy(self)
+        bounds = [0, *self.stage, len(self.features)]
+        self.stages = nn.ModuleList(self.features[bounds[i]:bounds[i+1]] for i in range(len(bounds)-1))
+        self.__delattr__('features')
+        self.deploy = True
+        latency_after = measure_latency(self, shape) if benchmark else None
+        report = {"fused_bn": num_bn, "deployed": num_deploy, "latency_before(ms)": latency_before, "latency_after(ms)": latency_after}
+        if verbose:
+            print(f"fuse_for_inference: folded {num_bn} BN, switched {num_deploy} modules to deploy"
+                  + (f", batch 1 latency {latency_before:.2f} ms -> {latency_after:.2f} ms" if benchmark else ""))
+        return report
\ No newline at end of file
@@ -9,6 +9,7 @@ from torchvision.ops import Conv2dNormActivation
 from torchvision.models.efficientnet import FusedMBConv, FusedMBConvConfig
 from torchvision.models.efficientnet import MBConv, MBConvConfig
 from .LightSPEEDBlock import C2f
+from .fuse import merge_linear
 
 from timm.layers.conv_bn_act import ConvBnAct
 from timm.models._efficientnet_blocks import InvertedResidual
@@ -392,6 +393,7 @@ class Head(nn.Module):
             nn.Linear(self.ori_hide_features, roll_dim),
             nn.Softmax(dim=1),
         )
+        self.deploy = False
     
     def forward(self, x):
         x = self.fc(x)
@@ -399,11 +401,24 @@ class Head(nn.Module):
         # pos_feature = x[:, :self.pos_hide_features]
         # ori_feature = x
         pos = self.pos_fc(pos_feature)
+        if self.deploy:
+            yaw, pitch, roll = (F.softmax(ori, dim=1) for ori in self.ori_fc(ori_feature).split(self.ori_dims, dim=1))
+            return pos, yaw, pitch, roll
         yaw = self.yaw_fc(ori_feature)
         pitch = self.pitch_fc(ori_feature)
         roll = self.roll_fc(ori_feature)
         return pos, yaw, pitch, roll
 
+    def switch_to_deploy(self):
+        # 将yaw/pitch/roll三个全连接层合并为一个, 推理时只做一次矩阵乘法
+        if self.deploy:
+            return
+        self.ori_fc, self.ori_dims = merge_linear([self.yaw_fc[0], self.pitch_fc[0], self.roll_fc[0]])
+        self.__delattr__('yaw_fc')
+        self.__delattr__('pitch_fc')
+        self.__delattr__('roll_fc')
+        self.deploy = True
+
 class RepECPHead(nn.Sequential):
     def __init__(self, in_channels: List[int], pool_size: List[int], pos_dim: int, yaw_dim: int, pitch_dim: int, roll_dim: int):
         super(RepECPHead, self).__init__(
@@ -0,0 +1,60 @@
+import math
+import torch
+import numpy as np
+
+from torch import nn, Tensor
+from typing import Tuple
+
+from ..utils.quaternion import euler_yxz_to_quat
+
+
+class PoseExport(nn.Module):
+    """导出用的包装: 模型 + 欧拉角解码, 输出 pos[B, 3] 与 quat[B, 4]
+
+    decode_ori_batch 中的期望与 euler_yxz_to_quat 都写成张量运算放进计算图,
+    部署时不再需要Python端的 OriEncoderDecoder / OriEncoderDecoderGauss。
+    yaw/pitch/roll的取值范围预先转换为弧度保存为buffer, 随模型一起导出。
+    """
+
+    def __init__(self, model: nn.Module, ori_encoder_decoder):
+        super().__init__()
+        self.model = model
+        for name in ["yaw_range", "pitch_range", "roll_range"]:
+            self.register_buffer(name, getattr(ori_encoder_decoder, name).detach().float().cpu() * (math.pi / 180))
+
+    def forward(self, x: Tensor) -> Tuple[Tensor, Tensor]:
+        pos, yaw, pitch, roll = self.model(x)
+        yaw = torch.sum(yaw * self.yaw_range, dim=1)
+        pitch = torch.sum(pitch * self.pitch_range, dim=1)
+        roll = torch.sum(roll * self.roll_range, dim=1)
+        return pos, euler_yxz_to_quat(yaw, pitch, roll, degrees=False)
+
+
+def export_torchscript(model: PoseExport, example: Tensor, path: str) -> torch.jit.ScriptModule:
+    # trace导出, 模型内只有对dtype的判断, trace时按uint8输入固定
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model.eval(), example))
+    traced.save(path)
+    return traced
+
+
+def export_onnx(model: PoseExport, example: Tensor, path: str, opset: int = 17) -> str:
+    # 使用TorchScript导出器, batch维为动态维度
+    with torch.no_grad():
+        torch.onnx.export(model.eval(), (example,), path,
+                          input_names=["image"],
+                          output_names=["pos", "quat"],
+                          dynamic_axes={"image": {0: "batch"}, "pos": {0: "batch"}, "quat": {0: "batch"}},
+                          opset_version=opset,
+                          dynamo=False)
+    return path
+
+
+def pose_difference(expected: Tuple[Tensor, Tensor], result: Tuple[Tensor, Tensor]) -> dict:
+    # 位置的最大绝对误差(m)与姿态的最大夹角(deg), q与-q视为相同
+    # 单位四元数 |q1 - q2| = 2sin(θ/4), 比arccos(|q1·q2|)在θ接近0时精确
+    pos = np.abs(np.asarray(expected[0], dtype=np.float64) - np.asarray(result[0], dtype=np.float64)).max()
+    q1, q2 = np.asarray(expected[1], dtype=np.float64), np.asarray(result[1], dtype=np.float64)
+    chord = np.minimum(np.linalg.norm(q1 - q2, axis=1), np.linalg.norm(q1 + q2, axis=1))
+    ori = np.rad2deg(4 * np.arcsin(np.clip(chord / 2, 0, 1))).max()
+    return {"pos(m)": float(pos), "ori(deg)": float(ori)}
@@ -0,0 +1,104 @@
+import copy
+import time
+import torch
+import numpy as np
+
+from torch import nn
+from typing import List, Tuple
+from torch.nn.utils.fusion import fuse_conv_bn_weights
+from torchvision.ops import Conv2dNormActivation
+from timm.layers.conv_bn_act import ConvBnAct
+from timm.layers.mixed_conv2d import MixedConv2d
+from timm.models._efficientnet_blocks import InvertedResidual
+
+
+# timm模块中 卷积 -> BN 的属性名
+TIMM_CONV_BN = {
+    ConvBnAct: [("conv", "bn")],
+    InvertedResidual: [("conv_pw", "bn1"), ("conv_dw", "bn2"), ("conv_pwl", "bn3")],
+}
+
+
+def fold_bn(conv: nn.Module, bn: nn.BatchNorm2d) -> nn.Module:
+    # 返回折叠了BN的卷积, MixedConv2d (kernel_size为列表时timm使用) 按输出通道切分BN后逐个折叠
+    fused = copy.deepcopy(conv)
+    convs = list(fused.values()) if isinstance(fused, MixedConv2d) else [fused]
+    start = 0
+    for sub in convs:
+        index = slice(start, start + sub.out_channels)
+        sub.weight, sub.bias = fuse_conv_bn_weights(sub.weight, sub.bias, bn.running_mean[index], bn.running_var[index],
+                                                    bn.eps, bn.weight[index], bn.bias[index])
+        start += sub.out_channels
+    return fused
+
+
+def fuse_bn_act(bn: nn.BatchNorm2d) -> nn.Module:
+    # BN折叠后剩下的部分, timm的BatchNormAct2d还包含drop与激活
+    if hasattr(bn, "act"):
+        return nn.Sequential(bn.drop, bn.act)
+    return nn.Identity()
+
+
+def fuse_conv_bn(model: nn.Module) -> int:
+    # 将所有 Conv2dNormActivation / ConvBnAct / InvertedResidual 中的BN折叠进卷积, 需要在eval模式下调用
+    # 返回折叠的BN数量
+    fused = 0
+    for module in list(model.modules()):
+        if isinstance(module, Conv2dNormActivation) and len(module) > 1 and isinstance(module[1], nn.BatchNorm2d):
+            module[0] = fold_bn(module[0], module[1])
+            module[1] = nn.Identity()
+            fused += 1
+            continue
+        for module_type, pairs in TIMM_CONV_BN.items():
+            if not isinstance(module, module_type):
+                continue
+            for conv_name, bn_name in pairs:
+                bn = getattr(module, bn_name)
+                if isinstance(bn, nn.BatchNorm2d):
+                    setattr(module, conv_name, fold_bn(getattr(module, conv_name), bn))
+                    setattr(module, bn_name, fuse_bn_act(bn))
+                    fused += 1
+    return fused
+
+
+def merge_linear(linears: List[nn.Linear]):
+    # 输入相同的多个全连接层合并为一个, 返回合并后的层与各输出的维度
+    weight = linears[0].weight
+    merged = nn.Linear(linears[0].in_features, sum(fc.out_features for fc in linears), device=weight.device, dtype=weight.dtype)
+    merged.weight.data = torch.cat([fc.weight.data for fc in linears])
+    merged.bias.data = torch.cat([fc.bias.data for fc in linears])
+    return merged, [fc.out_features for fc in linears]
+
+
+def switch_to_deploy(model: nn.Module) -> int:
+    # 调用所有子模块的switch_to_deploy (RepVGGplusBlock的分支重参数化、Head的全连接层合并)
+    switched = 0
+    for module in list(model.modules()):
+        if module is not model and hasattr(module, "switch_to_deploy"):
+            module.switch_to_deploy()
+            switched += 1
+    return switched
+
+
+def time_fn(fn, repeat: int = 20, warmup: int = 3, cuda: bool = False) -> float:
+    # 测量无参调用fn的耗时中位数(ms), cuda为True时每次计时前后同步
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1e3
+
+
+@torch.no_grad()
+def measure_latency(model: nn.Module, shape: Tuple[int, ...], repeat: int = 20, warmup: int = 3) -> float:
+    # 在模型所在设备上测量uint8输入的前向延迟中位数(ms)
+    device = next(model.parameters()).device
+    x = torch.randint(0, 256, shape, dtype=torch.uint8, device=device)
+    return time_fn(lambda: model(x), repeat, warmup, cuda=device.type == "cuda")
@@ -0,0 +1,85 @@
+import io
+import copy
+import torch
+
+from torch import nn, Tensor
+from typing import Iterable, List
+
+from torch.ao.quantization import get_default_qconfig_mapping, get_default_qat_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, prepare_qat_fx, convert_fx
+from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+
+
+class _ForwardFloat(nn.Module):
+    # FX追踪的入口: 直接调用forward_float, 跳过uint8归一化的分支
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x: Tensor):
+        return self.model.forward_float(x)
+
+
+class QuantizedSPEED(nn.Module):
+    """量化模型(PTQ/QAT)的包装, 输入输出与Mobile_SPEEDv3相同
+
+    graph在PTQ校准/QAT训练时为插入了observer/fake-quant的FP32模型, convert后为INT8模型。
+    backbone与neck的卷积/全连接为INT8, 没有量化kernel的算子(Mish等)在前后反量化后以FP32计算;
+    Head保持FP32, 避免softmax后的欧拉角编码被量化到8bit, 期望解码的精度下降;
+    单通道输入的expand2rgb_conv计算量很小, 默认也保持FP32。
+    """
+
+    def __init__(self, graph: nn.Module):
+        super().__init__()
+        self.graph = graph
+
+    def forward(self, x: Tensor):
+        if x.dtype == torch.uint8:
+            x = x.float() / 255
+        return self.graph(x)
+
+
+def prepare(model: nn.Module, example: Tensor, backend: str = "x86", skip: List[str] = ["expand2rgb_conv"], qat: bool = False) -> QuantizedSPEED:
+    # 拷贝模型并融合(BN折叠、backbone切分为self.stages以便FX追踪), 插入observer(PTQ)或fake-quant(QAT)
+    # skip中的子模块(相对Mobile_SPEEDv3的名字)保持FP32
+    model = copy.deepcopy(model).cpu().eval()
+    if not model.deploy:
+        model.fuse_for_inference(imgsz=list(example.shape[2:]), verbose=False, benchmark=False)
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = (get_default_qat_qconfig_mapping if qat else get_default_qconfig_mapping)(backend)
+    qconfig_mapping.set_module_name("model.head", None)
+    for name in skip:
+        qconfig_mapping.set_module_name(f"model.{name}", None)
+    prepare_custom_config = PrepareCustomConfig().set_non_traceable_module_names(["model.head"])
+    example = example.float() / 255 if example.dtype == torch.uint8 else example.float()
+    if qat:
+        graph = prepare_qat_fx(_ForwardFloat(model).train(), qconfig_mapping, (example,), prepare_custom_config=prepare_custom_config)
+    else:
+        graph = prepare_fx(_ForwardFloat(model), qconfig_mapping, (example,), prepare_custom_config=prepare_custom_config)
+    return QuantizedSPEED(graph)
+
+
+def convert(model: QuantizedSPEED) -> QuantizedSPEED:
+    # 将校准/训练后的模型转换为INT8, 原模型不变
+    return QuantizedSPEED(convert_fx(copy.deepcopy(model.graph).cpu().eval())).eval()
+
+
+@torch.no_grad()
+def quantize_ptq(model: nn.Module, calibration: Iterable[Tensor], backend: str = "x86",
+                 skip: List[str] = ["expand2rgb_conv"]) -> QuantizedSPEED:
+    # 训练后量化: 用calibration中的批次统计激活范围后转换为INT8
+    prepared = None
+    for images in calibration:
+        if prepared is None:
+            prepared = prepare(model, images, backend, skip).eval()
+        prepared(images)
+    if prepared is None:
+        raise ValueError("calibration is empty")
+    return convert(prepared)
+
+
+def model_size(model: nn.Module) -> float:
+    # 序列化后state_dict的大小(MB)
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
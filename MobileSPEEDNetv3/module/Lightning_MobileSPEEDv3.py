@@ -3,28 +3,41 @@ import lightning as L
 import numpy as np
 import rich
 import csv
+import copy
+import time
 
+from itertools import combinations
 from torch.optim import SGD, AdamW
+from torch.ao.quantization import disable_observer
 
 from ..model import Mobile_SPEEDv3, LightSPEED
+from ..model.quantize import QuantizedSPEED, prepare, convert
 from ..utils.loss import PoseLoss, EulerLoss, OriLoss
 from ..utils.metrics import Loss, PosError, OriError, Score
 from ..utils.utils import OriEncoderDecoder, OriEncoderDecoderGauss
+from ..utils.config import get_config, merge_config
 
 
 class LightningMobileSPEEDv3(L.LightningModule):
     def __init__(self, config):
         super().__init__()
-        # 配置
-        self.config: dict = config
+        # 配置, 旧版本checkpoint(load_from_checkpoint)的配置中缺少的配置项(如QAT)原地补全为默认值
+        self.config: dict = merge_config(config)
         # 模型
         self.model: Mobile_SPEEDv3 = Mobile_SPEEDv3(self.config)
         # self.model: LightSPEED = LightSPEED(self.config)
-        # 欧拉角编码解码器
+        # 量化感知训练: 加载浮点checkpoint后融合BN并插入fake-quant, 之后的训练与验证都在fake-quant模型上进行
+        if self.config["QAT"]["enable"]:
+            if self.config["QAT"]["ckpt"] is not None:
+                state_dict = torch.load(self.config["QAT"]["ckpt"], map_location="cpu", weights_only=False)["state_dict"]
+                self.model.load_state_dict({key[len("model."):]: value for key, value in state_dict.items() if key.startswith("model.")})
+            example = torch.zeros(1, 1, *self.config["imgsz"], dtype=torch.uint8)
+            self.model: QuantizedSPEED = prepare(self.model, example, self.config["QAT"]["backend"], self.config["QAT"]["skip"], qat=True)
+        # 欧拉角编码解码器, 在CPU上创建, 训练/验证开始时移动到模型所在的设备
         if self.config["encoder"] == "Linear":
-            self.ori_encoder_decoder = OriEncoderDecoder(self.config["stride"], self.config["s"], self.config["n"], device="cuda" if config["accelerator"] == "gpu" else config["accelerator"])
+            self.ori_encoder_decoder = OriEncoderDecoder(self.config["stride"], self.config["s"], self.config["n"])
         elif self.config["encoder"] == "Gauss":
-            self.ori_encoder_decoder = OriEncoderDecoderGauss(self.config["stride"], self.config["s"], self.config["n"], device="cuda" if config["accelerator"] == "gpu" else config["accelerator"])   
+            self.ori_encoder_decoder = OriEncoderDecoderGauss(self.config["stride"], self.config["s"], self.config["n"])
         # 损失函数
         self.pos_loss: PoseLoss = PoseLoss(self.config["pos_loss"])
         self.yaw_loss: EulerLoss = EulerLoss(self.config["euler_loss"])
@@ -49,6 +62,9 @@ class LightningMobileSPEEDv3(L.LightningModule):
         self.ori_error: OriError = OriError()
         self.pos_error: PosError = PosError()
         self.score: Score = Score(self.config["ALPHA"])
+        # 训练吞吐量: 本轮的样本数与 [开始时间, 最后一个batch结束的时间]
+        self.train_samples: int = 0
+        self.train_time: list = [0.0, 0.0]
         self.save_hyperparameters()
         if self.config["save_csv"]:
             self.result = [["file_name",
@@ -61,37 +77,77 @@ class LightningMobileSPEEDv3(L.LightningModule):
 
 
     def forward(self, x1):
+        if self.config["channels_last"]:
+            x1 = x1.contiguous(memory_format=torch.channels_last)
         return self.model(x1)
 
+    def forward_views(self, views):
+        # 自监督: 所有视图拼接为一个批次, 只做一次主干/颈部/头部的前向, 再按视图拆分输出
+        # 返回每个视图的 (pos, yaw, pitch, roll)
+        num = views[0].shape[0]
+        outputs = self(torch.cat(views))
+        return list(zip(*(output.split(num) for output in outputs)))
+
+    def consistency_losses(self, outputs):
+        # 视图两两之间的位置、欧拉角与姿态一致性损失, 对所有视图对取平均
+        ori_decode = [self.ori_encoder_decoder.decode_ori_batch(yaw, pitch, roll) for _, yaw, pitch, roll in outputs]
+        pairs = list(combinations(range(len(outputs)), 2))
+        pos_loss = yaw_loss = pitch_loss = roll_loss = ori_loss = 0
+        for i, j in pairs:
+            pos_i, yaw_i, pitch_i, roll_i = outputs[i]
+            pos_j, yaw_j, pitch_j, roll_j = outputs[j]
+            pos_loss = pos_loss + self.pos_loss(pos_i, pos_j)
+            yaw_loss = yaw_loss + self.yaw_loss(yaw_i, yaw_j)
+            pitch_loss = pitch_loss + self.pitch_loss(pitch_i, pitch_j)
+            roll_loss = roll_loss + self.roll_loss(roll_i, roll_j)
+            ori_loss = ori_loss + self.ori_loss(ori_decode[i], ori_decode[j])
+        losses = [loss / len(pairs) for loss in (pos_loss, yaw_loss, pitch_loss, roll_loss, ori_loss)]
+        return losses, ori_decode
+
+    def on_fit_start(self):
+        self.ori_encoder_decoder.to(self.device)
+        if self.config["channels_last"]:
+            self.model.to(memory_format=torch.channels_last)
+
     # ===========================train===========================
     def on_train_start(self):
         self.logger.experiment.log_asset_folder(folder="MobileSPEEDNetv3", log_file_name=True, recursive=True)
 
+    def on_train_epoch_start(self):
+        self.train_samples = 0
+        self.train_time = [time.perf_counter(), time.perf_counter()]
+        # QAT后期固定量化参数, 只微调权重
+        if self.config["QAT"]["enable"] and self.current_epoch >= self.config["QAT"]["freeze_observer_epoch"]:
+            self.model.apply(disable_observer)
+
+    def on_train_batch_end(self, outputs, batch, batch_idx):
+        self.train_time[1] = time.perf_counter()
+
+    @property
+    def samples_per_sec(self) -> float:
+        # 本轮训练的吞吐量, 包括等待数据的时间, 不包括验证
+        elapsed = self.train_time[1] - self.train_time[0]
+        return self.train_samples / elapsed if elapsed > 0 else 0.0
+
 
     def training_step(self, batch, batch_idx):
         if self.config["self_supervised"]:
-            image_1, image_2 = batch
-            num = image_1.shape[0]
-            out1, out2 = self(image_1, image_2)
-            pos_1, yaw_1, pitch_1, roll_1 = out1
-            pos_2, yaw_2, pitch_2, roll_2 = out2
-            # ori_decode_1 = self.ori_encoder_decoder.decode_ori_batch(yaw_1, pitch_1, roll_1)
-            # ori_decode_2 = self.ori_encoder_decoder.decode_ori_batch(yaw_2, pitch_2, roll_2)
-            train_pos_loss = self.pos_loss(pos_1, pos_2)
-            train_yaw_loss = self.yaw_loss(yaw_1, yaw_2)
-            train_pitch_loss = self.pitch_loss(pitch_1, pitch_2)
-            train_roll_loss = self.roll_loss(roll_1, roll_2)
-            # train_ori_loss = self.ori_loss(ori_decode_1, ori_decode_2)
+            # batch为K个视图, 拼接为一个K*B的批次前向
+            num = batch[0].shape[0]
+            outputs = self.forward_views(batch)
+            (train_pos_loss, train_yaw_loss, train_pitch_loss, train_roll_loss, train_ori_loss), _ = self.consistency_losses(outputs)
         else:
             inputs, labels = batch
             num = inputs.shape[0]
             pos, yaw, pitch, roll = self(inputs)
+            yaw_encode, pitch_encode, roll_encode = self.ori_encoder_decoder.encode_ori_batch(labels["ori"])
             ori_decode = self.ori_encoder_decoder.decode_ori_batch(yaw, pitch, roll)
             train_pos_loss = self.pos_loss(pos, labels["pos"])
-            train_yaw_loss = self.yaw_loss(yaw, labels["yaw_encode"])
-            train_pitch_loss = self.pitch_loss(pitch, labels["pitch_encode"])
-            train_roll_loss = self.roll_loss(roll, labels["roll_encode"])
+            train_yaw_loss = self.yaw_loss(yaw, yaw_encode)
+            train_pitch_loss = self.pitch_loss(pitch, pitch_encode)
+            train_roll_loss = self.roll_loss(roll, roll_encode)
             train_ori_loss = self.ori_loss(ori_decode, labels["ori"])
+        self.train_samples += num
 
         train_loss = self.BETA[0] * train_pos_loss + self.BETA[1] * (train_yaw_loss + train_pitch_loss + train_roll_loss) + self.BETA[2] * train_ori_loss
 
@@ -112,7 +168,12 @@ class LightningMobileSPEEDv3(L.LightningModule):
             "train/roll_loss": self.train_roll_loss.compute(),
             "train/ori_loss": self.train_ori_loss.compute(),
             "train/loss": self.train_loss.compute(),
+            "train/samples_per_sec": self.samples_per_sec,
         }, on_epoch=True)
+        # 几何增强接受率
+        datamodule = self.trainer.datamodule
+        if datamodule is not None and hasattr(datamodule, "augmentation_stats"):
+            self.log_dict({f"augment/{k}": v for k, v in datamodule.augmentation_stats().items()}, on_epoch=True)
         self.train_pos_loss.reset()
         self.train_yaw_loss.reset()
         self.train_pitch_loss.reset()
@@ -123,36 +184,31 @@ class LightningMobileSPEEDv3(L.LightningModule):
 
     # ===========================validation===========================
     def on_validation_start(self) -> None:
-        rich.print(f"[b]{'train':<5} Epoch {self.current_epoch:>3}/{self.trainer.max_epochs:<3} pos_loss: {self.train_pos_loss.compute().item():<8.4f}  yaw_loss: {self.train_yaw_loss.compute().item():<8.4f}  pitch_loss: {self.train_pitch_loss.compute().item():<8.4f}  roll_loss: {self.train_roll_loss.compute().item():<8.4f}  ori_loss: {self.train_ori_loss.compute().item():<8.4f}  loss: {self.train_loss.compute().item():<8.4f}")
+        self.ori_encoder_decoder.to(self.device)
+        rich.print(f"[b]{'train':<5} Epoch {self.current_epoch:>3}/{self.trainer.max_epochs:<3} pos_loss: {self.train_pos_loss.compute().item():<8.4f}  yaw_loss: {self.train_yaw_loss.compute().item():<8.4f}  pitch_loss: {self.train_pitch_loss.compute().item():<8.4f}  roll_loss: {self.train_roll_loss.compute().item():<8.4f}  ori_loss: {self.train_ori_loss.compute().item():<8.4f}  loss: {self.train_loss.compute().item():<8.4f}  samples/s: {self.samples_per_sec:<8.1f}")
 
     
     def validation_step(self, batch, batch_index):
         # 取出数据
         if self.config["self_supervised"]:
-            image_1, image_2 = batch
-            num = image_1.shape[0]
-            out1, out2 = self(image_1, image_2)
-            pos_1, yaw_1, pitch_1, roll_1 = out1
-            pos_2, yaw_2, pitch_2, roll_2 = out2
-            val_pos_loss = self.pos_loss(pos_1, pos_2)
-            val_yaw_loss = self.yaw_loss(yaw_1, yaw_2)
-            val_pitch_loss = self.pitch_loss(pitch_1, pitch_2)
-            val_roll_loss = self.roll_loss(roll_1, roll_2)
-            # val_ori_loss = self.ori_loss(ori_decode_1, ori_decode_2)
-            ori_decode_1 = self.ori_encoder_decoder.decode_ori_batch(yaw_1, pitch_1, roll_1)
-            ori_decode_2 = self.ori_encoder_decoder.decode_ori_batch(yaw_2, pitch_2, roll_2)
-            self.pos_error.update(pos_1, pos_2)
-            self.ori_error.update(ori_decode_1, ori_decode_2)
+            num = batch[0].shape[0]
+            outputs = self.forward_views(batch)
+            (val_pos_loss, val_yaw_loss, val_pitch_loss, val_roll_loss, val_ori_loss), ori_decode = self.consistency_losses(outputs)
+            # 以前两个视图之间的差异作为误差指标
+            self.pos_error.update(outputs[0][0], outputs[1][0])
+            self.ori_error.update(ori_decode[0], ori_decode[1])
         else:
             inputs, labels = batch
             num = inputs.shape[0]
             # 前向传播
             pos, yaw, pitch, roll = self(inputs)
+            # 由姿态标签批量计算欧拉角编码
+            yaw_encode, pitch_encode, roll_encode = self.ori_encoder_decoder.encode_ori_batch(labels["ori"])
             # 计算损失
             val_pos_loss = self.pos_loss(pos, labels["pos"])
-            val_yaw_loss = self.yaw_loss(yaw, labels["yaw_encode"])
-            val_pitch_loss = self.pitch_loss(pitch, labels["pitch_encode"])
-            val_roll_loss = self.roll_loss(roll, labels["roll_encode"])
+            val_yaw_loss = self.yaw_loss(yaw, yaw_encode)
+            val_pitch_loss = self.pitch_loss(pitch, pitch_encode)
+            val_roll_loss = self.roll_loss(roll, roll_encode)
             ori_decode = self.ori_encoder_decoder.decode_ori_batch(yaw, pitch, roll)
             val_ori_loss = self.ori_loss(ori_decode, labels["ori"])
             self.ori_error.update(ori_decode, labels["ori"])
@@ -213,18 +269,27 @@ class LightningMobileSPEEDv3(L.LightningModule):
         self.logger.experiment.log_asset(self.trainer.callbacks[3].best_model_path, overwrite=True)
         self.logger.experiment.log_asset(self.trainer.callbacks[3].last_model_path, overwrite=True)
     
+    def export_int8(self, path: str) -> QuantizedSPEED:
+        # QAT结束后转换为INT8模型, 保存为TorchScript
+        quantized = convert(self.model)
+        example = torch.zeros(1, 1, *self.config["imgsz"], dtype=torch.uint8)
+        with torch.no_grad():
+            torch.jit.trace(quantized, example).save(path)
+        return quantized
+    
     def configure_optimizers(self):
-        # 定义优化器
+        # 定义优化器, QAT微调使用QAT.lr
+        lr0 = self.config["QAT"]["lr"] if self.config["QAT"]["enable"] else self.config["lr0"]
         if self.config["optimizer"] == "AdamW":
             if self.config["precision"] == "half":
                 eps = 1e-3
             else:
                 eps = 1e-8
-            optimizer = AdamW(self.parameters(), lr=self.config["lr0"],
+            optimizer = AdamW(self.parameters(), lr=lr0,
                              weight_decay=self.config["weight_decay"],
                              eps=eps)
         elif self.config["optimizer"] == "SGD":
-            optimizer = SGD(self.parameters(), lr=self.config["lr0"],
+            optimizer = SGD(self.parameters(), lr=lr0,
                             weight_decay=self.config["weight_decay"],
                             momentum=self.config["momentum"])
         
@@ -234,7 +299,10 @@ class LightningMobileSPEEDv3(L.LightningModule):
             "interval": "epoch",            # 调度间隔
             "frequency": 1,                 # 调度频率
         }
-        if self.config["lr_scheduler"] == "WarmupCosineAnnealingLR":
+        if self.config["QAT"]["enable"]:
+            # QAT从训练好的权重开始, 不做warmup, 学习率按余弦衰减
+            scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=self.config["QAT"]["epoch"])
+        elif self.config["lr_scheduler"] == "WarmupCosineAnnealingLR":
             # 余弦退火学习率调度器
             lambda_max = self.config["lr0"] / self.config['lr0']
             lambda_min = self.config["lr_min"] / self.config["lr0"]
@@ -263,6 +331,21 @@ class LightningMobileSPEEDv3(L.LightningModule):
             "lr_scheduler": lr_scheduler_config
         }
 
+def load_checkpoint(ckpt: str, config: dict = None) -> LightningMobileSPEEDv3:
+    # 在CPU上加载checkpoint, 默认使用checkpoint中保存的配置, 解码器放在CPU上, 不下载预训练权重
+    checkpoint = torch.load(ckpt, map_location="cpu", weights_only=False)
+    if config is None:
+        config = checkpoint.get("hyper_parameters", {}).get("config", get_config())
+    # checkpoint之后新增的配置项(包括嵌套字典中的键)使用默认值
+    config = merge_config(copy.deepcopy(config))
+    config["accelerator"] = "cpu"
+    config["pretrained"] = False
+    # QAT的checkpoint中已经是fake-quant模型的权重, 不再加载浮点checkpoint
+    config["QAT"]["ckpt"] = None
+    module = LightningMobileSPEEDv3(config)
+    module.load_state_dict(checkpoint["state_dict"])
+    return module.eval()
+
 # @torch.jit.script
 def get_box(box, stage):
     batch_index = torch.arange(0, box.shape[0]).unsqueeze(1).repeat(1, 4)
@@ -0,0 +1,270 @@
+"""
+Batch augmentation
+
+"""
+
+import torch
+import numpy as np
+import torch.nn.functional as F
+
+from torch import Tensor
+
+from .flare import SunFlareBank, flare_transmission
+from .quaternion import quat_canonical, quat_multiply, quat_to_matrix, euler_yxz_to_quat
+from .utils import Camera, scale_matrix
+
+
+def warp_boxes_batch(boxes: Tensor, M: Tensor, width: int, height: int) -> Tensor:
+    # warp_boxes的批量版本, boxes [..., 4], M [..., 3, 3], 结果限制在图片内
+    x1, y1, x2, y2 = boxes.unbind(-1)
+    corners = torch.stack([x1, y1, x2, y2, x1, y2, x2, y1], -1).reshape(*boxes.shape[:-1], 4, 2)
+    corners = torch.cat([corners, torch.ones_like(corners[..., :1])], -1) @ M.transpose(-1, -2)
+    x = corners[..., 0] / corners[..., 2]
+    y = corners[..., 1] / corners[..., 2]
+    return torch.stack([x.amin(-1).clamp(0, width - 1), y.amin(-1).clamp(0, height - 1),
+                        x.amax(-1).clamp(0, width - 1), y.amax(-1).clamp(0, height - 1)], -1)
+
+
+def box_area(boxes: Tensor) -> Tensor:
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+
+class BatchGeometricAugment:
+    """在collate之后对整个批次做缩放与旋转增强
+
+    与Speed.warp使用相同的增强分布与接受条件, 每个样本一次抽取max_tries个候选,
+    取第一个被接受的候选, 位姿、bbox与单应矩阵都用批量矩阵运算更新,
+    最后用一次grid_sample完成整个批次的透视变换。输入为imgsz大小的图片,
+    内参由Camera.K缩放到imgsz, 也可以传入每个样本的内参 [B, 3, 3]。
+    """
+
+    def __init__(self, config: dict, stats=None, max_tries: int = 6):
+        self.config: dict = config
+        self.stats = stats              # AugmentationStats, 记录接受率
+        self.max_tries: int = max_tries
+        self.height, self.width = config["imgsz"]
+        self.K = torch.from_numpy(scale_matrix(self.width / Camera.width, self.height / Camera.height) @ Camera(config).K)
+
+    def __call__(self, images: Tensor, labels: dict, K: Tensor = None):
+        # images [B, 1, H, W] uint8或[0, 1]的浮点数, labels含pos/ori/bbox
+        # 返回[0, 1]的float32图片, labels中的pos/ori/bbox原地更新
+        B, device, dtype = images.shape[0], images.device, torch.float64
+        K = (self.K if K is None else K).to(device, dtype).expand(B, 3, 3)
+        K_inv = torch.linalg.inv(K)
+        pos = labels["pos"].to(dtype)
+        ori = labels["ori"].to(dtype)
+        bbox = labels["bbox"].to(dtype)
+        M = torch.eye(3, dtype=dtype, device=device).repeat(B, 1, 1)
+        batch_index = torch.arange(B, device=device)
+
+        # 缩放增强: 以目标中心的投影点为中心缩放, 投影点不动
+        active = torch.rand(B, device=device) < self.config["Resize"]["p"]
+        if active.any():
+            alpha = 1 + (torch.rand(B, self.max_tries, device=device, dtype=dtype) * 2 - 1) * self.config["Resize"]["ratio"]
+            center = (K @ (pos / pos[:, 2:])[..., None])[..., 0]
+            M_zoom = torch.zeros(B, self.max_tries, 3, 3, device=device, dtype=dtype)
+            M_zoom[..., 0, 0] = alpha
+            M_zoom[..., 1, 1] = alpha
+            M_zoom[..., 0, 2] = center[:, None, 0] * (1 - alpha)
+            M_zoom[..., 1, 2] = center[:, None, 1] * (1 - alpha)
+            M_zoom[..., 2, 2] = 1
+            pos_zoom = pos[:, None] / alpha[..., None]
+            distance = pos_zoom.norm(dim=-1)
+            index, accepted = self.select("resize", (10 < distance) & (distance < 40), active)
+            pos = torch.where(accepted[:, None], pos_zoom[batch_index, index], pos)
+            M_zoom = M_zoom[batch_index, index]
+            bbox = torch.where(accepted[:, None], warp_boxes_batch(bbox, M_zoom, self.width, self.height), bbox)
+            M = torch.where(accepted[:, None, None], M_zoom @ M, M)
+
+        # 旋转增强: dice <= p时绕光轴旋转图像, 否则旋转相机
+        dice = torch.rand(B, device=device)
+        rotate_img = (dice <= self.config["Rotate"]["p"]) & self.config["Rotate"]["Rotate_img"]
+        rotate_cam = (dice > self.config["Rotate"]["p"]) & self.config["Rotate"]["Rotate_cam"]
+        if (rotate_img | rotate_cam).any():
+            change = torch.rand(B, self.max_tries, 3, device=device, dtype=dtype) * 2 - 1
+            img_change = torch.zeros_like(change)
+            img_change[..., 2] = change[..., 2] * self.config["Rotate"]["img_angle"]
+            change = torch.where(rotate_img[:, None, None], img_change, change * self.config["Rotate"]["cam_angle"])
+            rotation = euler_yxz_to_quat(change[..., 0], change[..., 1], change[..., 2])
+            r_change = quat_to_matrix(rotation)
+            M_rotate = K[:, None] @ r_change @ K_inv[:, None]
+            bbox_rotate = warp_boxes_batch(bbox[:, None], M_rotate, self.width, self.height)
+            ok = box_area(bbox_rotate) >= 0.95 * box_area(bbox)[:, None]
+            index_img, accepted_img = self.select("rotate_img", ok, rotate_img)
+            index_cam, accepted_cam = self.select("rotate_cam", ok, rotate_cam)
+            index = torch.where(rotate_img, index_img, index_cam)
+            accepted = accepted_img | accepted_cam
+            rotation = rotation[batch_index, index]
+            pos = torch.where(accepted[:, None], (r_change[batch_index, index] @ pos[..., None])[..., 0], pos)
+            ori = torch.where(accepted[:, None], quat_canonical(quat_multiply(rotation, ori)), ori)
+            bbox = torch.where(accepted[:, None], bbox_rotate[batch_index, index], bbox)
+            M = torch.where(accepted[:, None, None], M_rotate[batch_index, index] @ M, M)
+
+        images = self.warp(images, M)
+        labels["pos"][:] = pos
+        labels["ori"][:] = ori
+        labels["bbox"][:] = bbox.floor()
+        return images, labels
+
+    def select(self, name: str, ok: Tensor, active: Tensor):
+        # 每个样本取第一个被接受的候选, 并按逐样本拒绝采样的方式统计候选次数
+        found = ok.any(dim=1)
+        index = ok.int().argmax(dim=1)
+        accepted = active & found
+        if self.stats is not None and active.any():
+            tries = torch.where(found, index + 1, self.max_tries)[active]
+            self.stats.update(name, int(tries.sum()), int(accepted.sum()), int(active.sum()))
+        return index, accepted
+
+    def warp(self, images: Tensor, M: Tensor) -> Tensor:
+        # 等价于对每个样本做cv.warpPerspective(image, M, (W, H), flags=cv.INTER_LINEAR)
+        B, _, H, W = images.shape
+        # 输出像素反向映射到输入像素, 归一化到[-1, 1] (align_corners=True)的缩放并入同一个矩阵
+        normalize = torch.tensor([[2 / (W - 1), 0, -1], [0, 2 / (H - 1), -1], [0, 0, 1]], dtype=M.dtype, device=M.device)
+        A = (normalize @ torch.linalg.inv(M)).to(torch.float32)
+        xs = torch.arange(W, device=images.device, dtype=torch.float32)
+        ys = torch.arange(H, device=images.device, dtype=torch.float32)
+        # 按行列分离计算 A @ [x, y, 1], 直接得到[B, H, W, 2]布局, 避免[B, H*W, 3]的矩阵乘法
+        x_term = A[:, None, None, :, 0] * xs[None, None, :, None]                          # [B, 1, W, 3]
+        y_term = A[:, None, None, :, 1] * ys[None, :, None, None] + A[:, None, None, :, 2]  # [B, H, 1, 3]
+        xy = x_term[..., :2] + y_term[..., :2]
+        grid = xy.div_(x_term[..., 2:] + y_term[..., 2:])
+        if images.dtype == torch.uint8:
+            images = images.to(torch.float32).mul_(1 / 255)
+        return F.grid_sample(images, grid, mode="bilinear", padding_mode="zeros", align_corners=True)
+
+
+class BatchPhotometricAugment:
+    """对整个批次做像素级增强, 替代worker中逐张图片的Albumentations链
+
+    与原有增强使用相同的概率: 概率p时从 AdvancedBlur/GaussNoise/Blur/GaussianBlur 中等概率选一种(OneOf),
+    概率p时做亮度/对比度抖动(ColorJitter, 灰度图上饱和度与色调无效), 概率flare_p时叠加太阳光晕(RandomSunFlare overlay),
+    传入光晕库时光晕从库中截取, 不再逐张渲染。
+    每个样本的参数独立随机。原增强作用在原图上, 这里作用在imgsz的图片上,
+    因此模糊核、光晕半径等空间参数由原图像素换算到imgsz像素, 各种模糊统一为方差相同的高斯核。
+    """
+
+    kernel_radius: int = 3      # imgsz上的模糊核半径, 覆盖换算后最大sigma的3倍以上
+    table_size: int = 1024      # 光晕透过率查找表的长度
+
+    def __init__(self, config: dict, p: float, flare_p: float, bank: SunFlareBank = None):
+        self.p: float = p
+        self.flare_p: float = flare_p
+        self.height, self.width = config["imgsz"]
+        self.scale: float = self.width / Camera.width      # 原图像素 -> imgsz像素
+        self.src_radius: float = config["SunFlare"]["src_radius"] * self.scale
+        self.num_circles = config["SunFlare"]["num_circles"]
+        self.transmission = torch.from_numpy(flare_transmission(config["SunFlare"]["src_radius"], self.table_size))
+        # 有光晕库时从库中截取光晕, 否则逐张渲染; 库中的(a, c)堆叠为[N, 2, 2h, 2w]的uint8, 与光晕库共享内存
+        self.bank: SunFlareBank = bank
+        self.bank_layers: Tensor = torch.from_numpy(np.stack([bank.coverage, bank.color], 1)) if bank is not None else None
+
+    def __call__(self, images: Tensor, generator: torch.Generator = None) -> Tensor:
+        # images [B, 1, H, W] uint8或[0, 1]的浮点数, 返回[0, 1]的float32图片
+        # generator只作用于光晕, 传入固定种子的CPU generator可以让光晕可复现
+        if images.dtype == torch.uint8:
+            images = images.to(torch.float32).mul_(1 / 255)
+        else:
+            images = images.to(torch.float32, copy=True)
+        B, device = images.shape[0], images.device
+        # OneOf: 0 AdvancedBlur, 1 GaussNoise, 2 Blur, 3 GaussianBlur
+        selected = torch.rand(B, device=device) < self.p
+        choice = torch.randint(0, 4, (B,), device=device)
+        blur = torch.nonzero(selected & (choice != 1)).flatten()
+        if len(blur):
+            images[blur] = self.blur(images[blur], choice[blur])
+        noise = torch.nonzero(selected & (choice == 1)).flatten()
+        if len(noise):
+            # GaussNoise(var_limit=(5, 15)), 方差以uint8灰度为单位
+            sigma = torch.empty(len(noise), 1, 1, 1, device=device).uniform_(5, 15).sqrt_() / 255
+            images[noise] += torch.randn_like(images[noise]) * sigma
+        jitter = torch.nonzero(torch.rand(B, device=device) < self.p).flatten()
+        if len(jitter):
+            images[jitter] = self.jitter(images[jitter].clamp_(0, 1))
+        flare = torch.nonzero(torch.rand(B, generator=generator).to(device) < self.flare_p).flatten()
+        if len(flare):
+            if self.bank is not None:
+                images[flare] = self.blend_flare(images[flare].clamp_(0, 1), generator)
+            else:
+                images[flare] = self.flare(images[flare].clamp_(0, 1))
+        return images.clamp_(0, 1)
+
+    def blur(self, images: Tensor, choice: Tensor) -> Tensor:
+        # 每个样本一个 (2r+1)x(2r+1) 的高斯核, 用分组卷积一次完成
+        n, device = images.shape[0], images.device
+        ksize = torch.randint(1, 4, (n,), device=device) * 2 + 1                       # 原图上的核大小 3/5/7
+        sigma_gauss = 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8                               # cv.getGaussianKernel的默认sigma
+        sigma_box = ksize / 12 ** 0.5                                                   # 与均值滤波方差相同的sigma
+        sigma = torch.where(choice == 2, sigma_box, sigma_gauss)[:, None].repeat(1, 2)
+        angle = torch.zeros(n, device=device)
+        # AdvancedBlur: 各向异性、旋转±25度的高斯核, sigma_x/sigma_y ∈ [0.2, 1.0]
+        advanced = choice == 0
+        sigma[advanced] = torch.empty(int(advanced.sum()), 2, device=device).uniform_(0.2, 1.0)
+        angle[advanced] = torch.deg2rad(torch.empty(int(advanced.sum()), device=device).uniform_(-25, 25))
+        sigma = (sigma * self.scale).clamp_(min=1e-3)
+        r = self.kernel_radius
+        offsets = torch.arange(-r, r + 1, device=device, dtype=torch.float32)
+        ys, xs = torch.meshgrid(offsets, offsets, indexing="ij")
+        cos, sin = angle.cos()[:, None, None], angle.sin()[:, None, None]
+        u = xs * cos + ys * sin
+        v = -xs * sin + ys * cos
+        kernel = torch.exp(-0.5 * ((u / sigma[:, 0, None, None]) ** 2 + (v / sigma[:, 1, None, None]) ** 2))
+        kernel = kernel / kernel.sum(dim=(1, 2), keepdim=True)
+        padded = F.pad(images.transpose(0, 1), (r, r, r, r), mode="reflect")             # BORDER_REFLECT_101
+        return F.conv2d(padded, kernel[:, None], groups=n).transpose(0, 1)
+
+    def jitter(self, images: Tensor) -> Tensor:
+        # ColorJitter(brightness=0.3, contrast=0.3), 两者的先后顺序随机
+        n, device = images.shape[0], images.device
+        brightness = torch.empty(n, 1, 1, 1, device=device).uniform_(0.7, 1.3)
+        contrast = torch.empty(n, 1, 1, 1, device=device).uniform_(0.7, 1.3)
+        brightness_first = torch.rand(n, 1, 1, 1, device=device) < 0.5
+
+        def adjust_contrast(x):
+            return (x * contrast + x.mean(dim=(1, 2, 3), keepdim=True) * (1 - contrast)).clamp_(0, 1)
+
+        x = torch.where(brightness_first, (images * brightness).clamp_(0, 1), adjust_contrast(images))
+        return torch.where(brightness_first, adjust_contrast(x), (x * brightness).clamp_(0, 1))
+
+    def flare(self, images: Tensor) -> Tensor:
+        # RandomSunFlare(method="overlay"): 先沿过光源的直线叠加若干小光斑, 再叠加径向渐变的光源
+        n, _, H, W = images.shape
+        device = images.device
+        xs = torch.arange(W, device=device, dtype=torch.float32)[None, None, None, :]
+        ys = torch.arange(H, device=device, dtype=torch.float32)[None, None, :, None]
+        center = torch.rand(n, 2, device=device) * torch.tensor([W, H], device=device)
+        angle = torch.rand(n, device=device) * 2 * torch.pi
+        # 光斑: 位置在光源所在直线上, 原图上半径为 randint(1, max(2, 0.01 * height)) 的立方
+        num_circles = torch.randint(self.num_circles[0], self.num_circles[1] + 1, (n,), device=device)
+        max_rad = max(2, int(Camera.height * 0.01))
+        for k in range(self.num_circles[1]):
+            t = torch.rand(n, device=device) * W - center[:, 0]
+            cx = (center[:, 0] + t * angle.cos())[:, None, None, None]
+            cy = (center[:, 1] + t * angle.sin())[:, None, None, None]
+            radius = (torch.randint(1, max_rad + 1, (n,), device=device) ** 3 * self.scale)[:, None, None, None]
+            alpha = torch.empty(n, 1, 1, 1, device=device).uniform_(0.05, 0.2) * (k < num_circles)[:, None, None, None]
+            color = torch.empty(n, 1, 1, 1, device=device).uniform_(0.8, 1.0)
+            inside = (xs - cx) ** 2 + (ys - cy) ** 2 <= radius ** 2
+            images = torch.where(inside, images * (1 - alpha) + color * alpha, images)
+        # 光源: 按到中心的归一化距离查透过率
+        distance = ((xs - center[:, 0, None, None, None]) ** 2 + (ys - center[:, 1, None, None, None]) ** 2).sqrt_()
+        index = (distance / self.src_radius * (self.table_size - 1)).clamp_(max=self.table_size - 1).long()
+        transmission = self.transmission.to(device)[index]
+        return images * transmission + (1 - transmission)
+
+    def blend_flare(self, images: Tensor, generator: torch.Generator = None) -> Tensor:
+        # 与SunFlareBank.apply相同: 随机选取光晕、窗口位置与强度, 一次grid_sample截取窗口并放大到imgsz
+        n, _, H, W = images.shape
+        device = images.device
+        if self.bank_layers.device != device:
+            self.bank_layers = self.bank_layers.to(device)
+        index = torch.randint(len(self.bank), (n,), generator=generator)
+        k = torch.empty(n).uniform_(*self.bank.intensity, generator=generator)
+        # 窗口为画布的一半, 中心在画布归一化坐标[-0.5, 0.5]内均匀分布
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = theta[:, 1, 1] = 0.5
+        theta[:, :, 2] = torch.rand(n, 2, generator=generator) - 0.5
+        grid = F.affine_grid(theta.to(device), [n, 2, H, W], align_corners=False)
+        layers = self.bank_layers[index.to(device)].to(torch.float32)
+        overlay = F.grid_sample(layers, grid, mode="bilinear", align_corners=False) * (k / 255).to(device)[:, None, None, None]
+        return images * (1 - overlay[:, :1]) + overlay[:, 1:]
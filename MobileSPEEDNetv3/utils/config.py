@@ -1,3 +1,4 @@
+import copy
 import yaml
 import torch
 # from .utils import build_histogram, pre_compute_ori_decode
@@ -11,3 +12,15 @@ def get_config(cfg_path: str = "MobileSPEEDNetv3/cfg/base.yaml"):
     #                                                              torch.tensor([180, 90, 180]))
     # config["B"] = pre_compute_ori_decode(config["H_MAP"])
     return config
+
+
+def merge_config(config: dict, default: dict = None) -> dict:
+    # 用默认配置补全config中缺少的键, 嵌套的字典逐层补全, 已有的值保持不变; 原地修改并返回config
+    # 旧版本checkpoint中保存的配置缺少之后新增的配置项(包括Rotate等字典中的新键)
+    default = get_config() if default is None else default
+    for key, value in default.items():
+        if key not in config:
+            config[key] = copy.deepcopy(value)
+        elif isinstance(value, dict) and isinstance(config[key], dict):
+            merge_config(config[key], value)
+    return config
@@ -0,0 +1,57 @@
+"""
+CPU training profile
+
+"""
+
+import os
+import cv2 as cv
+import torch
+
+from typing import List
+
+
+def available_cores() -> List[int]:
+    # 当前进程可以使用的CPU核
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores: List[int], threads: int, workers: int):
+    # 前threads个核给计算线程, 剩下的核分给DataLoader worker; 核不够分时worker与计算线程共用所有核
+    compute = cores[:threads]
+    loader = cores[threads:] if workers > 0 and len(cores) > threads else cores
+    return compute, loader
+
+
+def pin_worker(worker_id: int, cores: List[int]):
+    # DataLoader的worker_init_fn: 每个worker绑定到一个核, worker多于核时轮流分配
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {cores[worker_id % len(cores)]})
+    torch.set_num_threads(1)
+    cv.setNumThreads(1)
+
+
+def configure_cpu(config: dict) -> dict:
+    """按DataLoader worker的数量设置CPU训练的线程数与核绑定, 需要在创建DataLoader与开始计算之前调用
+
+    threads为0时计算线程数为 可用核数 - workers (至少1), inter-op线程数为interop_threads;
+    pin_cores为True时主进程(计算线程)绑定到前threads个核, 返回的worker_cores写入config,
+    由SpeedDataModule在worker启动时把每个worker绑定到剩余的核上。
+    """
+    cores = available_cores()
+    workers = config["workers"]
+    threads = config["threads"] if config["threads"] > 0 else max(1, len(cores) - workers)
+    threads = min(threads, len(cores))
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(config["interop_threads"])
+    except RuntimeError:
+        # inter-op线程池已经启动后不能再修改
+        pass
+    compute, loader = split_cores(cores, threads, workers)
+    if config["pin_cores"] and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, set(compute))
+        config["worker_cores"] = loader
+    return {"cores": len(cores), "threads": torch.get_num_threads(), "interop_threads": torch.get_num_interop_threads(),
+            "compute_cores": compute, "worker_cores": loader if config["pin_cores"] else None}
@@ -1,18 +1,26 @@
 from torchvision.transforms import v2
-from torch.utils.data import Dataset, random_split, Subset
+from torch.utils.data import Dataset, random_split, Subset, get_worker_info, default_collate
+from multiprocessing.sharedctypes import RawArray
 from pathlib import Path
 from threading import Thread
 from tqdm import tqdm
-from .utils import rotate_image, rotate_cam, resize, Camera, warp_boxes, bbox_in_image, OriEncoderDecoder, OriEncoderDecoderGauss
+from .storage import SharedImageStore, MemmapImageStore, JpegBytesStore, LabelTable, IMREAD_FLAGS
+from .utils import rotate_image_pose, rotate_cam_pose, resize_pose, scale_matrix, RemapCache, Camera, warp_boxes, bbox_in_image
+from .batch_augment import BatchGeometricAugment, BatchPhotometricAugment
+from .flare import SunFlareBank
+from .cpu import pin_worker
+from .profiler import StageTimer
 from typing import List
+from functools import partial
 
 import albumentations as A
 import cv2 as cv
 import lightning as L
 import numpy as np
 import random
+import ctypes
 
-import json
+import zlib
 import torch
 from torch.utils.data import DataLoader
 
@@ -89,9 +97,29 @@ def CropAndPad(img: np.array, bbox: List[float]):
 def DropBlockSafe(img: np.array, bbox: List[float], drop_num_lim: int):
     # 随机丢弃部分图片中的一些块
     # 丢弃块不覆盖bbox
-    
-    assert drop_num_lim > 0, "drop_num_lim must be greater than 0" 
-    
+    # 图片缓存返回只读视图, 先复制再原地丢弃
+    if not img.flags.writeable:
+        img = img.copy()
+    return DropBlockSafeInplace(img, bbox, drop_num_lim)
+
+def CropAndPadInplace(img: np.array, bbox: List[int]):
+    # CropAndPad的原地版本, 裁掉的部分直接用裁剪边缘的像素填充, 与BORDER_REPLICATE的结果相同
+    x_min, y_min, x_max, y_max = bbox
+    height, width = img.shape[:2]
+    crop_x_min = np.random.randint(0, x_min+1)
+    crop_y_min = np.random.randint(0, y_min+1)
+    crop_x_max = np.random.randint(x_max, width)
+    crop_y_max = np.random.randint(y_max, height)
+    img[:crop_y_min] = img[crop_y_min]
+    img[crop_y_max+1:] = img[crop_y_max]
+    img[:, :crop_x_min] = img[:, crop_x_min:crop_x_min+1]
+    img[:, crop_x_max+1:] = img[:, crop_x_max:crop_x_max+1]
+    return img
+
+def DropBlockSafeInplace(img: np.array, bbox: List[int], drop_num_lim: int):
+    # DropBlockSafe的原地版本, 丢弃块覆盖所有通道
+    assert drop_num_lim > 0, "drop_num_lim must be greater than 0"
+
     x_min, y_min, x_max, y_max = bbox
     height, width = img.shape[:2]
     drop_num = np.random.randint(1, drop_num_lim+1)
@@ -102,16 +130,15 @@ def DropBlockSafe(img: np.array, bbox: List[float], drop_num_lim: int):
         3: [0, y_max+1, width-1, height-1]
     }
     for i in range(drop_num):
-        area = np.random.randint(0, 4)
-        area_x_min, area_y_min, area_x_max, area_y_max = area_dict[area]
-        try:
-            drop_x_min = np.random.randint(area_x_min, area_x_max+1)
-            drop_y_min = np.random.randint(area_y_min, area_y_max+1)
-            drop_x_max = np.random.randint(drop_x_min, area_x_max+1)
-            drop_y_max = np.random.randint(drop_y_min, area_y_max+1)
-            img[drop_y_min:drop_y_max+1, drop_x_min:drop_x_max+1, :] = np.random.randint(100, 200)
-        except:
-            pass
+        area_x_min, area_y_min, area_x_max, area_y_max = area_dict[np.random.randint(0, 4)]
+        # bbox贴边时该区域为空
+        if area_x_min > area_x_max or area_y_min > area_y_max:
+            continue
+        drop_x_min = np.random.randint(area_x_min, area_x_max+1)
+        drop_y_min = np.random.randint(area_y_min, area_y_max+1)
+        drop_x_max = np.random.randint(drop_x_min, area_x_max+1)
+        drop_y_max = np.random.randint(drop_y_min, area_y_max+1)
+        img[drop_y_min:drop_y_max+1, drop_x_min:drop_x_max+1] = np.random.randint(100, 200)
     return img
 
 class MultiEpochsDataLoader(DataLoader):
@@ -143,17 +170,99 @@ class _RepeatSampler(object):
             yield from iter(self.sampler)
 
 
+class AugmentationStats:
+    """统计各几何增强的候选采样次数与接受次数
+
+    计数放在fork前创建的共享内存中, 每个dataloader worker只写自己的槽位, 无需加锁。
+    几何增强只在训练集上进行, 验证集的worker不会写入计数。
+    每个增强记录 [样本数, 候选采样次数, 接受的样本数]。
+    """
+    names: List[str] = ["resize", "rotate_img", "rotate_cam"]
+
+    def __init__(self, workers: int):
+        self.counts = np.frombuffer(RawArray(ctypes.c_int64, (workers + 1) * len(self.names) * 3), dtype=np.int64)
+        self.counts = self.counts.reshape(workers + 1, len(self.names), 3)
+
+    def update(self, name: str, tries: int, accepted: int, samples: int = 1):
+        # 批量增强时一次累加整个批次的 样本数/候选次数/接受数
+        worker_info = get_worker_info()
+        slot = 0 if worker_info is None else (worker_info.id + 1) % self.counts.shape[0]
+        self.counts[slot, self.names.index(name)] += [samples, tries, int(accepted)]
+
+    def summary(self) -> dict:
+        # 接受率 = 接受的样本数 / 候选采样次数, 放弃率 = 所有候选都被拒绝的样本比例
+        counts = self.counts.sum(axis=0)
+        stats = {}
+        for name, (samples, tries, accepted) in zip(self.names, counts):
+            if samples == 0:
+                continue
+            stats[f"{name}_acceptance"] = float(accepted / tries)
+            stats[f"{name}_fallback"] = float(1 - accepted / samples)
+        return stats
+
+    def reset(self):
+        self.counts[:] = 0
+
+
+# uint8传输时打包标签的布局 [pos(3), ori(4), bbox(4)]
+LABEL_LAYOUT = {"pos": slice(0, 3), "ori": slice(3, 7), "bbox": slice(7, 11)}
+LABEL_DIM = 11
+
+
+def pack_label(pos: np.ndarray, ori: np.ndarray, bbox: List[float]) -> np.ndarray:
+    label = np.empty(LABEL_DIM, dtype=np.float32)
+    label[LABEL_LAYOUT["pos"]] = pos
+    label[LABEL_LAYOUT["ori"]] = ori
+    label[LABEL_LAYOUT["bbox"]] = bbox
+    return label
+
+
+def unpack_label(labels: dict) -> dict:
+    # 在打包的标签张量上切出pos/ori/bbox视图, 不产生拷贝
+    for key, index in LABEL_LAYOUT.items():
+        labels[key] = labels["label"][:, index]
+    return labels
+
+
+def speed_collate(batch: list):
+    # uint8传输的collate: 图片堆叠为[B, 1, H, W]的uint8张量, 标签堆叠为[B, 11]的float32张量
+    # default_collate在worker中直接把结果分配在共享内存里, 避免再拷贝一次
+    if isinstance(batch[0][1], dict):
+        images = default_collate([torch.from_numpy(image) for image, _ in batch])
+        labels = {
+            "filename": [y["filename"] for _, y in batch],
+            "label": default_collate([y["label"] for _, y in batch]),
+        }
+        return images, labels
+    # 自监督: 每个样本为[K, 1, H, W]的多视图, 堆叠为[B, K, 1, H, W]
+    return default_collate([torch.from_numpy(views) for views in batch])
+
+
 def prepare_Speed(config: dict):
     # 准备数据集
 
+    # remap表每张约2.2MB(768x480), 按角度范围缓存全部量化角度会耗尽内存, 需要显式设置上限
+    if config["Rotate"]["quantize"] > 0 and config["Rotate"]["remap_cache"] <= 0:
+        raise ValueError("Rotate.quantize > 0 requires Rotate.remap_cache > 0")
+
     # 为Speed类添加属性
     Speed.config = config
     Speed.camera = Camera(config)
+    Speed.decode_scale = Speed.camera.decode_scale
+    Speed.imread_flag = IMREAD_FLAGS[Speed.decode_scale]
     Speed.data_dir = Path(config["data_dir"])
     Speed.image_dir = Speed.data_dir / "images/train"
     Speed.label_file = Speed.data_dir / "train_label.json"
     Speed.test_img_dir = Speed.data_dir / "images/train"
     Speed.real_test_img_dir = Speed.data_dir / "images/train"
+    Speed.cache_dir = Path(config["cache_dir"]) if config.get("cache_dir") else Speed.data_dir / "cache"
+
+    # 太阳光晕库每次运行生成一次, worker fork后共享
+    if config["SunFlare"]["val"] not in ("deterministic", "disabled", "random"):
+        raise ValueError(f"unknown SunFlare.val policy: {config['SunFlare']['val']}")
+    if config["SunFlare"]["val"] == "deterministic" and config["SunFlare"]["bank_size"] == 0:
+        raise ValueError("SunFlare.val: deterministic requires SunFlare.bank_size > 0")
+    Speed.flare_bank = SunFlareBank(config) if config["SunFlare"]["bank_size"] > 0 else None
 
     # 设置transform
     Speed.transform = {
@@ -265,8 +374,12 @@ def prepare_Speed(config: dict):
         }
     }
 
-    # 设置标签字典
-    Speed.labels = json.load(open(Speed.label_file, "r"))
+    # 加载编译后的标签表, 源json变化时重新编译
+    label_table_file = Speed.cache_dir / "train_label.npz"
+    if LabelTable.exists(label_table_file, Speed.label_file):
+        Speed.labels = LabelTable(label_table_file)
+    else:
+        Speed.labels = LabelTable.compile(Speed.label_file, label_table_file, Camera.width, Camera.height)
     
     # 采样列表
     if config["debug"]:
@@ -279,39 +392,30 @@ def prepare_Speed(config: dict):
     Speed.train_index, Speed.val_index = random_split(Speed.img_name, [train_num, val_num])
     # Speed.test_index = list(Speed.test_labels.keys())
 
-    # 缓存图片
+    # 缓存图片, 重复调用时先释放上一次的缓存, 共享内存不等到进程退出才回收
+    if Speed.img_store is not None:
+        Speed.img_store.close()
+        Speed.img_store = None
     if Speed.config["ram"]:
-        Speed.img_dict = {}
         Speed.read_img()
     
-    # 设置姿态编码解码器
-    if Speed.config["encoder"] == "Linear":
-        Speed.ori_encoder_decoder = OriEncoderDecoder(Speed.config["stride"], Speed.config["s"], Speed.config["n"])
-    elif Speed.config["encoder"] == "Gauss":
-        Speed.ori_encoder_decoder = OriEncoderDecoderGauss(Speed.config["stride"], Speed.config["s"], Speed.config["n"])
+    # 几何增强接受率统计
+    Speed.aug_stats = AugmentationStats(config["workers"])
+    # worker中各阶段的耗时统计, 由StepProfiler读取
+    Speed.stage_timer = StageTimer(config["workers"], config["Profile"]["worker_events"], enable=config["Profile"]["enable"])
 
 
 class ImageReader(Thread):
-    def __init__(self, img_name: list, config: dict, image_dir: Path):
+    def __init__(self, img_name: list, config: dict, image_dir: Path, img_store):
         Thread.__init__(self)
         self.config: dict = config
         self.image_dir: Path = image_dir
         self.image_name: list = img_name
-        self.img_dict: dict = {}
+        self.img_store = img_store
     
     def run(self):
         for img_name in tqdm(self.image_name):
-            image = cv.imread(str(self.image_dir / img_name), cv.IMREAD_GRAYSCALE)
-            bbox = Speed.labels[img_name]["bbox"]
-            if bbox[2] >= 1920:
-                bbox[2] = 1919
-            if bbox[3] >= 1200:
-                bbox[3] = 1199
-            Speed.labels[img_name]["bbox"] = bbox
-            self.img_dict[img_name] = image
-    
-    def get_result(self) -> dict:
-        return self.img_dict
+            self.img_store.load(img_name, self.image_dir / img_name)
 
 
 class Speed(Dataset):
@@ -319,7 +423,7 @@ class Speed(Dataset):
     image_dir: Path         # 图片目录
     po_file: Path           # 位姿json文件
     bbox_file: Path         # bbox json文件
-    labels: dict            # 标签字典
+    labels: LabelTable      # 编译后的标签表
     test_labels: dict       # 测试集标签字典
     config: dict            # 配置字典
     img_name: list          # 样本id列表
@@ -327,9 +431,14 @@ class Speed(Dataset):
     train_index: Subset     # 训练集图片名列表
     val_index: Subset       # 验证集图片名列表
     test_index: list        # 测试集图片名列表
-    img_dict: dict = {} # 图片字典
+    cache_dir: Path         # 图片缓存目录
+    img_store = None        # 图片缓存 SharedImageStore/MemmapImageStore/JpegBytesStore
     camera: Camera
-    ori_encoder_decoder =  None
+    decode_scale: int = 1   # 解码缩放倍数
+    aug_stats: AugmentationStats = AugmentationStats(0)    # 几何增强接受率统计
+    flare_bank: SunFlareBank = None     # 预生成的太阳光晕库, None时逐张渲染
+    stage_timer: StageTimer = StageTimer(0, enable=False)      # worker中各阶段的耗时统计
+    imread_flag: int = cv.IMREAD_GRAYSCALE
     
 
     def __init__(self, mode: str = "train"):
@@ -337,17 +446,24 @@ class Speed(Dataset):
         self.transform = Speed.transform[mode]["transform"]
         self.sample_index = Speed.train_index if "train" in mode else Speed.val_index if "val" in mode else Speed.test_index
         self.mode = mode
-        self.Resize = A.Compose([A.Resize(height=Speed.config["imgsz"][0], width=Speed.config["imgsz"][1], p=1.0, interpolation=cv.INTER_LINEAR)],
-        p=1,
-        bbox_params=A.BboxParams(format="pascal_voc", label_fields=["category_ids"]))
-        self.last_resize = v2.Resize(Speed.config["imgsz"])
-        self.sun_flare = A.RandomSunFlare(
-            flare_roi=(0, 0, 1, 1),
-            num_flare_circles_range=(5, 10),
-            src_radius=500,
-            method="overlay",
-            p=0.5
-        )
+        # 耗时统计写入的槽位段, 测试集与验证集相同
+        self.split: str = "train" if "train" in mode else "val"
+        # 量化旋转角度时缓存remap表, 每个worker最多Rotate.remap_cache张
+        self.remap_cache = None
+        if Speed.config["Rotate"]["quantize"] > 0:
+            self.remap_cache = RemapCache(Speed.config["Rotate"]["remap_cache"])
+        # 训练集随机叠加光晕; 验证/测试集按SunFlare.val: random与训练集相同, deterministic按样本序号固定, disabled不加
+        self.flare_policy: str = "random" if "train" in mode else Speed.config["SunFlare"]["val"]
+        # 没有光晕库时逐张渲染, 光源半径以原图像素配置, 换算到解码分辨率
+        self.sun_flare = None
+        if Speed.flare_bank is None:
+            self.sun_flare = A.RandomSunFlare(
+                flare_roi=(0, 0, 1, 1),
+                num_flare_circles_range=tuple(Speed.config["SunFlare"]["num_circles"]),
+                src_radius=Speed.config["SunFlare"]["src_radius"] // Speed.decode_scale,
+                method="overlay",
+                p=Speed.config["SunFlare"]["p"]
+            )
         
     
     def __len__(self):
@@ -356,44 +472,36 @@ class Speed(Dataset):
     def __getitem__(self, index) -> tuple:
         filename = self.sample_index[index].strip()                  # 图片文件名
         # filename = "img000001.jpg"
-        if Speed.config["ram"]:
-            image = Speed.img_dict[filename]
-            bbox = self.labels[filename]["bbox"]
-        else:
-            image = cv.imread(str(self.image_dir / filename), cv.IMREAD_GRAYSCALE)       # 读取图片
-            bbox = self.labels[filename]["bbox"]
-            if bbox[2] >= 1920:
-                bbox[2] = 1919
-            if bbox[3] >= 1200:
-                bbox[3] = 1199
-            
+        timer = Speed.stage_timer
+        with timer.stage("decode", self.split):
+            if Speed.img_store is not None:
+                image = Speed.img_store.get(filename)
+            else:
+                image = cv.imread(str(self.image_dir / filename), Speed.imread_flag)       # 读取图片
+        pos, ori, bbox = Speed.labels.get(filename)     # 位置、归一化的姿态、限制在原图内的bbox
+        # bbox缩放到解码分辨率
+        bbox = bbox / Speed.decode_scale
+        if Speed.decode_scale > 1:
+            bbox[2] = min(bbox[2], image.shape[1] - 1)
+            bbox[3] = min(bbox[3], image.shape[0] - 1)
+        bbox = bbox.tolist()
         
-        ori = np.array(self.labels[filename]["ori"]) / np.linalg.norm(self.labels[filename]["ori"])   # 姿态
-        pos = np.array(self.labels[filename]["pos"])   # 位置
         
+        # 自监督: 一次解码与空间变换生成多个视图
+        if "self_supervised" in self.mode:
+            return self.multi_view(image, bbox)
         
         # 先进行Albumentation增强
-        if "self_supervised" in self.mode:
-            # 空间变换
-            transformed = self.A_transform[0](image=image, bboxes=[bbox], category_ids=[1])
-            image = transformed["image"]
-            bbox = list(map(int, list(transformed["bboxes"][0])))
-            # 像素变换
-            transformed_1 = self.A_transform[1](image=image, bboxes=[bbox], category_ids=[1])
-            image_1 = transformed_1["image"]
-            bbox_1 = list(map(int, list(transformed_1["bboxes"][0])))
-            image_1 = CropAndPad(image_1, bbox_1)
-            image_1 = DropBlockSafe(image_1, bbox=bbox_1, drop_num_lim=Speed.config["DropBlockSafe"]["drop_num"])
-            transformed_2 = self.A_transform[1](image=image, bboxes=[bbox], category_ids=[1])
-            image_2 = transformed_2["image"]
-            bbox_2 = list(map(int, list(transformed_2["bboxes"][0])))
-            image_2 = CropAndPad(image_2, bbox_2)
-            image_2 = DropBlockSafe(image_2, bbox=bbox_2, drop_num_lim=Speed.config["DropBlockSafe"]["drop_num"])
-        else:
-            if self.A_transform is not None:
-                transformed = self.A_transform(image=image, bboxes=[bbox], category_ids=[1])
-                image = transformed["image"]
-                bbox = list(map(int, list(transformed["bboxes"][0])))
+        # batch_photometric开启时像素级增强在collate之后对整个批次进行, worker中跳过
+        photometric = not Speed.config["batch_photometric"]
+        if self.A_transform is not None:
+            with timer.stage("albumentations", self.split):
+                if photometric:
+                    transformed = self.A_transform(image=image, bboxes=[bbox], category_ids=[1])
+                    image = transformed["image"]
+                    bbox = list(map(int, list(transformed["bboxes"][0])))
+                else:
+                    bbox = list(map(int, bbox))
                 dice = np.random.rand()
                 if dice < Speed.config["CropAndPad"]["p"]:
                     image = CropAndPad(image, bbox)
@@ -401,76 +509,9 @@ class Speed(Dataset):
                 if dice < Speed.config["DropBlockSafe"]["p"]:
                     image = DropBlockSafe(image, bbox, Speed.config["DropBlockSafe"]["drop_num"])
         
-        image = self.sun_flare(image=image)["image"]
-        
-        # Resize到设定大小
-        if Speed.config["resize_first"]:
-            transformed = self.Resize(image=image, bboxes=[bbox], category_ids=[1])
-            image = transformed["image"]
-            bbox = list(map(int, list(transformed["bboxes"][0])))
-        
-        # 进行resize数据增强
-        dice = np.random.rand()
-        if "train" in self.mode or "self_supervised" in self.mode:
-            warpped = False
-            if dice < Speed.config["Resize"]["p"]:
-                warpped_time = 0
-                while True:
-                    if warpped_time > 5:
-                        warpped = False
-                        break
-                    warpped_time += 1
-                    image_warpped, pos_warpped, ori_warpped, M_warpped = resize(image, pos, ori, Speed.camera, Speed.config["Resize"]["ratio"])
-                    bbox_warpped = warp_boxes(np.array([bbox]), M_warpped, height=image.shape[0], width=image.shape[1]).tolist()[0]
-                    if 10 < np.linalg.norm(pos_warpped) < 40:
-                        warpped = True
-                        break
-            if warpped:
-                image = image_warpped
-                pos = pos_warpped
-                ori = ori_warpped
-                bbox = list(map(int, bbox_warpped))
-        
-        # 进行warpping
-        dice = np.random.rand()
-        if ("train" in self.mode or "self_supervised" in self.mode) and (Speed.config["Rotate"]["Rotate_img"] or Speed.config["Rotate"]["Rotate_cam"]):
-            warpped_time = 0
-            bbox_area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
-            warpped = False
-            if Speed.config["Rotate"]["Rotate_img"] and dice <= Speed.config["Rotate"]["p"]:
-                while True:
-                    if warpped_time > 5:
-                        warpped = False
-                        break
-                    warpped_time += 1
-                    image_warpped, pos_warpped, ori_warpped, M_warpped = rotate_image(image, pos, ori, Speed.camera.SK, Speed.camera.SK_inv, Speed.config["Rotate"]["img_angle"])
-                    bbox_warpped = warp_boxes(np.array([bbox]), M_warpped, height=image.shape[0], width=image.shape[1]).tolist()[0]
-                    if bbox_in_image(bbox_warpped, bbox_area):
-                        warpped = True
-                        break
-            elif Speed.config["Rotate"]["Rotate_cam"] and dice > Speed.config["Rotate"]["p"]:
-                while True:
-                    if warpped_time > 5:
-                        warpped = False
-                        break
-                    warpped_time += 1
-                    image_warpped, pos_warpped, ori_warpped, M_warpped = rotate_cam(image, pos, ori, Speed.camera.SK, Speed.camera.SK_inv, Speed.config["Rotate"]["cam_angle"])
-                    bbox_warpped = warp_boxes(np.array([bbox]), M_warpped, height=image.shape[0], width=image.shape[1]).tolist()[0]
-                    if bbox_in_image(bbox_warpped, bbox_area):
-                        warpped = True
-                        break
-            
-            if warpped:
-                image = image_warpped
-                pos = pos_warpped
-                ori = ori_warpped
-                bbox = list(map(int, bbox_warpped))
-        
-        
-        if "self_supervised" in self.mode:
-            image_1 = self.transform(image_1)       # (1, 480, 768)
-            image_2 = self.transform(image_2)       # (1, 480, 768)
-            return image_1, image_2
+        if photometric:
+            with timer.stage("flare", self.split):
+                image = self.flare(image, index)
         
         # if "train" in self.mode:
         #     if random.random() < 0.5:
@@ -483,29 +524,157 @@ class Speed(Dataset):
         #     image = cv.cvtColor(image, cv.COLOR_GRAY2BGR)
         #     image = add_sun_flare(image, bbox)
         #     image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
-            
         
-        # 使用torchvision转换图片
-        if not Speed.config["resize_first"]:
-            transformed = self.Resize(image=image, bboxes=[bbox], category_ids=[1])
-            image = transformed["image"]
-            bbox = list(map(int, list(transformed["bboxes"][0])))
+        # 几何变换, 只对图片做一次warp
+        with timer.stage("warp", self.split):
+            image, pos, ori, bbox = self.warp(image, pos, ori, bbox)
         
-        image = self.transform(image)       # (3, 480, 768)
-        yaw_encode, pitch_encode, roll_encode = Speed.ori_encoder_decoder.encode_ori(ori)
+        # 欧拉角编码在训练/验证step中由ori批量计算
+        if Speed.config["transport"] == "uint8":
+            # uint8图片与打包的float32标签, 由speed_collate组成批次, 归一化在模型内完成
+            with timer.stage("encode", self.split):
+                label = pack_label(pos, ori, bbox)
+            with timer.stage("to_tensor", self.split):
+                image = np.ascontiguousarray(image)[None]
+            return image, {"filename": filename, "label": label}
         
-        y: dict = {
-            "filename": filename,
-            "pos": pos,
-            "ori": ori,
-            "yaw_encode": yaw_encode,
-            "pitch_encode": pitch_encode,
-            "roll_encode": roll_encode,
-            "bbox": bbox
-        }
+        with timer.stage("to_tensor", self.split):
+            image = self.transform(image)       # (3, 480, 768)
+        
+        with timer.stage("encode", self.split):
+            y: dict = {
+                "filename": filename,
+                "pos": pos.astype(np.float32),
+                "ori": ori.astype(np.float32),
+                "bbox": bbox
+            }
 
         return image, y
 
+    def multi_view(self, image: np.ndarray, bbox: List[float]):
+        # 解码与空间变换只做一次, 得到imgsz大小的基础图片,
+        # 再生成self_supervised_views个像素变换视图写入预分配的[K, 1, H, W]缓冲区, 裁剪与丢弃块在缓冲区上原地进行
+        timer = Speed.stage_timer
+        with timer.stage("warp", self.split):
+            # 平移/旋转可能把贴边的目标移出图片, bbox被Albumentations丢弃时重新采样, 多次失败则不做空间变换
+            for _ in range(6):
+                transformed = self.A_transform[0](image=image, bboxes=[bbox], category_ids=[1])
+                if len(transformed["bboxes"]) > 0:
+                    break
+            else:
+                transformed = {"image": image, "bboxes": [bbox]}
+            base = transformed["image"]
+            height, width = Speed.config["imgsz"]
+            scale_x, scale_y = width / base.shape[1], height / base.shape[0]
+            x_min, y_min, x_max, y_max = transformed["bboxes"][0]
+            bbox = [int(x_min * scale_x), int(y_min * scale_y), min(int(x_max * scale_x), width - 1), min(int(y_max * scale_y), height - 1)]
+            if base.shape[:2] != (height, width):
+                base = cv.resize(base, (width, height), interpolation=cv.INTER_LINEAR)
+        views = np.empty((Speed.config["self_supervised_views"], 1, height, width), dtype=np.uint8)
+        # 像素变换必须在裁剪与丢弃块之前, 否则模糊/噪声会作用到填充的边缘和丢弃块上, 因此batch_photometric开启时也在worker中进行
+        with timer.stage("albumentations", self.split):
+            for view in views[:, 0]:
+                view[...] = self.A_transform[1](image=base, bboxes=[], category_ids=[])["image"]      # 像素变换不改变bbox
+                CropAndPadInplace(view, bbox)
+                DropBlockSafeInplace(view, bbox, Speed.config["DropBlockSafe"]["drop_num"])
+        if Speed.config["transport"] == "uint8":
+            return views
+        with timer.stage("to_tensor", self.split):
+            return tuple(self.transform(view[0]) for view in views)       # K x (1, 480, 768)
+
+    def flare(self, image: np.ndarray, index: int) -> np.ndarray:
+        # 叠加太阳光晕
+        if self.flare_policy == "disabled":
+            return image
+        if self.sun_flare is not None:
+            return self.sun_flare(image=image)["image"]
+        rng = np.random.RandomState([Speed.config["seed"], index]) if self.flare_policy == "deterministic" else np.random
+        if rng.rand() < Speed.config["SunFlare"]["p"]:
+            image = Speed.flare_bank.apply(image, rng)
+        return image
+
+    def warp(self, image: np.ndarray, pos: np.ndarray, ori: np.ndarray, bbox: List[float]):
+        # 将缩放增强、旋转增强与resize到imgsz组合成一个单应矩阵, 只对图片warp一次
+        # 增强在Camera的frame坐标系中进行, 位姿与bbox的更新和逐步warp时完全相同
+        height, width = image.shape[:2]
+        camera = Speed.camera
+        frame_size = (camera.frame_width, camera.frame_height)
+        M_in = scale_matrix(camera.frame_width / width, camera.frame_height / height)        # 解码图片 -> frame
+        M_out = scale_matrix(Speed.config["imgsz"][1] / camera.frame_width, Speed.config["imgsz"][0] / camera.frame_height)     # frame -> imgsz
+        M = np.eye(3)
+        bbox = warp_boxes(np.array([bbox]), M_in, *frame_size).tolist()[0]
+        
+        # 进行resize数据增强
+        resized = False
+        dice = np.random.rand()
+        if self.geometric_augment and dice < Speed.config["Resize"]["p"]:
+            warpped = self.sample_warp("resize",
+                                       lambda: resize_pose(pos, ori, camera, Speed.config["Resize"]["ratio"]),
+                                       lambda pos_warpped, bbox_warpped: 10 < np.linalg.norm(pos_warpped) < 40,
+                                       bbox)
+            if warpped is not None:
+                pos, ori, M_warpped, bbox = warpped
+                M = M_warpped @ M
+                resized = True
+        
+        # 进行warpping
+        quantized = False       # 是否只做了量化角度的图像旋转
+        dice = np.random.rand()
+        if self.geometric_augment and (Speed.config["Rotate"]["Rotate_img"] or Speed.config["Rotate"]["Rotate_cam"]):
+            bbox_area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+            warpped = None
+            if Speed.config["Rotate"]["Rotate_img"] and dice <= Speed.config["Rotate"]["p"]:
+                warpped = self.sample_warp("rotate_img",
+                                           lambda: rotate_image_pose(pos, ori, camera.SK, camera.SK_inv, Speed.config["Rotate"]["img_angle"], self.rotate_angle()),
+                                           lambda pos_warpped, bbox_warpped: bbox_in_image(bbox_warpped, bbox_area),
+                                           bbox)
+                quantized = warpped is not None and self.remap_cache is not None and not resized
+            elif Speed.config["Rotate"]["Rotate_cam"] and dice > Speed.config["Rotate"]["p"]:
+                warpped = self.sample_warp("rotate_cam",
+                                           lambda: rotate_cam_pose(pos, ori, camera.SK, camera.SK_inv, Speed.config["Rotate"]["cam_angle"]),
+                                           lambda pos_warpped, bbox_warpped: bbox_in_image(bbox_warpped, bbox_area),
+                                           bbox)
+            if warpped is not None:
+                pos, ori, M_warpped, bbox = warpped
+                M = M_warpped @ M
+        
+        # 一次warp直接输出imgsz大小的图片
+        # 只有量化角度的图像旋转时warp矩阵会重复出现, 使用缓存的remap表; 相机旋转与缩放的矩阵是连续的, 缓存不会命中
+        dsize = (Speed.config["imgsz"][1], Speed.config["imgsz"][0])
+        if quantized:
+            image = self.remap_cache.warp(image, M_out @ M @ M_in, dsize)
+        else:
+            image = cv.warpPerspective(image, M_out @ M @ M_in, dsize, flags=cv.INTER_LINEAR)
+        bbox = warp_boxes(np.array([bbox]), M_out, width=Speed.config["imgsz"][1], height=Speed.config["imgsz"][0]).tolist()[0]
+        bbox = list(map(int, bbox))
+        return image, pos, ori, bbox
+
+    @property
+    def geometric_augment(self) -> bool:
+        # batch_warp开启时worker只做resize, 几何增强在collate之后对整个批次进行
+        return "train" in self.mode and not Speed.config["batch_warp"]
+
+    def rotate_angle(self):
+        # 开启量化时, 图像旋转角度量化到Rotate.quantize的整数倍, 位姿使用量化后的精确角度
+        if self.remap_cache is None:
+            return None
+        quantize = Speed.config["Rotate"]["quantize"]
+        angle = np.random.uniform(-Speed.config["Rotate"]["img_angle"], Speed.config["Rotate"]["img_angle"])
+        return np.round(angle / quantize) * quantize
+
+    def sample_warp(self, name: str, draw, accept, bbox: List[float], max_tries: int = 6):
+        # 拒绝采样: 候选矩阵只在bbox角点与位姿上验证, 被拒绝的候选不会触碰像素
+        # draw() -> (pos, ori, warp_matrix), accept(pos, bbox) -> bool
+        frame_size = (Speed.camera.frame_width, Speed.camera.frame_height)
+        for tries in range(1, max_tries + 1):
+            pos_warpped, ori_warpped, M_warpped = draw()
+            bbox_warpped = warp_boxes(np.array([bbox]), M_warpped, *frame_size).tolist()[0]
+            if accept(pos_warpped, bbox_warpped):
+                Speed.aug_stats.update(name, tries, True)
+                return pos_warpped, ori_warpped, M_warpped, bbox_warpped
+        Speed.aug_stats.update(name, max_tries, False)
+        return None
+
     @staticmethod
     def divide_data(lst: list, n: int):
         # 将列表lst分为n份，最后不足一份单独一组
@@ -514,24 +683,69 @@ class Speed(Dataset):
     
     @staticmethod
     def read_img(thread_num: int = 12):
-        # 将采样列表中的图片读入内存
+        # 将采样列表中的图片读入图片缓存
+        # ram为memmap时转换为磁盘上的uint8数据文件, 已转换过则直接映射
+        # ram为jpeg时只缓存未解码的JPEG字节
+        shape = cv.imread(str(Speed.image_dir / Speed.img_name[0]), Speed.imread_flag).shape
+        if Speed.config["ram"] == "jpeg":
+            Speed.img_store = JpegBytesStore(Speed.img_name, Speed.image_dir, Speed.imread_flag)
+        elif Speed.config["ram"] == "memmap":
+            memmap_file = Speed.cache_dir / "train_images.u8"
+            if MemmapImageStore.exists(memmap_file, Speed.img_name, shape):
+                Speed.img_store = MemmapImageStore(memmap_file)
+                print(f"loaded {len(Speed.img_store)} pre-decoded images from {memmap_file}")
+                return
+            Speed.img_store = MemmapImageStore(memmap_file, Speed.img_name, shape, Speed.imread_flag)
+        else:
+            Speed.img_store = SharedImageStore(Speed.img_name, shape, Speed.imread_flag)
         img_divided: list = Speed.divide_data(Speed.img_name, thread_num)
         thread_list: list[ImageReader] = []
         for sub_img_name in img_divided:
-            thread_list.append(ImageReader(sub_img_name, Speed.config, Speed.image_dir))
+            thread_list.append(ImageReader(sub_img_name, Speed.config, Speed.image_dir, Speed.img_store))
         for thread in thread_list:
             thread.start()
         for thread in thread_list:
             thread.join()
-        for thread in thread_list:
-            Speed.img_dict.update(thread.get_result())
+        if Speed.config["ram"] == "memmap":
+            Speed.img_store.finalize()
+            print(f"converted {len(Speed.img_store)} images to {Speed.img_store.path}: {Speed.img_store.nbytes / 1024**3:.2f} GB")
+        elif Speed.config["ram"] == "jpeg":
+            decoded_bytes = len(Speed.img_store) * int(np.prod(shape))
+            print(f"cached {len(Speed.img_store)} jpeg images in shared memory: {Speed.img_store.nbytes / 1024**3:.2f} GB "
+                  f"({decoded_bytes / Speed.img_store.nbytes:.1f}x smaller than decoded), "
+                  f"decode speed: {Speed.img_store.decode_speed():.1f} images/s")
+        else:
+            print(f"cached {len(Speed.img_store)} images in shared memory: {Speed.img_store.nbytes / 1024**3:.2f} GB")
 
 
 class SpeedDataModule(L.LightningDataModule):
     def __init__(self, config: dict):
         super().__init__()
         self.config: dict = config
+        # 自监督的一致性损失比较视图两两之间的预测, speed_collate也按至少两个视图组成批次
+        if config["self_supervised"] and config["self_supervised_views"] < 2:
+            raise ValueError(f"self_supervised_views must be >= 2, got {config['self_supervised_views']}")
         prepare_Speed(config)
+        # 批次级几何增强, 需要uint8传输的打包标签
+        if config["batch_warp"] and config["transport"] != "uint8":
+            raise ValueError("batch_warp requires transport: uint8")
+        self.batch_warp = BatchGeometricAugment(config, Speed.aug_stats) if config["batch_warp"] else None
+        # worker中各阶段的耗时, Profile.enable时由StepProfiler在每个epoch结束时记录
+        self.stage_timer: StageTimer = Speed.stage_timer
+        # 批次级像素增强, 概率与worker中的Albumentations链相同
+        if config["batch_photometric"] and config["transport"] != "uint8":
+            raise ValueError("batch_photometric requires transport: uint8")
+        # 锁页内存只对GPU训练有用, CPU训练时pin_cores由configure_cpu给出每个worker绑定的核
+        self.pin_memory: bool = config["accelerator"] == "gpu"
+        self.worker_init_fn = partial(pin_worker, cores=config["worker_cores"]) if config["worker_cores"] else None
+        self.batch_photometric = None
+        if config["batch_photometric"]:
+            flare_p = config["SunFlare"]["p"]
+            # 自监督的视图在worker中先做像素增强再裁剪与丢弃块, 不使用批次级像素增强
+            self.batch_photometric = {
+                "train": BatchPhotometricAugment(config, p=config["Augmentation"]["p"], flare_p=flare_p, bank=Speed.flare_bank),
+                "val": BatchPhotometricAugment(config, p=0.0, flare_p=0.0 if config["SunFlare"]["val"] == "disabled" else flare_p, bank=Speed.flare_bank),
+            }
 
     def setup(self, stage: str) -> None:
         if stage == "fit":
@@ -544,6 +758,33 @@ class SpeedDataModule(L.LightningDataModule):
         elif stage == "validate":
             self.speed_data_val: Speed = Speed("val")
     
+    def augmentation_stats(self, reset: bool = True) -> dict:
+        # 汇总所有worker的几何增强接受率, 用于调节img_angle/cam_angle
+        stats = Speed.aug_stats.summary()
+        if reset:
+            Speed.aug_stats.reset()
+        return stats
+    
+    def on_after_batch_transfer(self, batch, dataloader_idx: int):
+        # uint8传输时在设备上把打包的标签拆成pos/ori/bbox, 再依次做批次级的像素增强与几何增强
+        if self.config["transport"] != "uint8":
+            return batch
+        training = self.trainer is not None and self.trainer.training
+        if self.config["self_supervised"]:
+            # [B, K, 1, H, W]拆成K个视图
+            return batch.unbind(1)
+        images, labels = batch
+        labels = unpack_label(labels)
+        if self.batch_photometric is not None:
+            generator = None
+            if not training and self.config["SunFlare"]["val"] == "deterministic":
+                # 验证集顺序固定, 用批次内的文件名作为种子, 每个epoch的光晕相同
+                generator = torch.Generator().manual_seed(zlib.crc32("".join(labels["filename"]).encode()))
+            images = self.batch_photometric["train" if training else "val"](images, generator)
+        if self.batch_warp is not None and training:
+            images, labels = self.batch_warp(images, labels)
+        return images, labels
+    
     def train_dataloader(self) -> MultiEpochsDataLoader:
         loader = DataLoader(
             self.speed_data_train,
@@ -551,8 +792,9 @@ class SpeedDataModule(L.LightningDataModule):
             shuffle=True,
             num_workers=self.config["workers"],
             persistent_workers=True,
-            pin_memory=True,
-            pin_memory_device='cuda',
+            pin_memory=self.pin_memory,
+            worker_init_fn=self.worker_init_fn,
+            collate_fn=speed_collate if self.config["transport"] == "uint8" else None,
         )
         return loader
     
@@ -563,8 +805,9 @@ class SpeedDataModule(L.LightningDataModule):
             shuffle=False,
             num_workers=self.config["workers"],
             persistent_workers=True,
-            pin_memory=True,
-            pin_memory_device='cuda',
+            pin_memory=self.pin_memory,
+            worker_init_fn=self.worker_init_fn,
+            collate_fn=speed_collate if self.config["transport"] == "uint8" else None,
         )
         return loader
 
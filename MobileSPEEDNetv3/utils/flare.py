@@ -0,0 +1,95 @@
+"""
+Sun flare bank
+
+"""
+
+import cv2 as cv
+import numpy as np
+
+from .utils import Camera
+
+
+def flare_transmission(src_radius: int, table_size: int = 1024) -> np.ndarray:
+    # RandomSunFlare(method="overlay")的光源由src_radius // 10个同心圆逐层混合而成, 第i层半径rad_i、混合系数alpha_i
+    # 距离中心d处的透过率为 prod_{rad_i >= d}(1 - alpha_i), 只与d / src_radius有关, 预先做成查找表
+    num_times = src_radius // 10
+    rad = np.linspace(1, src_radius, num_times) / src_radius
+    alpha = np.linspace(0, 1, num_times)[::-1] ** 3
+    u = np.linspace(0, 1, table_size)
+    return np.where(rad[None] >= u[:, None], 1 - alpha[None], 1).prod(axis=1).astype(np.float32)
+
+
+class SunFlareBank:
+    """预先生成的太阳光晕库, 替代逐张图片渲染RandomSunFlare
+
+    RandomSunFlare(method="overlay")对每个像素都是仿射的: out = img * (1 - a) + c,
+    因此每个光晕只需保存覆盖率a与叠加亮度c两张uint8图, 光斑的累积混合与光源的逐层混合都在生成时算好。
+    画布为原图(Camera.width x Camera.height)的两倍大小、按scale降低分辨率保存, 光源位于画布中心,
+    使用时随机截取原图大小的窗口并放大到目标分辨率, 相当于光源位置在图片内均匀分布。
+    每次运行只生成一次, DataLoader的worker fork后共享同一份内存。
+    """
+
+    table_size: int = 1024      # 光源透过率查找表的长度
+
+    def __init__(self, config: dict):
+        flare = config["SunFlare"]
+        self.scale: float = flare["bank_scale"]           # 原图像素 -> 光晕库像素
+        self.intensity = flare["intensity"]               # 叠加强度范围
+        self.height: int = max(1, round(Camera.height * self.scale))
+        self.width: int = max(1, round(Camera.width * self.scale))
+        self.transmission: np.ndarray = flare_transmission(flare["src_radius"], self.table_size)
+        self.coverage = np.empty((flare["bank_size"], 2 * self.height, 2 * self.width), dtype=np.uint8)
+        self.color = np.empty_like(self.coverage)
+        rng = np.random.default_rng(config["seed"])
+        for i in range(flare["bank_size"]):
+            self.coverage[i], self.color[i] = self.render(rng, flare["src_radius"] * self.scale, flare["num_circles"])
+
+    def __len__(self):
+        return len(self.coverage)
+
+    @property
+    def nbytes(self) -> int:
+        return self.coverage.nbytes + self.color.nbytes
+
+    def render(self, rng: np.random.Generator, src_radius: float, num_circles) -> tuple:
+        # 在画布上按RandomSunFlare的参数分布渲染一个光晕, 返回uint8的(a, c)
+        # 光斑: overlay上依次画圆, 每画一个就把overlay按alpha混合进output, 因此overlay上的旧光斑会被重复混合
+        # 用 (1 - a, c) 表示 output = img * (1 - a) + c, (painted, overlay_color) 表示overlay
+        H, W = self.coverage.shape[1:]
+        cx, cy = self.width, self.height
+        angle = 2 * np.pi * rng.random()
+        a = np.zeros((H, W), dtype=np.float32)
+        c = np.zeros((H, W), dtype=np.float32)
+        painted = np.zeros((H, W), dtype=np.uint8)
+        overlay_color = np.zeros((H, W), dtype=np.float32)
+        max_radius = max(2, int(Camera.height * 0.01))
+        for _ in range(rng.integers(num_circles[0], num_circles[1] + 1)):
+            alpha = rng.uniform(0.05, 0.2)
+            # 光斑在过光源的直线上, 原图中沿x方向的位置均匀分布在图片内
+            t = rng.uniform(-1, 0) * self.width + rng.random() * self.width
+            center = (int(cx + t * np.cos(angle)), int(cy + t * np.sin(angle)))
+            radius = int(rng.integers(1, max_radius + 1) ** 3 * self.scale)
+            mask = cv.circle(np.zeros((H, W), dtype=np.uint8), center, radius, 1, -1).astype(bool)
+            painted |= mask
+            overlay_color[mask] = rng.integers(204, 256) / 255
+            a += alpha * (painted - a)
+            c += alpha * (overlay_color - c)
+        # 光源: 按到中心的归一化距离查透过率, 白色光源 (1 - T) 叠加在output上
+        ys, xs = np.ogrid[:H, :W]
+        distance = np.sqrt((xs - cx) ** 2 + (ys - cy) ** 2, dtype=np.float32)
+        index = np.minimum(distance / src_radius * (self.table_size - 1), self.table_size - 1).astype(np.int64)
+        T = self.transmission[index]
+        a = 1 - (1 - a) * T
+        c = c * T + (1 - T)
+        return np.rint(a * 255).astype(np.uint8), np.rint(c * 255).astype(np.uint8)
+
+    def apply(self, image: np.ndarray, rng=np.random) -> np.ndarray:
+        # 随机选取一个光晕、窗口位置与强度叠加到uint8图片上, rng为np.random或RandomState
+        i = rng.randint(len(self))
+        x, y = rng.randint(0, self.width + 1), rng.randint(0, self.height + 1)
+        k = rng.uniform(*self.intensity)
+        size = image.shape[1], image.shape[0]
+        # 先在光晕库分辨率上乘以强度, 再放大到图片大小
+        a = cv.resize(cv.convertScaleAbs(self.coverage[i, y:y + self.height, x:x + self.width], alpha=k), size, interpolation=cv.INTER_LINEAR)
+        c = cv.resize(cv.convertScaleAbs(self.color[i, y:y + self.height, x:x + self.width], alpha=k), size, interpolation=cv.INTER_LINEAR)
+        return cv.add(cv.subtract(image, cv.multiply(image, a, scale=1 / 255)), c)
@@ -0,0 +1,229 @@
+"""
+Step-level performance instrumentation
+
+"""
+
+import os
+import json
+import time
+import ctypes
+import numpy as np
+import torch
+
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from multiprocessing.sharedctypes import RawArray
+from typing import List
+
+from torch.utils.data import get_worker_info
+from lightning.pytorch.callbacks import Callback
+from lightning.pytorch.utilities import rank_zero_warn
+
+
+class StageTimer:
+    """统计dataloader worker中__getitem__各阶段的耗时
+
+    与AugmentationStats相同, 数据放在fork前创建的共享内存中, 每个worker只写自己的槽位, 无需加锁,
+    训练集与验证集的worker使用不同的槽位段, 验证不影响训练集的统计。
+    totals记录每个阶段的 [次数, 总耗时(s)];
+    events为每个槽位最近capacity个阶段的环形缓冲区 [阶段, 开始时间, 耗时], 用于trace。
+    时间为time.perf_counter(), Linux上各进程共用同一个单调时钟, 可以与主进程的时间戳对齐。
+    enable为False时stage()不计时。
+    """
+    names: List[str] = ["decode", "albumentations", "flare", "warp", "encode", "to_tensor"]
+    splits: List[str] = ["train", "val"]
+
+    def __init__(self, workers: int, capacity: int = 0, enable: bool = True):
+        self.enable: bool = enable
+        self.capacity: int = capacity if enable else 0
+        # 每个split各有 主进程 + workers 个槽位
+        self.split_slots: int = workers + 1
+        slots = len(self.splits) * self.split_slots
+        self.totals = np.frombuffer(RawArray(ctypes.c_double, slots * len(self.names) * 2), dtype=np.float64)
+        self.totals = self.totals.reshape(slots, len(self.names), 2)
+        self.events = np.frombuffer(RawArray(ctypes.c_double, slots * max(self.capacity, 1) * 3), dtype=np.float64)
+        self.events = self.events.reshape(slots, max(self.capacity, 1), 3)
+        self.cursor = np.frombuffer(RawArray(ctypes.c_int64, slots), dtype=np.int64)
+
+    def slot(self, split: str = "train") -> int:
+        # split内主进程为第0个槽位, worker i为第i+1个
+        worker_info = get_worker_info()
+        index = 0 if worker_info is None else (worker_info.id + 1) % self.split_slots
+        return self.splits.index(split) * self.split_slots + index
+
+    def slot_name(self, slot: int) -> str:
+        split, index = divmod(slot, self.split_slots)
+        return f"{self.splits[split]} " + ("main" if index == 0 else f"worker {index - 1}")
+
+    def stage(self, name: str, split: str = "train"):
+        # with timer.stage("decode", "train"): ...
+        return self._record(name, split) if self.enable else nullcontext()
+
+    @contextmanager
+    def _record(self, name: str, split: str):
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        slot, stage = self.slot(split), self.names.index(name)
+        self.totals[slot, stage] += [1, elapsed]
+        if self.capacity > 0:
+            self.events[slot, self.cursor[slot] % self.capacity] = [stage, start, elapsed]
+            self.cursor[slot] += 1
+
+    def summary(self, split: str = "train") -> dict:
+        # split中每个阶段每次的平均耗时(ms)与占worker总耗时的比例
+        start = self.splits.index(split) * self.split_slots
+        counts, seconds = self.totals[start:start + self.split_slots].sum(axis=0).T
+        total = seconds.sum()
+        stats = {}
+        for name, count, second in zip(self.names, counts, seconds):
+            if count == 0:
+                continue
+            stats[f"{name}_ms"] = float(second / count * 1000)
+            stats[f"{name}_share"] = float(second / total)
+        return stats
+
+    def recent_events(self) -> list:
+        # 各槽位环形缓冲区中的阶段 (槽位, 阶段名, 开始时间, 耗时), 按开始时间排序
+        events = []
+        for slot in range(self.events.shape[0]):
+            num = min(int(self.cursor[slot]), self.capacity)
+            for stage, start, elapsed in self.events[slot, :num]:
+                events.append((slot, self.names[int(stage)], float(start), float(elapsed)))
+        return sorted(events, key=lambda event: event[2])
+
+    def reset(self):
+        self.totals[:] = 0
+
+
+class StepProfiler(Callback):
+    """训练step的耗时分解: 等待数据 / 前向 / 损失 / 反向 / 优化器
+
+    data_wait为上一个step结束到本step开始的时间, 包括取batch、拷贝到设备与on_after_batch_transfer中的批次级增强;
+    forward到模型前向结束, loss到loss.backward()之前, optimizer包括梯度裁剪、step与zero_grad。
+    每个epoch结束时记录各阶段的平均耗时与datamodule.stage_timer中训练集worker各阶段的耗时(profile/*),
+    等待数据占step时间的比例超过starvation时给出警告;
+    训练结束时把最近trace_steps个step与worker的阶段写成Chrome trace JSON, 用chrome://tracing或ui.perfetto.dev打开。
+    sync为True时GPU训练在阶段边界同步CUDA, 计时准确但会降低吞吐量, 只在分析时开启。
+    """
+    phases: List[str] = ["data_wait", "forward", "loss", "backward", "optimizer"]
+
+    def __init__(self, dirpath: str = None, trace_steps: int = 200, starvation: float = 0.2, sync: bool = True):
+        super().__init__()
+        self.dirpath: str = dirpath
+        self.starvation: float = starvation
+        self.sync: bool = sync
+        # 最近trace_steps个step的 (global_step, [上一个step结束, 开始, 前向结束, 反向开始, 反向结束, 结束])
+        self.steps: deque = deque(maxlen=trace_steps)
+        self.bounds: list = None
+        self.last_end: float = 0.0
+        self.start_time: float = 0.0
+        self.epoch_times = np.zeros(len(self.phases))
+        self.epoch_steps: int = 0
+        self.stage_timer: StageTimer = None
+        self.handle = None
+        self.trace_path: str = None
+
+    def now(self, pl_module) -> float:
+        if self.sync and pl_module.device.type == "cuda":
+            torch.cuda.synchronize(pl_module.device)
+        return time.perf_counter()
+
+    def on_fit_start(self, trainer, pl_module):
+        self.stage_timer = getattr(trainer.datamodule, "stage_timer", None)
+        self.start_time = time.perf_counter()
+        self.handle = pl_module.register_forward_hook(self.on_forward_end)
+
+    def on_fit_end(self, trainer, pl_module):
+        if self.handle is not None:
+            self.handle.remove()
+            self.handle = None
+
+    def on_forward_end(self, module, inputs, outputs):
+        # 自监督时所有视图只前向一次; 验证时self.bounds为None
+        if self.bounds is not None and len(self.bounds) == 2:
+            self.bounds.append(self.now(module))
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.last_end = self.now(pl_module)
+        self.epoch_times[:] = 0
+        self.epoch_steps = 0
+        if self.stage_timer is not None:
+            self.stage_timer.reset()
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        self.bounds = [self.last_end, self.now(pl_module)]
+
+    def on_before_backward(self, trainer, pl_module, loss):
+        if self.bounds is not None and len(self.bounds) == 3:
+            self.bounds.append(self.now(pl_module))
+
+    def on_after_backward(self, trainer, pl_module):
+        if self.bounds is not None and len(self.bounds) == 4:
+            self.bounds.append(self.now(pl_module))
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self.last_end = self.now(pl_module)
+        bounds, self.bounds = self.bounds, None
+        # 手动优化或跳过反向的step没有完整的阶段
+        if bounds is None or len(bounds) != 5:
+            return
+        bounds.append(self.last_end)
+        self.steps.append((trainer.global_step, bounds))
+        self.epoch_times += np.diff(bounds)
+        self.epoch_steps += 1
+
+    def summary(self) -> dict:
+        # 本轮每个阶段每个step的平均耗时(ms)与等待数据的比例
+        if self.epoch_steps == 0:
+            return {}
+        stats = {f"{phase}_ms": float(t / self.epoch_steps * 1000) for phase, t in zip(self.phases, self.epoch_times)}
+        stats["data_wait_share"] = float(self.epoch_times[0] / self.epoch_times.sum())
+        return stats
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        stats = self.summary()
+        if not stats:
+            return
+        worker_stats = self.stage_timer.summary("train") if self.stage_timer is not None else {}
+        pl_module.log_dict({f"profile/{k}": v for k, v in stats.items()}, on_epoch=True)
+        pl_module.log_dict({f"profile/worker_{k}": v for k, v in worker_stats.items()}, on_epoch=True)
+        if stats["data_wait_share"] > self.starvation:
+            shares = {k[:-len("_share")]: v for k, v in worker_stats.items() if k.endswith("_share")}
+            slowest = f", slowest worker stage: {max(shares, key=shares.get)} ({max(shares.values()):.0%})" if shares else ""
+            rank_zero_warn(f"data starvation in epoch {trainer.current_epoch}: {stats['data_wait_share']:.0%} of the step time "
+                           f"is spent waiting for the dataloader (threshold {self.starvation:.0%}){slowest}. "
+                           f"Consider more workers, ram caching, batch_photometric or batch_warp.")
+
+    def trace_events(self) -> list:
+        # Chrome trace的事件, 时间戳为相对fit开始的微秒; pid 0为训练进程, pid 1为dataloader worker, 训练集与验证集的worker为不同的线程
+        events = [
+            {"name": "process_name", "ph": "M", "pid": 0, "args": {"name": "train"}},
+            {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "dataloader"}},
+        ]
+        for step, bounds in self.steps:
+            for phase, start, end in zip(self.phases, bounds[:-1], bounds[1:]):
+                events.append({"name": phase, "cat": "step", "ph": "X", "pid": 0, "tid": 0,
+                               "ts": (start - self.start_time) * 1e6, "dur": (end - start) * 1e6, "args": {"step": step}})
+        if self.stage_timer is None or not self.steps:
+            return events
+        # 只保留trace中第一个step开始之后的worker阶段
+        first = self.steps[0][1][0]
+        slots = set()
+        for slot, name, start, elapsed in self.stage_timer.recent_events():
+            if start < first:
+                continue
+            slots.add(slot)
+            events.append({"name": name, "cat": "worker", "ph": "X", "pid": 1, "tid": slot,
+                           "ts": (start - self.start_time) * 1e6, "dur": elapsed * 1e6})
+        for slot in sorted(slots):
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": slot,
+                           "args": {"name": self.stage_timer.slot_name(slot)}})
+        return events
+
+    def on_train_end(self, trainer, pl_module):
+        dirpath = self.dirpath or trainer.default_root_dir
+        os.makedirs(dirpath, exist_ok=True)
+        self.trace_path = os.path.join(dirpath, "trace.json")
+        with open(self.trace_path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,121 @@
+"""
+Quaternion utilities
+
+All quaternions are scalar-first [w, x, y, z] (the SPEED label convention) and
+all euler angles are intrinsic 'YXZ' (yaw, pitch, roll), matching
+scipy.spatial.transform.Rotation.from_euler('YXZ', ...).
+Every function is batched over the leading dimensions and accepts either
+numpy arrays or torch tensors, returning the same type.
+
+"""
+
+import numpy as np
+import torch
+
+
+def _xp(x):
+    return torch if isinstance(x, torch.Tensor) else np
+
+
+def _unbind(x):
+    # 沿最后一维拆分
+    return [x[..., i] for i in range(x.shape[-1])]
+
+
+def quat_normalize(q):
+    xp = _xp(q)
+    return q / xp.sqrt((q * q).sum(-1))[..., None]
+
+
+def quat_canonical(q):
+    """Flip the sign so that w > 0, breaking ties on x, y, z in order (as scipy canonical=True)."""
+    xp = _xp(q)
+    w, x, y, z = _unbind(q)
+    flip = (w < 0) | ((w == 0) & ((x < 0) | ((x == 0) & ((y < 0) | ((y == 0) & (z < 0))))))
+    return xp.where(flip[..., None], -q, q)
+
+
+def quat_multiply(q1, q2):
+    """Hamilton product q1 * q2, i.e. the rotation q2 followed by q1."""
+    xp = _xp(q1)
+    w1, x1, y1, z1 = _unbind(q1)
+    w2, x2, y2, z2 = _unbind(q2)
+    return xp.stack([
+        w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+        w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+        w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+        w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2,
+    ], -1)
+
+
+def quat_to_matrix(q):
+    """Unit quaternion [..., 4] -> rotation matrix [..., 3, 3]."""
+    xp = _xp(q)
+    w, x, y, z = _unbind(q)
+    matrix = xp.stack([
+        1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y),
+        2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x),
+        2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y),
+    ], -1)
+    return matrix.reshape(*matrix.shape[:-1], 3, 3)
+
+
+def matrix_to_quat(matrix):
+    """Rotation matrix [..., 3, 3] -> canonical unit quaternion [..., 4] (Shepperd's method)."""
+    xp = _xp(matrix)
+    m00, m01, m02 = matrix[..., 0, 0], matrix[..., 0, 1], matrix[..., 0, 2]
+    m10, m11, m12 = matrix[..., 1, 0], matrix[..., 1, 1], matrix[..., 1, 2]
+    m20, m21, m22 = matrix[..., 2, 0], matrix[..., 2, 1], matrix[..., 2, 2]
+    # 以四个分量中最大者为主元, 避免除以接近0的数
+    candidates = xp.stack([
+        xp.stack([1 + m00 + m11 + m22, m21 - m12, m02 - m20, m10 - m01], -1),
+        xp.stack([m21 - m12, 1 + m00 - m11 - m22, m01 + m10, m02 + m20], -1),
+        xp.stack([m02 - m20, m01 + m10, 1 - m00 + m11 - m22, m12 + m21], -1),
+        xp.stack([m10 - m01, m02 + m20, m12 + m21, 1 - m00 - m11 + m22], -1),
+    ], -2)
+    diagonal = xp.stack([candidates[..., i, i] for i in range(4)], -1)
+    best = diagonal.argmax(-1)
+    if xp is np:
+        q = np.take_along_axis(candidates, best[..., None, None], axis=-2)[..., 0, :]
+    else:
+        q = torch.gather(candidates, -2, best[..., None, None].expand(*best.shape, 1, 4))[..., 0, :]
+    return quat_canonical(quat_normalize(q))
+
+
+def quat_to_euler_yxz(q, degrees: bool = True):
+    """Unit quaternion [..., 4] -> (yaw, pitch, roll) of the intrinsic 'YXZ' sequence.
+
+    In gimbal lock (|pitch| = 90 deg) roll is set to 0, as scipy does.
+    """
+    xp = _xp(q)
+    w, x, y, z = _unbind(q)
+    r02 = 2 * (x * z + w * y)
+    r22 = 1 - 2 * (x * x + y * y)
+    r12 = 2 * (y * z - w * x)
+    r10 = 2 * (x * y + w * z)
+    r11 = 1 - 2 * (x * x + z * z)
+    r00 = 1 - 2 * (y * y + z * z)
+    r20 = 2 * (x * z - w * y)
+    pitch = xp.arcsin(xp.clip(-r12, -1, 1))
+    locked = xp.abs(r12) > 1 - 1e-7
+    yaw = xp.where(locked, xp.arctan2(-r20, r00), xp.arctan2(r02, r22))
+    roll = xp.where(locked, xp.zeros_like(pitch), xp.arctan2(r10, r11))
+    if degrees:
+        yaw, pitch, roll = xp.rad2deg(yaw), xp.rad2deg(pitch), xp.rad2deg(roll)
+    return yaw, pitch, roll
+
+
+def euler_yxz_to_quat(yaw, pitch, roll, degrees: bool = True):
+    """Intrinsic 'YXZ' euler angles -> unit quaternion [..., 4]."""
+    xp = _xp(yaw)
+    if degrees:
+        yaw, pitch, roll = xp.deg2rad(yaw), xp.deg2rad(pitch), xp.deg2rad(roll)
+    cy, sy = xp.cos(yaw * 0.5), xp.sin(yaw * 0.5)
+    cp, sp = xp.cos(pitch * 0.5), xp.sin(pitch * 0.5)
+    cr, sr = xp.cos(roll * 0.5), xp.sin(roll * 0.5)
+    return xp.stack([
+        cy * cp * cr + sy * sp * sr,
+        cy * sp * cr + sy * cp * sr,
+        sy * cp * cr - cy * sp * sr,
+        -sy * sp * cr + cy * cp * sr,
+    ], -1)
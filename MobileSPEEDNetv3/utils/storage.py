@@ -0,0 +1,293 @@
+"""
+Image and label storage backends
+
+"""
+
+import os
+import json
+import time
+import atexit
+import tempfile
+import cv2 as cv
+import numpy as np
+
+from pathlib import Path
+from multiprocessing import shared_memory
+from typing import List, Tuple
+
+
+# 解码缩放倍数 -> OpenCV读取标志
+IMREAD_FLAGS = {
+    1: cv.IMREAD_GRAYSCALE,
+    2: cv.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv.IMREAD_REDUCED_GRAYSCALE_4,
+}
+
+
+class SharedImageStore:
+    """将解码后的灰度图打包进一块连续的POSIX共享内存
+
+    所有图片按采样列表顺序依次存放, index记录 文件名 -> 字节偏移。
+    DataLoader的worker fork后直接映射同一块物理页, 读取时零拷贝,
+    不会因为引用计数写入触发copy-on-write, 常驻内存不随worker数量增长。
+    图片缓存是Speed的类属性, 不随Dataset序列化, 只支持fork方式启动的worker, 其他缓存相同。
+    """
+
+    def __init__(self, img_name: List[str], shape: Tuple[int, int], imread_flag: int = cv.IMREAD_GRAYSCALE):
+        self.imread_flag: int = imread_flag
+        self.shape: Tuple[int, int] = tuple(shape)
+        self.frame_bytes: int = int(np.prod(self.shape))
+        self.index: dict = {name: i * self.frame_bytes for i, name in enumerate(img_name)}
+        self.nbytes: int = max(len(self.index) * self.frame_bytes, 1)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.nbytes)
+        self.owner_pid = os.getpid()
+        atexit.register(self.close)
+        # frombuffer持有共享内存的导出引用, 取出的图片未释放时close不会解除映射
+        self.buffer = np.frombuffer(self.shm.buf, dtype=np.uint8, count=self.nbytes)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, img_name: str):
+        return img_name in self.index
+
+    def load(self, img_name: str, img_path: Path):
+        self.put(img_name, cv.imread(str(img_path), self.imread_flag))
+
+    def put(self, img_name: str, image: np.ndarray):
+        if image.shape != self.shape:
+            raise ValueError(f"image {img_name} has shape {image.shape}, expected {self.shape}")
+        offset = self.index[img_name]
+        self.buffer[offset:offset + self.frame_bytes] = image.reshape(-1)
+
+    def get(self, img_name: str) -> np.ndarray:
+        # 返回共享内存上的只读视图, 调用方不能原地修改
+        offset = self.index[img_name]
+        image = self.buffer[offset:offset + self.frame_bytes].reshape(self.shape)
+        image.flags.writeable = False
+        return image
+
+    def close(self):
+        # 先删除共享内存的名称, 物理内存在所有映射解除后回收;
+        # 仍有取出的图片引用共享内存时保留映射, 进程退出时再次尝试
+        if self.shm is None:
+            return
+        self.buffer = None
+        if self.owner_pid == os.getpid():
+            self.shm.unlink()
+            self.owner_pid = None
+        try:
+            self.shm.close()
+        except BufferError:
+            return
+        atexit.unregister(self.close)
+        self.shm = None
+
+
+class MemmapImageStore:
+    """预解码的uint8图片文件, 通过np.memmap映射读取
+
+    数据文件中所有图片按顺序连续存放, 同名的.json索引记录图片尺寸与文件名顺序。
+    转换写入每个进程唯一的临时文件, 完成后改名为数据文件并写入索引, 因此中断的转换会在下次启动时重新进行,
+    DDP的多个rank同时转换时也不会截断其他rank已映射的文件。
+    读取时不再需要JPEG解码, 缓存交给操作系统的page cache。
+    """
+
+    def __init__(self, path: Path, img_name: List[str] = None, shape: Tuple[int, int] = None, imread_flag: int = cv.IMREAD_GRAYSCALE):
+        self.imread_flag: int = imread_flag
+        self.path: Path = Path(path)
+        self.index_path: Path = self.path.with_suffix(".json")
+        self.tmp_path: Path = None      # 转换中的临时数据文件
+        if img_name is None:
+            # 打开已有的数据文件
+            meta = json.load(open(self.index_path, "r"))
+            img_name, shape, mode = meta["img_name"], meta["shape"], "r"
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self.path.parent, prefix=self.path.name + ".", suffix=".tmp", delete=False) as f:
+                self.tmp_path = Path(f.name)
+            mode = "w+"
+        self.img_name: List[str] = list(img_name)
+        self.shape: Tuple[int, int] = tuple(shape)
+        self.frame_bytes: int = int(np.prod(self.shape))
+        self.index: dict = {name: i * self.frame_bytes for i, name in enumerate(self.img_name)}
+        self.nbytes: int = max(len(self.index) * self.frame_bytes, 1)
+        self.buffer = np.memmap(self.tmp_path or self.path, dtype=np.uint8, mode=mode, shape=(self.nbytes,))
+
+    @staticmethod
+    def exists(path: Path, img_name: List[str], shape: Tuple[int, int]) -> bool:
+        # 数据文件完整、尺寸一致且包含全部图片时才可复用
+        index_path = Path(path).with_suffix(".json")
+        if not Path(path).exists() or not index_path.exists():
+            return False
+        meta = json.load(open(index_path, "r"))
+        return tuple(meta["shape"]) == tuple(shape) and set(img_name) <= set(meta["img_name"])
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, img_name: str):
+        return img_name in self.index
+
+    def load(self, img_name: str, img_path: Path):
+        self.put(img_name, cv.imread(str(img_path), self.imread_flag))
+
+    def put(self, img_name: str, image: np.ndarray):
+        if image.shape != self.shape:
+            raise ValueError(f"image {img_name} has shape {image.shape}, expected {self.shape}")
+        offset = self.index[img_name]
+        self.buffer[offset:offset + self.frame_bytes] = image.reshape(-1)
+
+    def get(self, img_name: str) -> np.ndarray:
+        offset = self.index[img_name]
+        image = self.buffer[offset:offset + self.frame_bytes].reshape(self.shape)
+        image.flags.writeable = False
+        return image
+
+    def finalize(self):
+        # 写完数据后落盘, 先删除旧索引再改名数据文件, 最后改名写入新索引, 读取方不会把新数据与旧索引配对;
+        # 多个rank转换的内容相同, 改名都是原子的, 以任何顺序完成结果都一致。之后以只读方式重新映射
+        self.buffer.flush()
+        del self.buffer
+        with tempfile.NamedTemporaryFile("w", dir=self.path.parent, prefix=self.index_path.name + ".", suffix=".tmp", delete=False) as f:
+            json.dump({"shape": list(self.shape), "img_name": self.img_name}, f)
+        self.index_path.unlink(missing_ok=True)
+        os.replace(self.tmp_path, self.path)
+        os.replace(f.name, self.index_path)
+        self.tmp_path = None
+        self.buffer = np.memmap(self.path, dtype=np.uint8, mode="r", shape=(self.nbytes,))
+
+    def close(self):
+        # 解除映射, 数据文件保留供下次使用; 未完成的转换删除临时文件
+        self.buffer = None
+        if self.tmp_path is not None:
+            self.tmp_path.unlink(missing_ok=True)
+            self.tmp_path = None
+
+
+class JpegBytesStore:
+    """在一块POSIX共享内存中保存未解码的JPEG字节
+
+    内存占用约为解码缓存的1/10, worker读取时用cv.imdecode即时解码,
+    完全绕开文件系统(尤其是NFS)的延迟。index记录 文件名 -> (字节偏移, 长度)。
+    """
+
+    def __init__(self, img_name: List[str], image_dir: Path, imread_flag: int = cv.IMREAD_GRAYSCALE):
+        self.imread_flag: int = imread_flag
+        self.index: dict = {}
+        offset = 0
+        for name in img_name:
+            length = os.path.getsize(Path(image_dir) / name)
+            self.index[name] = (offset, length)
+            offset += length
+        self.nbytes: int = max(offset, 1)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.nbytes)
+        self.owner_pid = os.getpid()
+        atexit.register(self.close)
+        # frombuffer持有共享内存的导出引用, 取出的图片未释放时close不会解除映射
+        self.buffer = np.frombuffer(self.shm.buf, dtype=np.uint8, count=self.nbytes)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, img_name: str):
+        return img_name in self.index
+
+    def load(self, img_name: str, img_path: Path):
+        offset, length = self.index[img_name]
+        with open(img_path, "rb") as f:
+            f.readinto(self.shm.buf[offset:offset + length])
+
+    def get(self, img_name: str) -> np.ndarray:
+        offset, length = self.index[img_name]
+        return cv.imdecode(self.buffer[offset:offset + length], self.imread_flag)
+
+    def decode_speed(self, num: int = 32) -> float:
+        # 统计解码吞吐量 images/s
+        img_name = list(self.index.keys())[:num]
+        start = time.perf_counter()
+        for name in img_name:
+            self.get(name)
+        return len(img_name) / max(time.perf_counter() - start, 1e-9)
+
+    def close(self):
+        # 先删除共享内存的名称, 物理内存在所有映射解除后回收;
+        # 仍有取出的图片引用共享内存时保留映射, 进程退出时再次尝试
+        if self.shm is None:
+            return
+        self.buffer = None
+        if self.owner_pid == os.getpid():
+            self.shm.unlink()
+            self.owner_pid = None
+        try:
+            self.shm.close()
+        except BufferError:
+            return
+        atexit.unregister(self.close)
+        self.shm = None
+
+
+class LabelTable:
+    """编译后的列式标签表, 替代train_label.json的字典嵌套列表
+
+    names为文件名索引, pos[N, 3]、ori[N, 4]、bbox[N, 4]均为连续的float32数组,
+    ori已归一化, bbox已限制在原始图片内。保存为.npz, 同时记录源json的大小与修改时间,
+    源文件变化后自动重新编译。worker fork后共享同一份只读数组。
+    """
+
+    def __init__(self, path: Path):
+        self.path: Path = Path(path)
+        with np.load(self.path) as data:
+            self.names: np.ndarray = data["names"]
+            self.pos: np.ndarray = data["pos"]
+            self.ori: np.ndarray = data["ori"]
+            self.bbox: np.ndarray = data["bbox"]
+        self.index: dict = {name: i for i, name in enumerate(self.names.tolist())}
+        for array in (self.pos, self.ori, self.bbox):
+            array.flags.writeable = False
+
+    @staticmethod
+    def _source_stamp(label_file: Path) -> np.ndarray:
+        stat = os.stat(label_file)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    @staticmethod
+    def exists(path: Path, label_file: Path) -> bool:
+        # 表文件存在且与源json一致时才可复用
+        if not Path(path).exists():
+            return False
+        with np.load(path) as data:
+            return "source" in data and np.array_equal(data["source"], LabelTable._source_stamp(label_file))
+
+    @staticmethod
+    def compile(label_file: Path, path: Path, width: int, height: int) -> "LabelTable":
+        labels = json.load(open(label_file, "r"))
+        names = list(labels.keys())
+        pos = np.array([labels[name]["pos"] for name in names], dtype=np.float64).reshape(-1, 3)
+        ori = np.array([labels[name]["ori"] for name in names], dtype=np.float64).reshape(-1, 4)
+        ori /= np.linalg.norm(ori, axis=1, keepdims=True)
+        bbox = np.array([labels[name]["bbox"] for name in names], dtype=np.float64).reshape(-1, 4)
+        bbox[:, [0, 2]] = bbox[:, [0, 2]].clip(0, width - 1)
+        bbox[:, [1, 3]] = bbox[:, [1, 3]].clip(0, height - 1)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # 先写临时文件再改名, 中断的编译不会留下不完整的表;
+        # 临时文件名每个进程唯一, DDP的多个rank同时编译时互不覆盖, 改名是原子的, 最后一次改名生效
+        with tempfile.NamedTemporaryFile(dir=Path(path).parent, prefix=Path(path).stem + ".", suffix=".tmp.npz", delete=False) as f:
+            np.savez(f, names=np.array(names), pos=pos.astype(np.float32), ori=ori.astype(np.float32),
+                     bbox=bbox.astype(np.float32), source=LabelTable._source_stamp(label_file))
+        os.replace(f.name, path)
+        return LabelTable(path)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, img_name: str):
+        return img_name in self.index
+
+    def keys(self) -> List[str]:
+        return self.names.tolist()
+
+    def get(self, img_name: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # 返回 pos, ori, bbox 的只读行视图
+        i = self.index[img_name]
+        return self.pos[i], self.ori[i], self.bbox[i]
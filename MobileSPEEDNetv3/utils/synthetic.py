@@ -0,0 +1,128 @@
+"""
+Synthetic SPEED-format dataset
+
+"""
+
+import json
+import cv2 as cv
+import numpy as np
+
+from pathlib import Path
+from functools import partial
+from multiprocessing import Pool
+from typing import List, Tuple
+
+from .utils import Camera
+from .quaternion import quat_canonical, quat_to_matrix
+
+
+# 目标由长方体组成, (中心, 尺寸) 单位为米, 在目标坐标系中: 主体、太阳能板与两根天线
+TARGET_BOXES: List[Tuple[Tuple[float, float, float], Tuple[float, float, float]]] = [
+    ((0.0, 0.0, 0.0), (0.80, 0.80, 0.32)),
+    ((0.0, 0.0, -0.18), (0.80, 0.56, 0.02)),
+    ((0.30, 0.30, 0.40), (0.02, 0.02, 0.50)),
+    ((-0.30, 0.30, 0.40), (0.02, 0.02, 0.50)),
+]
+# 长方体的8个顶点与6个面(顶点逆时针排列时法向量朝外)
+_CORNERS = np.array([[x, y, z] for x in (-0.5, 0.5) for y in (-0.5, 0.5) for z in (-0.5, 0.5)])
+_FACES = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+
+
+def target_mesh() -> Tuple[np.ndarray, List[Tuple[int, int, int, int]]]:
+    # 目标的所有顶点 [N, 3] 与四边形面的顶点序号
+    vertices, faces = [], []
+    for center, size in TARGET_BOXES:
+        faces += [tuple(i + len(vertices) * 8 for i in face) for face in _FACES]
+        vertices.append(_CORNERS * np.array(size) + np.array(center))
+    return np.concatenate(vertices), faces
+
+
+TARGET_VERTICES, TARGET_FACES = target_mesh()
+K = np.array([[Camera.fx, 0, Camera.width / 2], [0, Camera.fy, Camera.height / 2], [0, 0, 1]])
+
+
+def project(points: np.ndarray, pos: np.ndarray, ori: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # 与resize_pose相同的位姿约定: 相机坐标 = R(ori) @ 目标坐标 + pos, 返回像素坐标 [N, 2] 与相机坐标 [N, 3]
+    points_cam = points @ quat_to_matrix(ori).T + pos
+    uv = points_cam @ K.T
+    return uv[:, :2] / uv[:, 2:], points_cam
+
+
+def sample_pose(rng: np.random.Generator, depth: Tuple[float, float], margin: int = 10, max_tries: int = 100):
+    # 随机采样位姿, 目标在相机前方且投影完整落在图像内(距边缘至少margin像素), 返回 pos, ori, bbox
+    for _ in range(max_tries):
+        z = rng.uniform(*depth)
+        # 投影中心在图像内均匀分布
+        u, v = rng.uniform(0, Camera.width), rng.uniform(0, Camera.height)
+        pos = np.array([(u - K[0, 2]) * z / K[0, 0], (v - K[1, 2]) * z / K[1, 1], z])
+        # 四维正态分布归一化后为均匀分布的旋转
+        ori = rng.normal(size=4)
+        ori = quat_canonical(ori / np.linalg.norm(ori))
+        uv, _ = project(TARGET_VERTICES, pos, ori)
+        x_min, y_min = np.floor(uv.min(axis=0))
+        x_max, y_max = np.ceil(uv.max(axis=0))
+        if x_min >= margin and y_min >= margin and x_max < Camera.width - margin and y_max < Camera.height - margin:
+            return pos, ori, [int(x_min), int(y_min), int(x_max), int(y_max)]
+    raise RuntimeError(f"no pose with the target inside the image after {max_tries} tries, depth range {depth} is too close")
+
+
+def render(pos: np.ndarray, ori: np.ndarray, rng: np.random.Generator, earth_p: float = 0.3) -> np.ndarray:
+    # 渲染1920x1200的灰度图: 深空或地球背景, 目标各面按朝向光源的程度着色, 由远到近绘制
+    image = np.zeros((Camera.height, Camera.width), dtype=np.float32)
+    if rng.random() < earth_p:
+        # 地球: 图像外的大圆, 亮度向边缘衰减
+        center = rng.uniform(-0.5, 1.5, 2) * [Camera.width, Camera.height]
+        radius = rng.uniform(1.0, 2.0) * Camera.width
+        y, x = np.mgrid[0:Camera.height, 0:Camera.width].astype(np.float32)
+        distance = np.sqrt((x - center[0]) ** 2 + (y - center[1]) ** 2) / radius
+        image += np.clip(1 - distance, 0, None) ** 0.5 * rng.uniform(60, 140)
+    light = rng.normal(size=3)
+    light /= np.linalg.norm(light)
+    uv, points_cam = project(TARGET_VERTICES, pos, ori)
+    order = sorted(TARGET_FACES, key=lambda face: -points_cam[list(face), 2].mean())
+    for face in order:
+        face = list(face)
+        a, b, c = points_cam[face[:3]]
+        normal = np.cross(b - a, c - a)
+        normal /= np.linalg.norm(normal)
+        # 背面剔除: 法向量与视线同向的面不可见
+        if normal @ points_cam[face].mean(axis=0) >= 0:
+            continue
+        shade = 30 + 200 * max(0.0, -normal @ light)
+        # 4位小数像素精度
+        cv.fillConvexPoly(image, np.round(uv[face] * 16).astype(np.int32), float(shade), lineType=cv.LINE_AA, shift=4)
+    image += rng.normal(0, 3, image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def make_sample(index: int, image_dir: Path, seed: int, depth: Tuple[float, float], earth_p: float, quality: int) -> Tuple[str, dict]:
+    # 每个样本使用由 (seed, index) 确定的随机数, 多进程生成的结果与单进程相同
+    rng = np.random.default_rng([seed, index])
+    pos, ori, bbox = sample_pose(rng, depth)
+    image = render(pos, ori, rng, earth_p)
+    filename = f"img{index:06d}.jpg"
+    cv.imwrite(str(image_dir / filename), image, [cv.IMWRITE_JPEG_QUALITY, quality])
+    return filename, {"pos": pos.tolist(), "ori": ori.tolist(), "bbox": bbox}
+
+
+def generate(out_dir: str, num: int, seed: int = 0, depth: Tuple[float, float] = (5.0, 30.0),
+             earth_p: float = 0.3, quality: int = 90, workers: int = 1) -> dict:
+    """生成与SPEED目录结构相同的合成数据集, 可直接作为data_dir
+
+    out_dir/images/train/img000000.jpg ... 为1920x1200的灰度JPEG,
+    out_dir/train_label.json为 {文件名: {"pos": [3], "ori": [4], "bbox": [x_min, y_min, x_max, y_max]}},
+    ori为标量在前的单位四元数, bbox为目标所有顶点在原图上投影的外接框, 与Camera的内参一致。
+    """
+    out_dir = Path(out_dir)
+    image_dir = out_dir / "images/train"
+    image_dir.mkdir(parents=True, exist_ok=True)
+    sample = partial(make_sample, image_dir=image_dir, seed=seed, depth=tuple(depth), earth_p=earth_p, quality=quality)
+    if workers > 1:
+        with Pool(workers) as pool:
+            samples = pool.map(sample, range(num), chunksize=max(1, min(64, num // (workers * 4))))
+    else:
+        samples = [sample(index) for index in range(num)]
+    labels = dict(samples)
+    with open(out_dir / "train_label.json", "w", encoding="utf-8") as f:
+        json.dump(labels, f)
+    return labels
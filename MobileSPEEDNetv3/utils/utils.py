@@ -6,9 +6,12 @@ Utility functions
 import torch
 import numpy as np
 import cv2
-from scipy.spatial.transform import Rotation as R
+
+from collections import OrderedDict
 from torch import Tensor
 
+from .quaternion import quat_canonical, quat_multiply, quat_to_matrix, quat_to_euler_yxz, euler_yxz_to_quat
+
 class Camera:
     fwx = 0.0176  # focal length[m]
     fwy = 0.0176  # focal length[m]
@@ -22,15 +25,29 @@ class Camera:
     def __init__(self, config):
         self.K = np.array([[self.fx, 0, self.width / 2], [0, self.fy, self.height / 2], [0, 0, 1]])
         self.K_inv = np.linalg.inv(self.K)
+        # 图片以1/decode_scale的分辨率解码
+        self.decode_scale = get_decode_scale(config)
+        # 几何增强所在的图像坐标系(frame)及其尺寸, S将原图像素坐标映射到该坐标系
         if config["resize_first"]:
-            self.S = np.array([[config["imgsz"][1] / self.width, 0, 0], [0, config["imgsz"][0] / self.height, 0], [0, 0, 1]])
+            self.frame_width, self.frame_height = config["imgsz"][1], config["imgsz"][0]
         else:
-            self.S = np.eye(3)
+            self.frame_width, self.frame_height = self.width // self.decode_scale, self.height // self.decode_scale
+        self.S = np.array([[self.frame_width / self.width, 0, 0], [0, self.frame_height / self.height, 0], [0, 0, 1]])
         self.S_inv = np.linalg.inv(self.S)
         self.SK = self.S @ self.K
         self.SK_inv = np.linalg.inv(self.SK)
 
 
+def get_decode_scale(config) -> int:
+    # 目标尺寸不超过传感器尺寸的1/2或1/4时, 直接以降低的分辨率解码JPEG
+    if not config.get("reduced_decode", False):
+        return 1
+    for scale in (4, 2):
+        if Camera.width // scale >= config["imgsz"][1] and Camera.height // scale >= config["imgsz"][0]:
+            return scale
+    return 1
+
+
 def warp_boxes(boxes, M, width, height):
     n = len(boxes)
     if n:
@@ -106,78 +123,60 @@ def clamp(bbox):
     return bbox
 
 
-def rotate_image(image, pos, ori, SK, SK_inv, rot_max_magnitude, rot_angle = None):
-    """Data augmentation: rotate image and adapt position/orientation.
-    Rotation amplitude is randomly picked from [-rot_max_magnitude/2, +rot_max_magnitude/2]
+def rotate_image_pose(pos, ori, SK, SK_inv, rot_max_magnitude, rot_angle = None):
+    """Rotate the image plane around the optical axis without touching pixels.
+    Returns the updated position/orientation and the perspective warp matrix.
     """
 
-    image = np.array(image)
-
     if rot_angle is None:
         change = np.random.uniform(-rot_max_magnitude, rot_max_magnitude)
     else:
         change = rot_angle
 
     # r_change = rpy2r(change, 0, 0, order='xyz', unit='deg')
-    rotation = R.from_euler('YXZ', [0, 0, change], degrees=True)
-    r_change = rotation.as_matrix()
-    
+    rotation = euler_yxz_to_quat(0.0, 0.0, change)
+    r_change = quat_to_matrix(rotation)
 
     # Construct warping (perspective) matrix
     warp_matrix = SK @ r_change @ SK_inv
 
-    height, width = np.shape(image)[:2]
-
-    image_warped = cv2.warpPerspective(image, warp_matrix, (width, height), cv2.WARP_INVERSE_MAP, flags=cv2.INTER_LINEAR)
-
-        
     # Update pose
     pos_new = np.array(r_change @ pos)
-    ori_new = rotation * R.from_quat([ori[1], ori[2], ori[3], ori[0]])
-    ori_new = ori_new.as_quat(canonical=True)
-    ori_new = np.array([ori_new[3], ori_new[0], ori_new[1], ori_new[2]])
+    ori_new = quat_canonical(quat_multiply(rotation, np.asarray(ori, dtype=np.float64)))
 
-    return image_warped, pos_new, ori_new, warp_matrix
+    return pos_new, ori_new, warp_matrix
 
 
-def rotate_cam(image, pos, ori, SK, SK_inv, rot_max_magnitude):
-    """Data augmentation: rotate image and adapt position/orientation.
-    Rotation amplitude is randomly picked from [-rot_max_magnitude/2, +rot_max_magnitude/2]
+def rotate_cam_pose(pos, ori, SK, SK_inv, rot_max_magnitude):
+    """Rotate the camera around its center without touching pixels.
+    Returns the updated position/orientation and the perspective warp matrix.
     """
 
-    image = np.array(image)
-
     change = np.random.uniform(-rot_max_magnitude, rot_max_magnitude, 3)
 
     # r_change = rpy2r(change, 0, 0, order='xyz', unit='deg')
-    rotation = R.from_euler('YXZ', change, degrees=True)
-    r_change = rotation.as_matrix()
-    
+    rotation = euler_yxz_to_quat(*change)
+    r_change = quat_to_matrix(rotation)
 
     # Construct warping (perspective) matrix
     warp_matrix = SK @ r_change @ SK_inv
 
-    height, width = np.shape(image)[:2]
-
-    image_warped = cv2.warpPerspective(image, warp_matrix, (width, height), cv2.WARP_INVERSE_MAP, flags=cv2.INTER_LINEAR)
-
     # Update pose
     pos_new = np.array(r_change @ pos)
-    ori_new = rotation * R.from_quat([ori[1], ori[2], ori[3], ori[0]])
-    ori_new = ori_new.as_quat(canonical=True)
-    ori_new = np.array([ori_new[3], ori_new[0], ori_new[1], ori_new[2]])
+    ori_new = quat_canonical(quat_multiply(rotation, np.asarray(ori, dtype=np.float64)))
 
-    return image_warped, pos_new, ori_new, warp_matrix
+    return pos_new, ori_new, warp_matrix
 
 
-def resize(image, pos, ori, camera, scale_max_magnitude):
-    image = np.array(image)
-    
+def resize_pose(pos, ori, camera, scale_max_magnitude):
+    """Zoom around the projected target center without touching pixels.
+    Returns the updated position/orientation and the perspective warp matrix.
+    """
+
     alpha = 1 + np.random.uniform(-scale_max_magnitude, scale_max_magnitude)
     
     points_body = np.array([0, 0, 0, 1])
-    rotation = R.from_quat([ori[1], ori[2], ori[3], ori[0]])
-    pose_mat = np.hstack((rotation.as_matrix(), np.expand_dims(pos, 1)))
+    pose_mat = np.hstack((quat_to_matrix(np.asarray(ori, dtype=np.float64)), np.expand_dims(pos, 1)))
     p_cam = pose_mat @ points_body
     points_camera_frame = p_cam / p_cam[2]
     points_image_plane = camera.SK @ points_camera_frame
@@ -187,15 +186,97 @@ def resize(image, pos, ori, camera, scale_max_magnitude):
     trans_matrix = np.array([[1, 0, points_image_plane[0]-points_image_plane_resized[0]], [0, 1, points_image_plane[1]-points_image_plane_resized[1]], [0, 0, 1]])
     warp_matrix = trans_matrix @ resize_matrix
     
-    height, width = np.shape(image)[:2]
+    pos_new = pos / alpha
+    ori_new = ori
     
+    return pos_new, ori_new, warp_matrix
+
+
+def rotate_image(image, pos, ori, SK, SK_inv, rot_max_magnitude, rot_angle = None):
+    """Data augmentation: rotate image and adapt position/orientation.
+    Rotation amplitude is randomly picked from [-rot_max_magnitude/2, +rot_max_magnitude/2]
+    """
+
+    image = np.array(image)
+
+    pos_new, ori_new, warp_matrix = rotate_image_pose(pos, ori, SK, SK_inv, rot_max_magnitude, rot_angle)
+
+    height, width = np.shape(image)[:2]
+
     image_warped = cv2.warpPerspective(image, warp_matrix, (width, height), cv2.WARP_INVERSE_MAP, flags=cv2.INTER_LINEAR)
+
+    return image_warped, pos_new, ori_new, warp_matrix
+
+
+def rotate_cam(image, pos, ori, SK, SK_inv, rot_max_magnitude):
+    """Data augmentation: rotate image and adapt position/orientation.
+    Rotation amplitude is randomly picked from [-rot_max_magnitude/2, +rot_max_magnitude/2]
+    """
+
+    image = np.array(image)
+
+    pos_new, ori_new, warp_matrix = rotate_cam_pose(pos, ori, SK, SK_inv, rot_max_magnitude)
+
+    height, width = np.shape(image)[:2]
+
+    image_warped = cv2.warpPerspective(image, warp_matrix, (width, height), cv2.WARP_INVERSE_MAP, flags=cv2.INTER_LINEAR)
+
+    return image_warped, pos_new, ori_new, warp_matrix
+
+
+def resize(image, pos, ori, camera, scale_max_magnitude):
+    image = np.array(image)
     
-    pos_new = pos / alpha
-    ori_new = ori
+    pos_new, ori_new, warp_matrix = resize_pose(pos, ori, camera, scale_max_magnitude)
+    
+    height, width = np.shape(image)[:2]
+    
+    image_warped = cv2.warpPerspective(image, warp_matrix, (width, height), cv2.WARP_INVERSE_MAP, flags=cv2.INTER_LINEAR)
     
     return image_warped, pos_new, ori_new, warp_matrix
 
+
+class RemapCache:
+    """LRU cache of fixed-point remap tables keyed by the warp matrix.
+
+    With quantized rotation angles the same warp matrix repeats, so the per-pixel
+    inverse mapping is computed once with cv2.convertMaps and reused by cv2.remap.
+    Each entry costs 6 bytes per output pixel (CV_16SC2 + CV_16UC1).
+    """
+
+    def __init__(self, maxsize: int = 64):
+        self.maxsize = maxsize
+        self.maps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, M, src_shape, dsize):
+        key = (np.round(M, 9).tobytes(), tuple(src_shape), tuple(dsize))
+        if key in self.maps:
+            self.hits += 1
+            self.maps.move_to_end(key)
+            return self.maps[key]
+        self.misses += 1
+        width, height = dsize
+        xs, ys = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+        points = np.linalg.inv(M) @ np.stack([xs.ravel(), ys.ravel(), np.ones(width * height)])
+        map_x = (points[0] / points[2]).reshape(height, width).astype(np.float32)
+        map_y = (points[1] / points[2]).reshape(height, width).astype(np.float32)
+        self.maps[key] = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        if len(self.maps) > self.maxsize:
+            self.maps.popitem(last=False)
+        return self.maps[key]
+
+    def warp(self, image, M, dsize):
+        # 等价于cv2.warpPerspective(image, M, dsize, flags=cv2.INTER_LINEAR)
+        map1, map2 = self.get(M, image.shape[:2], dsize)
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
+
+
+def scale_matrix(sx, sy):
+    # 图像缩放对应的单应矩阵, 与Camera.S的约定一致
+    return np.array([[sx, 0, 0], [0, sy, 0], [0, 0, 1]], dtype=np.float64)
+
 class OriEncoderDecoder:
     def __init__(self, stride: int, alpha: float, neighbor: int = 0, device: str = 'cpu'):
         assert 360 % stride == 0 and 180 % stride == 0, "stride must be a divisor of 360 and 180"
@@ -256,23 +337,59 @@ class OriEncoderDecoder:
         return encode
     
     def encode_ori(self, ori: np.ndarray):
-        rotation = R.from_quat([ori[1], ori[2], ori[3], ori[0]])
-        yaw, pitch, roll = rotation.as_euler('YXZ', degrees=True)    # 偏航角、俯仰角、翻滚角
+        yaw, pitch, roll = quat_to_euler_yxz(np.asarray(ori, dtype=np.float64))    # 偏航角、俯仰角、翻滚角
         
         yaw_encode = self._encode_ori(yaw, self.yaw_len, self.yaw_index_dict)
         pitch_encode = self._encode_ori(pitch, self.pitch_len, self.pitch_index_dict)
         roll_encode = self._encode_ori(roll, self.roll_len, self.roll_index_dict)
         return yaw_encode, pitch_encode, roll_encode
 
+    def _encode_ori_batch(self, angle: Tensor, angle_range: Tensor):
+        # _encode_ori的批量版本, 逐个neighbor向两侧扩散, 每一步对整个batch做scatter_add
+        encode = torch.zeros(angle.shape[0], angle_range.shape[0], dtype=angle.dtype, device=angle.device)
+        offset = -int(torch.round(angle_range[0] / self.stride).item())     # 角度bin -> 编码下标
+        
+        mean = angle / self.stride
+        l = torch.floor(mean)
+        r = torch.ceil(mean)
+        li = l.long()[:, None] + offset
+        ri = r.long()[:, None] + offset
+        # l == r时两侧各占一半, 等价于_encode_ori中的alpha[0] /= 2
+        same = l == r
+        pl = torch.where(same, 0.5, r - mean)
+        pr = torch.where(same, 0.5, mean - l)
+        for _ in range(self.neighbor):
+            encode.scatter_add_(1, li, (pl * (1 - self.alpha))[:, None])
+            encode.scatter_add_(1, ri, (pr * (1 - self.alpha))[:, None])
+            p_out = (pl + pr) * self.alpha
+            li = li - 1
+            ri = ri + 1
+            l = l - 1
+            r = r + 1
+            d = r - l
+            pl = p_out * (r - mean) / d
+            pr = p_out * (mean - l) / d
+        encode.scatter_add_(1, li, pl[:, None])
+        encode.scatter_add_(1, ri, pr[:, None])
+        
+        return encode
+
+    def encode_ori_batch(self, ori: Tensor):
+        # ori: [B, 4] -> 三个编码 [B, len], 与编码区间在同一设备上
+        yaw, pitch, roll = quat_to_euler_yxz(ori.to(self.yaw_range.device, torch.float64))
+        
+        yaw_encode = self._encode_ori_batch(yaw, self.yaw_range).to(self.yaw_range.dtype)
+        pitch_encode = self._encode_ori_batch(pitch, self.pitch_range).to(self.pitch_range.dtype)
+        roll_encode = self._encode_ori_batch(roll, self.roll_range).to(self.roll_range.dtype)
+        return yaw_encode, pitch_encode, roll_encode
+
     def decode_ori(self, yaw_encode: Tensor, pitch_encode: Tensor, roll_encode: Tensor):
         yaw_decode = np.sum(yaw_encode * self.yaw_range)
         pitch_decode = np.sum(pitch_encode * self.pitch_range)
         roll_decode = np.sum(roll_encode * self.roll_range)
         
-        rotation = R.from_euler('YXZ', [yaw_decode, pitch_decode, roll_decode], degrees=True)
-        ori = rotation.as_quat()
-        ori = [ori[3], ori[0], ori[1], ori[2]]
-        return torch.tensor(ori)
+        ori = euler_yxz_to_quat(yaw_decode, pitch_decode, roll_decode)
+        return torch.as_tensor(ori)
 
     def decode_ori_batch(self, yaw_encode: Tensor, pitch_encode: Tensor, roll_encode: Tensor):
         
@@ -280,19 +397,14 @@ class OriEncoderDecoder:
         pitch_decode = torch.sum(pitch_encode * self.pitch_range, dim=1)
         roll_decode = torch.sum(roll_encode * self.roll_range, dim=1)
         
-        cy = torch.cos(torch.deg2rad(yaw_decode * 0.5))
-        sy = torch.sin(torch.deg2rad(yaw_decode * 0.5))
-        cp = torch.cos(torch.deg2rad(pitch_decode * 0.5))
-        sp = torch.sin(torch.deg2rad(pitch_decode * 0.5))
-        cr = torch.cos(torch.deg2rad(roll_decode * 0.5))
-        sr = torch.sin(torch.deg2rad(roll_decode * 0.5))
-        
-        q0 = cy * cp * cr + sy * sp * sr
-        q1 = cy * sp * cr + sy * cp * sr
-        q2 = sy * cp * cr - cy * sp * sr
-        q3 = -sy * sp * cr + cy * cp * sr
-        
-        return torch.stack([q0, q1, q2, q3], dim=1)
+        return euler_yxz_to_quat(yaw_decode, pitch_decode, roll_decode)
+    
+    def to(self, device):
+        # 角度范围移动到模型所在的设备上, 返回自身
+        self.yaw_range = self.yaw_range.to(device)
+        self.pitch_range = self.pitch_range.to(device)
+        self.roll_range = self.roll_range.to(device)
+        return self
     
     
 class OriEncoderDecoderGauss:
@@ -344,23 +456,40 @@ class OriEncoderDecoderGauss:
         return encode
 
     def encode_ori(self, ori):
-        rotation = R.from_quat([ori[1], ori[2], ori[3], ori[0]])
-        yaw, pitch, roll = rotation.as_euler('YXZ', degrees=True)    # 偏航角、俯仰角、翻滚角
+        yaw, pitch, roll = quat_to_euler_yxz(np.asarray(ori, dtype=np.float64))    # 偏航角、俯仰角、翻滚角
         
         yaw_encode = self._encode_ori(yaw, self.yaw_len, self.yaw_l)
         pitch_encode = self._encode_ori(pitch, self.pitch_len, self.pitch_l)
         roll_encode = self._encode_ori(roll, self.roll_len, self.roll_l)
         return yaw_encode, pitch_encode, roll_encode
+
+    def _encode_ori_batch(self, angle: Tensor, angle_len: int, angle_l: float):
+        # _encode_ori的批量版本, 窗口[ceil(c - extra), floor(c + extra)]之外置零
+        c = ((angle - angle_l) / self.stride)[:, None]
+        indexes = torch.arange(angle_len, dtype=angle.dtype, device=angle.device)[None]
+        window = (indexes >= torch.ceil(c - self.extra)) & (indexes <= torch.floor(c + self.extra))
+        
+        rho = torch.exp(-(indexes - c)**2 / (2 * self.s**2)) * window
+        encode = rho / rho.sum(dim=1, keepdim=True)
+
+        return encode
+
+    def encode_ori_batch(self, ori: Tensor):
+        # ori: [B, 4] -> 三个编码 [B, len], 与编码区间在同一设备上
+        yaw, pitch, roll = quat_to_euler_yxz(ori.to(self.yaw_range.device, torch.float64))
+        
+        yaw_encode = self._encode_ori_batch(yaw, self.yaw_len, self.yaw_l).to(self.yaw_range.dtype)
+        pitch_encode = self._encode_ori_batch(pitch, self.pitch_len, self.pitch_l).to(self.pitch_range.dtype)
+        roll_encode = self._encode_ori_batch(roll, self.roll_len, self.roll_l).to(self.roll_range.dtype)
+        return yaw_encode, pitch_encode, roll_encode
     
     def decode_ori(self, yaw_encode: Tensor, pitch_encode: Tensor, roll_encode: Tensor):
         yaw_decode = torch.sum(yaw_encode * self.yaw_range)
         pitch_decode = torch.sum(pitch_encode * self.pitch_range)
         roll_decode = torch.sum(roll_encode * self.roll_range)
         
-        rotation = R.from_euler('YXZ', [yaw_decode, pitch_decode, roll_decode], degrees=True)
-        ori = rotation.as_quat()
-        ori = [ori[3], ori[0], ori[1], ori[2]]
-        return torch.tensor(ori)
+        ori = euler_yxz_to_quat(yaw_decode, pitch_decode, roll_decode)
+        return torch.as_tensor(ori)
 
     def decode_ori_batch(self, yaw_encode: Tensor, pitch_encode: Tensor, roll_encode: Tensor):
         
@@ -368,16 +497,11 @@ class OriEncoderDecoderGauss:
         pitch_decode = torch.sum(pitch_encode * self.pitch_range, dim=1)
         roll_decode = torch.sum(roll_encode * self.roll_range, dim=1)
         
-        cy = torch.cos(torch.deg2rad(yaw_decode * 0.5))
-        sy = torch.sin(torch.deg2rad(yaw_decode * 0.5))
-        cp = torch.cos(torch.deg2rad(pitch_decode * 0.5))
-        sp = torch.sin(torch.deg2rad(pitch_decode * 0.5))
-        cr = torch.cos(torch.deg2rad(roll_decode * 0.5))
-        sr = torch.sin(torch.deg2rad(roll_decode * 0.5))
-        
-        q0 = cy * cp * cr + sy * sp * sr
-        q1 = cy * sp * cr + sy * cp * sr
-        q2 = sy * cp * cr - cy * sp * sr
-        q3 = -sy * sp * cr + cy * cp * sr
-        
-        return torch.stack([q0, q1, q2, q3], dim=1)
\ No newline at end of file
+        return euler_yxz_to_quat(yaw_decode, pitch_decode, roll_decode)
+    
+    def to(self, device):
+        # 角度范围移动到模型所在的设备上, 返回自身
+        self.yaw_range = self.yaw_range.to(device)
+        self.pitch_range = self.pitch_range.to(device)
+        self.roll_range = self.roll_range.to(device)
+        return self
\ No newline at end of file
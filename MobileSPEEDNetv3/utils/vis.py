@@ -3,9 +3,10 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from spatialmath.base import q2r
-from scipy.spatial.transform import Rotation as R
 from matplotlib.pyplot import MultipleLocator
 
+from .quaternion import quat_to_matrix
+
 BOX_COLOR = (255, 0, 0) # Red
 TEXT_COLOR = (0, 0, 0) # White
 
@@ -73,8 +74,7 @@ def project(q, r, camera):
 
         # transformation to camera frame
         # pose_mat = np.hstack((np.transpose(quat2dcm(q)), np.expand_dims(r, 1)))
-        rotation = R.from_quat([q[1], q[2], q[3], q[0]])
-        pose_mat = np.hstack((rotation.as_matrix(), np.expand_dims(r, 1)))
+        pose_mat = np.hstack((quat_to_matrix(np.asarray(q, dtype=np.float64)), np.expand_dims(r, 1)))
         # pose_mat = np.hstack((quat2dcm(q), np.expand_dims(r, 1)))
         p_cam = pose_mat @ points_body
 
@@ -0,0 +1,152 @@
+import os
+import time
+import json
+import resource
+import shutil
+import tempfile
+import argparse
+
+import numpy as np
+import torch
+from pathlib import Path
+from torch.utils.data import Dataset, DataLoader, random_split, get_worker_info, default_collate
+
+from MobileSPEEDNetv3.utils.config import get_config
+from MobileSPEEDNetv3.utils.dataset import Speed, prepare_Speed, speed_collate
+from MobileSPEEDNetv3.utils.profiler import StageTimer
+
+
+# 存储后端 -> config["ram"]
+BACKENDS = {"disk": False, "shared": True, "memmap": "memmap", "jpeg": "jpeg"}
+
+
+class TimedSpeed(Dataset):
+    # 包装Speed, 每个样本额外返回 (__getitem__耗时(s), worker id, 进程的峰值RSS(KB)), 主进程的worker id为-1
+    def __init__(self, dataset: Speed):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        sample = self.dataset[index]
+        elapsed = time.perf_counter() - start
+        worker_info = get_worker_info()
+        return sample, (elapsed, -1 if worker_info is None else worker_info.id, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def timed_collate(batch: list):
+    collate = speed_collate if Speed.config["transport"] == "uint8" else default_collate
+    return collate([sample for sample, _ in batch]), [info for _, info in batch]
+
+
+def use_backend(backend: str, cache_dir: Path):
+    # 切换图片缓存, 释放上一个后端的共享内存; memmap文件写在cache_dir, 不覆盖数据集的缓存
+    if Speed.img_store is not None:
+        Speed.img_store.close()
+    Speed.img_store = None
+    Speed.config["ram"] = BACKENDS[backend]
+    Speed.cache_dir = cache_dir
+    if backend != "disk":
+        Speed.read_img()
+
+
+def bench(mode: str, workers: int, samples: int, batch_size: int, warmup: int, seed: int) -> dict:
+    # 用与SpeedDataModule相同的collate取samples个样本, 前warmup个批次(包括worker启动)不计时
+    dataset = TimedSpeed(Speed(mode))
+    # 在fork之前创建, worker写共享内存中自己的槽位
+    Speed.stage_timer = StageTimer(workers)
+    rng = np.random.default_rng(seed)
+    total = samples + warmup * batch_size
+    order = np.concatenate([rng.permutation(len(dataset)) if "train" in mode else np.arange(len(dataset))
+                            for _ in range(-(-total // len(dataset)))])[:total].tolist()
+    loader = DataLoader(dataset, batch_size=batch_size, sampler=order, num_workers=workers, collate_fn=timed_collate)
+    latency, rss = [], {}
+    start = time.perf_counter()
+    for i, (_, infos) in enumerate(loader):
+        if i == warmup:
+            start = time.perf_counter()
+            Speed.stage_timer.reset()
+        if i < warmup:
+            continue
+        for elapsed, worker, maxrss in infos:
+            latency.append(elapsed)
+            rss[worker] = max(rss.get(worker, 0), maxrss)
+    elapsed = time.perf_counter() - start
+    del loader
+    latency = np.array(latency) * 1000
+    stages = Speed.stage_timer.summary(dataset.dataset.split)
+    return {
+        "mode": mode,
+        "workers": workers,
+        "samples": len(latency),
+        "samples_per_sec": len(latency) / elapsed,
+        "latency_ms": {"mean": float(latency.mean()), "p50": float(np.percentile(latency, 50)), "p99": float(np.percentile(latency, 99))},
+        "stage_ms": {k[:-len("_ms")]: v for k, v in stages.items() if k.endswith("_ms")},
+        "stage_share": {k[:-len("_share")]: v for k, v in stages.items() if k.endswith("_share")},
+        # ru_maxrss包括fork时继承、与主进程共享的页
+        "peak_rss_mb": {("main" if worker < 0 else f"worker{worker}"): maxrss / 1024 for worker, maxrss in sorted(rss.items())},
+        "main_peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+if __name__ == "__main__":
+
+    # ====================参数====================
+    config = get_config()
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--data_dir", type=str, default=config["data_dir"], help="dataset dir")
+    parser.add_argument("--modes", type=str, nargs="+", default=["train", "val", "self_supervised_train"], choices=["train", "val", "self_supervised_train", "self_supervised_val"], help="Speed modes")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4], help="dataloader workers")
+    parser.add_argument("--backends", type=str, nargs="+", default=["disk", "shared", "memmap", "jpeg"], choices=list(BACKENDS), help="image storage: disk/shared(ram: true)/memmap/jpeg")
+    parser.add_argument("--samples", type=int, default=256, help="timed samples per run")
+    parser.add_argument("--images", type=int, default=1000, help="images used from the dataset, also cached by the ram backends")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed batches per run")
+    parser.add_argument("--batch_size", type=int, default=config["batch_size"], help="batch size")
+    parser.add_argument("--imgsz", type=int, nargs=2, default=config["imgsz"], help="input size H W")
+    parser.add_argument("--transport", type=str, default=config["transport"], choices=["uint8", "float"], help="batch transport")
+    parser.add_argument("--cache_dir", type=str, default=None, help="memmap cache dir, default: a temporary dir")
+    parser.add_argument("--out", type=str, default=None, help="json report path")
+
+    args = parser.parse_args()
+
+    config["data_dir"] = args.data_dir
+    config["imgsz"] = args.imgsz
+    config["transport"] = args.transport
+    config["batch_size"] = args.batch_size
+    config["workers"] = max(args.workers)
+    config["ram"] = False
+    config["debug"] = False
+
+    # ====================数据====================
+    prepare_Speed(config)
+    # 只使用前images张图片, 按config["split"]重新划分训练/验证集
+    Speed.img_name = Speed.img_name[:args.images]
+    Speed.train_index, Speed.val_index = random_split(Speed.img_name, config["split"], generator=torch.Generator().manual_seed(config["seed"]))
+    cache_dir = Path(args.cache_dir if args.cache_dir is not None else tempfile.mkdtemp(prefix="bench_data_"))
+
+    # ====================测试====================
+    report = {
+        "data_dir": args.data_dir, "images": len(Speed.img_name), "imgsz": args.imgsz, "batch_size": args.batch_size,
+        "transport": args.transport, "cpus": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(),
+        "results": [],
+    }
+    for backend in args.backends:
+        use_backend(backend, cache_dir)
+        for mode in args.modes:
+            for workers in args.workers:
+                result = {"backend": backend, **bench(mode, workers, args.samples, args.batch_size, args.warmup, config["seed"])}
+                print(f"{backend:<7} {mode:<22} workers: {workers:<3} samples/s: {result['samples_per_sec']:<8.1f} "
+                      f"p50: {result['latency_ms']['p50']:<7.2f}ms p99: {result['latency_ms']['p99']:<7.2f}ms")
+                report["results"].append(result)
+    use_backend("disk", cache_dir)
+    if args.cache_dir is None:
+        shutil.rmtree(cache_dir)
+
+    if args.out is not None:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    print(json.dumps(report, indent=4))
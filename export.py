@@ -0,0 +1,97 @@
+import os
+import copy
+import json
+import argparse
+
+import cv2 as cv
+import numpy as np
+import torch
+
+from MobileSPEEDNetv3.module.Lightning_MobileSPEEDv3 import load_checkpoint
+from MobileSPEEDNetv3.model.export import PoseExport, export_torchscript, export_onnx, pose_difference
+from MobileSPEEDNetv3.model.fuse import time_fn
+
+
+def load_images(paths: list, imgsz: list) -> torch.Tensor:
+    # 与验证集相同: 灰度读取并resize到imgsz, uint8 [B, 1, H, W]
+    images = [cv.resize(cv.imread(path, cv.IMREAD_GRAYSCALE), (imgsz[1], imgsz[0]), interpolation=cv.INTER_LINEAR) for path in paths]
+    return torch.from_numpy(np.stack(images))[:, None]
+
+
+if __name__ == "__main__":
+
+    # ====================参数====================
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--ckpt", type=str, required=True, help="LightningMobileSPEEDv3 checkpoint")
+    parser.add_argument("--out", type=str, default=None, help="output dir, default: checkpoint dir")
+    parser.add_argument("--format", type=str, nargs="+", default=["onnx", "torchscript"], choices=["onnx", "torchscript"], help="export formats")
+    parser.add_argument("--images", type=str, nargs="+", default=["test/img000001.jpg", "test/img008549.jpg"], help="images for parity check")
+    parser.add_argument("--imgsz", type=int, nargs=2, default=None, help="input size H W, default: config imgsz")
+    parser.add_argument("--fuse", action="store_true", help="fuse_for_inference before export")
+    parser.add_argument("--opset", type=int, default=17, help="onnx opset")
+    parser.add_argument("--pos_tol", type=float, default=1e-3, help="max position difference (m)")
+    parser.add_argument("--ori_tol", type=float, default=1e-2, help="max orientation difference (deg)")
+    parser.add_argument("--repeat", type=int, default=20, help="latency repeat")
+    parser.add_argument("--threads", type=int, default=None, help="cpu threads")
+
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    out = args.out if args.out is not None else os.path.dirname(os.path.abspath(args.ckpt))
+    name = os.path.splitext(os.path.basename(args.ckpt))[0]
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    # ====================模型====================
+    module = load_checkpoint(args.ckpt)
+    imgsz = args.imgsz if args.imgsz is not None else module.config["imgsz"]
+    images = load_images(args.images, imgsz)
+
+    # eager参考输出: 模型 + Python端的decode_ori_batch
+    def eager(x):
+        pos, yaw, pitch, roll = module.model(x)
+        return pos, module.ori_encoder_decoder.decode_ori_batch(yaw, pitch, roll)
+
+    with torch.no_grad():
+        expected = eager(images)
+        eager_latency = time_fn(lambda: eager(images[:1]), args.repeat)
+
+    model = copy.deepcopy(module.model)
+    if args.fuse:
+        model.fuse_for_inference(imgsz=imgsz)
+    export_model = PoseExport(model, module.ori_encoder_decoder).eval()
+
+    # ====================导出====================
+    report = {"ckpt": args.ckpt, "imgsz": imgsz, "fuse": args.fuse, "eager": {"latency(ms)": eager_latency}}
+    # 每个batch大小都与eager对比, batch为1时同时检查动态batch
+    batches = [images, images[:1]]
+
+    if "torchscript" in args.format:
+        path = os.path.join(out, f"{name}.torchscript.pt")
+        traced = export_torchscript(export_model, images, path)
+        with torch.no_grad():
+            diffs = [pose_difference([e[:len(x)] for e in expected], traced(x)) for x in batches]
+            latency = time_fn(lambda: traced(images[:1]), args.repeat)
+        report["torchscript"] = {"path": path, "diff": diffs, "latency(ms)": latency}
+
+    if "onnx" in args.format:
+        import onnxruntime as ort
+        path = export_onnx(export_model, images, os.path.join(out, f"{name}.onnx"), args.opset)
+        options = ort.SessionOptions()
+        if args.threads is not None:
+            options.intra_op_num_threads = args.threads
+        session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        diffs = [pose_difference([e[:len(x)] for e in expected], session.run(None, {"image": x.numpy()})) for x in batches]
+        single = images[:1].numpy()
+        latency = time_fn(lambda: session.run(None, {"image": single}), args.repeat)
+        report["onnx"] = {"path": path, "diff": diffs, "latency(ms)": latency}
+
+    # ====================校验====================
+    print(json.dumps(report, indent=4))
+    for fmt in args.format:
+        for diff in report[fmt]["diff"]:
+            assert diff["pos(m)"] <= args.pos_tol and diff["ori(deg)"] <= args.ori_tol, \
+                f"{fmt} parity check failed: {diff}, tolerance pos {args.pos_tol} m, ori {args.ori_tol} deg"
+    print(f"parity check passed, outputs in {out}")
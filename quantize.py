@@ -0,0 +1,89 @@
+import os
+import copy
+import json
+import itertools
+import argparse
+
+import torch
+
+from MobileSPEEDNetv3.module.Lightning_MobileSPEEDv3 import load_checkpoint
+from MobileSPEEDNetv3.model.quantize import quantize_ptq, model_size
+from MobileSPEEDNetv3.model.fuse import time_fn
+from MobileSPEEDNetv3.utils.dataset import SpeedDataModule
+from MobileSPEEDNetv3.utils.metrics import PosError, OriError, Score
+
+
+@torch.no_grad()
+def evaluate(model, batches, ori_encoder_decoder, ALPHA) -> dict:
+    # 与LightningMobileSPEEDv3.validation_step相同的指标
+    pos_error, ori_error, score = PosError(), OriError(), Score(ALPHA)
+    for images, labels in batches:
+        pos, yaw, pitch, roll = model(images)
+        pos_error.update(pos, labels["pos"])
+        ori_error.update(ori_encoder_decoder.decode_ori_batch(yaw, pitch, roll), labels["ori"])
+    score.update(ori_error.compute(), pos_error.compute())
+    return {"pos_error(m)": pos_error.compute().item(), "ori_error(deg)": ori_error.compute().item(), "score": score.compute().item()}
+
+
+if __name__ == "__main__":
+
+    # ====================参数====================
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--ckpt", type=str, required=True, help="LightningMobileSPEEDv3 checkpoint")
+    parser.add_argument("--out", type=str, default=None, help="output dir, default: checkpoint dir")
+    parser.add_argument("--data_dir", type=str, default=None, help="dataset dir, default: config data_dir")
+    parser.add_argument("--calib_batches", type=int, default=16, help="val batches for calibration")
+    parser.add_argument("--eval_batches", type=int, default=None, help="val batches for evaluation, default: all")
+    parser.add_argument("--batch_size", type=int, default=None, help="batch size, default: config batch_size")
+    parser.add_argument("--workers", type=int, default=None, help="dataloader workers, default: config workers")
+    parser.add_argument("--backend", type=str, default="x86", choices=["x86", "fbgemm", "qnnpack", "onednn"], help="quantized engine")
+    parser.add_argument("--skip", type=str, nargs="*", default=["expand2rgb_conv"], help="submodules kept in fp32, head is always fp32")
+    parser.add_argument("--repeat", type=int, default=20, help="latency repeat")
+    parser.add_argument("--threads", type=int, default=None, help="cpu threads")
+
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    out = args.out if args.out is not None else os.path.dirname(os.path.abspath(args.ckpt))
+    name = os.path.splitext(os.path.basename(args.ckpt))[0]
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    # ====================模型====================
+    module = load_checkpoint(args.ckpt)
+    config = module.config
+    for key in ["data_dir", "batch_size", "workers"]:
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    # val_dataloader使用persistent_workers
+    config["workers"] = max(1, config["workers"])
+
+    # ====================数据====================
+    dataloader = SpeedDataModule(config=config)
+    dataloader.setup("validate")
+    loader = dataloader.val_dataloader()
+    # 与验证时相同: 拆分打包的标签, batch_photometric开启时在批次上叠加验证集光晕
+    batches = lambda n: (dataloader.on_after_batch_transfer(batch, 0) for batch in itertools.islice(loader, n))
+
+    # ====================量化====================
+    quantized = quantize_ptq(module.model, (images for images, _ in batches(args.calib_batches)), args.backend, args.skip)
+    x = torch.randint(0, 256, (1, 1, *config["imgsz"]), dtype=torch.uint8)
+    # 保存为TorchScript, 部署时不依赖本仓库的代码
+    path = os.path.join(out, f"{name}.int8.torchscript.pt")
+    with torch.no_grad():
+        torch.jit.trace(quantized, x).save(path)
+
+    # ====================评估====================
+    fused = copy.deepcopy(module.model)
+    fused.fuse_for_inference(imgsz=config["imgsz"], verbose=False)
+    report = {"ckpt": args.ckpt, "path": path, "backend": args.backend, "calib_batches": args.calib_batches, "skip": args.skip}
+    for key, model in [("fp32", module.model), ("fp32_fused", fused), ("int8", quantized)]:
+        # 融合前后的FP32输出相同, 只评估一次
+        metrics = {} if key == "fp32_fused" else evaluate(model, batches(args.eval_batches), module.ori_encoder_decoder, config["ALPHA"])
+        with torch.no_grad():
+            metrics["latency(ms)"] = time_fn(lambda: model(x), args.repeat)
+        metrics["size(MB)"] = model_size(model)
+        report[key] = metrics
+    print(json.dumps(report, indent=4))
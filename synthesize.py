@@ -0,0 +1,26 @@
+import time
+import argparse
+
+from MobileSPEEDNetv3.utils.synthetic import generate
+
+
+if __name__ == "__main__":
+
+    # ====================参数====================
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--out", type=str, required=True, help="dataset dir, used as data_dir")
+    parser.add_argument("--num", type=int, default=1000, help="number of images")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--depth", type=float, nargs=2, default=[5.0, 30.0], help="target distance range (m)")
+    parser.add_argument("--earth_p", type=float, default=0.3, help="probability of an earth background")
+    parser.add_argument("--quality", type=int, default=90, help="jpeg quality")
+    parser.add_argument("--workers", type=int, default=1, help="processes")
+
+    args = parser.parse_args()
+
+    # ====================生成====================
+    start = time.perf_counter()
+    labels = generate(args.out, args.num, args.seed, args.depth, args.earth_p, args.quality, args.workers)
+    elapsed = time.perf_counter() - start
+    print(f"generated {len(labels)} images in {args.out}: {elapsed:.1f}s, {len(labels) / elapsed:.1f} images/s")
@@ -0,0 +1,83 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import cv2 as cv
+import numpy as np
+import torch
+
+from MobileSPEEDNetv3.utils.config import get_config
+from MobileSPEEDNetv3.utils.utils import warp_boxes
+from MobileSPEEDNetv3.utils.batch_augment import BatchGeometricAugment, BatchPhotometricAugment, warp_boxes_batch
+
+
+def random_homography(rng, height, width):
+    src = np.float32([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]])
+    dst = src + rng.uniform(-40, 40, src.shape).astype(np.float32)
+    return cv.getPerspectiveTransform(src, dst).astype(np.float64)
+
+
+def test_warp_matches_opencv():
+    config = get_config()
+    height, width = config["imgsz"]
+    augment = BatchGeometricAugment(config)
+    rng = np.random.default_rng(0)
+    image = cv.GaussianBlur(rng.integers(0, 256, (height, width)).astype(np.uint8), (9, 9), 3)
+    M = np.stack([random_homography(rng, height, width) for _ in range(4)])
+    warped = augment.warp(torch.from_numpy(image)[None, None].repeat(4, 1, 1, 1), torch.from_numpy(M))
+    for i in range(4):
+        expected = cv.warpPerspective(image, M[i], (width, height), flags=cv.INTER_LINEAR)
+        diff = np.abs(warped[i, 0].numpy() * 255 - expected)[2:-2, 2:-2]
+        assert diff.mean() < 0.5 and diff.max() < 3
+
+
+def test_warp_boxes_batch_matches_warp_boxes():
+    rng = np.random.default_rng(0)
+    boxes = np.array([[300, 200, 420, 310], [10, 5, 700, 470]], dtype=np.float64)
+    for _ in range(5):
+        M = random_homography(rng, 480, 768)
+        expected = warp_boxes(boxes, M, width=768, height=480)
+        result = warp_boxes_batch(torch.from_numpy(boxes), torch.from_numpy(M), 768, 480)
+        np.testing.assert_allclose(result.numpy(), expected, atol=1e-3)
+
+
+def test_pose_follows_image():
+    # 目标中心处的亮斑经过增强后应落在新位姿的投影点上
+    config = get_config()
+    config["Resize"]["p"] = 1.0
+    config["Rotate"]["p"] = 0.5
+    height, width = config["imgsz"]
+    torch.manual_seed(0)
+    augment = BatchGeometricAugment(config)
+    K = augment.K.numpy()
+    B = 16
+    pos = torch.tensor([[0.3, -0.2, 15.0]], dtype=torch.float64).repeat(B, 1)
+    ori = torch.tensor([[0.5, 0.5, 0.5, 0.5]], dtype=torch.float64).repeat(B, 1)
+    center = K @ (pos[0].numpy() / pos[0, 2].item())
+    ys, xs = np.mgrid[0:height, 0:width]
+    blob = np.exp(-((xs - center[0]) ** 2 + (ys - center[1]) ** 2) / (2 * 3.0 ** 2))
+    images = torch.from_numpy((blob * 255).astype(np.uint8))[None, None].repeat(B, 1, 1, 1)
+    bbox = torch.tensor([[center[0] - 60, center[1] - 40, center[0] + 60, center[1] + 40]], dtype=torch.float64).repeat(B, 1)
+    label = torch.cat([pos, ori, bbox], dim=1)
+    labels = {"label": label, "pos": label[:, 0:3], "ori": label[:, 3:7], "bbox": label[:, 7:11]}
+    images, labels = augment(images, labels)
+    for i in range(B):
+        projection = K @ (labels["pos"][i].numpy() / labels["pos"][i, 2].item())
+        weight = images[i, 0].numpy()
+        weight = np.where(weight > 0.5 * weight.max(), weight, 0)
+        centroid = np.array([(weight * xs).sum(), (weight * ys).sum()]) / weight.sum()
+        assert np.linalg.norm(centroid - projection[:2]) < 1.0
+        np.testing.assert_allclose(np.linalg.norm(labels["ori"][i].numpy()), 1, atol=1e-6)
+
+
+def test_photometric_range_and_identity():
+    config = get_config()
+    height, width = config["imgsz"]
+    torch.manual_seed(0)
+    images = torch.randint(0, 256, (8, 1, height, width), dtype=torch.uint8)
+    result = BatchPhotometricAugment(config, p=0.0, flare_p=0.0)(images)
+    np.testing.assert_allclose(result.numpy() * 255, images.numpy(), atol=1e-3)
+    result = BatchPhotometricAugment(config, p=1.0, flare_p=1.0)(images)
+    assert result.dtype == torch.float32 and result.shape == images.shape
+    assert result.min() >= 0 and result.max() <= 1
+    # 光晕中心附近接近饱和
+    assert (result > 0.99).flatten(1).any(dim=1).all()
@@ -0,0 +1,37 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import torch
+
+from MobileSPEEDNetv3.module.Lightning_MobileSPEEDv3 import LightningMobileSPEEDv3
+from MobileSPEEDNetv3.utils.config import get_config
+from MobileSPEEDNetv3.utils.cpu import split_cores
+
+
+def test_split_cores():
+    cores = list(range(8))
+    assert split_cores(cores, 6, 2) == ([0, 1, 2, 3, 4, 5], [6, 7])
+    # 核不够分时worker与计算线程共用所有核
+    assert split_cores(cores, 8, 4) == (cores, cores)
+    assert split_cores([0], 1, 1) == ([0], [0])
+
+
+def test_channels_last_bf16_forward():
+    config = get_config()
+    config["pretrained"] = False
+    config["accelerator"] = "cpu"
+    torch.manual_seed(0)
+    module = LightningMobileSPEEDv3(config).eval()
+    x = torch.randint(0, 256, (2, 1, 128, 192), dtype=torch.uint8)
+    with torch.no_grad():
+        expected = module(x)
+        module.config["channels_last"] = True
+        module.model.to(memory_format=torch.channels_last)
+        result = module(x)
+        for a, b in zip(expected, result):
+            torch.testing.assert_close(a, b, atol=1e-5, rtol=1e-4)
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            result = module(x)
+    for a, b in zip(expected, result):
+        assert b.dtype == torch.bfloat16
+        torch.testing.assert_close(a, b.float(), atol=0.05, rtol=0.05)
@@ -0,0 +1,54 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import numpy as np
+
+from MobileSPEEDNetv3.utils.dataset import CropAndPad, CropAndPadInplace, DropBlockSafe, DropBlockSafeInplace
+
+
+def random_bbox(rng, height, width):
+    x_min, y_min = int(rng.integers(0, width)), int(rng.integers(0, height))
+    return [x_min, y_min, int(rng.integers(x_min, width)), int(rng.integers(y_min, height))]
+
+
+def test_crop_and_pad_inplace_matches():
+    rng = np.random.default_rng(0)
+    for seed in range(50):
+        image = rng.integers(0, 256, (48, 77), dtype=np.uint8)
+        bbox = random_bbox(rng, 48, 77)
+        np.random.seed(seed)
+        expected = CropAndPad(image.copy(), bbox)
+        np.random.seed(seed)
+        result = image.copy()
+        CropAndPadInplace(result, bbox)
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_drop_block_safe_inplace_keeps_bbox():
+    rng = np.random.default_rng(0)
+    dropped = 0
+    for _ in range(50):
+        image = np.zeros((48, 77), dtype=np.uint8)
+        x_min, y_min, x_max, y_max = bbox = random_bbox(rng, 48, 77)
+        DropBlockSafeInplace(image, bbox, 7)
+        assert (image[y_min:y_max + 1, x_min:x_max + 1] == 0).all()
+        dropped += image.any()
+    assert dropped > 40
+
+
+def test_drop_block_safe_grayscale():
+    # 灰度图与图片缓存的只读视图上同样丢弃块, 输入不被修改
+    rng = np.random.default_rng(0)
+    dropped = 0
+    for seed in range(50):
+        image = np.zeros((48, 77), dtype=np.uint8)
+        image.flags.writeable = False
+        bbox = random_bbox(rng, 48, 77)
+        np.random.seed(seed)
+        result = DropBlockSafe(image, bbox, 7)
+        np.random.seed(seed)
+        expected = DropBlockSafeInplace(np.zeros((48, 77), dtype=np.uint8), bbox, 7)
+        np.testing.assert_array_equal(result, expected)
+        assert not image.any()
+        dropped += result.any()
+    assert dropped > 40
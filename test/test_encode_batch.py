@@ -0,0 +1,20 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import numpy as np
+import torch
+
+from scipy.spatial.transform import Rotation as R
+
+from MobileSPEEDNetv3.utils.utils import OriEncoderDecoderGauss, OriEncoderDecoder
+
+
+def test_encode_ori_batch_matches_encode_ori():
+    q = R.random(500, random_state=0).as_quat()
+    ori = np.concatenate([q[:, 3:], q[:, :3]], axis=1)
+    for ori_encoder_decoder in [OriEncoderDecoder(5, 0.1, 2), OriEncoderDecoder(10, 0.2, 3),
+                                OriEncoderDecoderGauss(5, 0.1), OriEncoderDecoderGauss(5, 1.5, 5)]:
+        expected = [np.stack(encode) for encode in zip(*[ori_encoder_decoder.encode_ori(o) for o in ori])]
+        encode = ori_encoder_decoder.encode_ori_batch(torch.from_numpy(ori))
+        for a, b in zip(encode, expected):
+            np.testing.assert_allclose(a.numpy(), b, atol=1e-6)
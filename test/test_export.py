@@ -0,0 +1,51 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import pytest
+import torch
+
+from MobileSPEEDNetv3.model import Mobile_SPEEDv3
+from MobileSPEEDNetv3.model.export import PoseExport, export_torchscript, export_onnx, pose_difference
+from MobileSPEEDNetv3.utils.config import get_config
+from MobileSPEEDNetv3.utils.utils import OriEncoderDecoder, OriEncoderDecoderGauss
+
+
+def build(encoder):
+    config = get_config()
+    config["pretrained"] = False
+    config["encoder"] = encoder
+    if encoder == "Linear":
+        ori_encoder_decoder = OriEncoderDecoder(config["stride"], config["s"], config["n"])
+    else:
+        # 模型按n扩展编码长度, Gauss解码器按max(tau * s, 5)扩展, 取两者一致的参数
+        config["n"], config["s"] = 5, 1.0
+        ori_encoder_decoder = OriEncoderDecoderGauss(config["stride"], config["s"], config["n"])
+    torch.manual_seed(0)
+    model = Mobile_SPEEDv3(config).eval()
+    x = torch.randint(0, 256, (2, 1, 128, 192), dtype=torch.uint8)
+    with torch.no_grad():
+        pos, yaw, pitch, roll = model(x)
+        expected = pos, ori_encoder_decoder.decode_ori_batch(yaw, pitch, roll)
+    return PoseExport(model, ori_encoder_decoder).eval(), x, expected
+
+
+@pytest.mark.parametrize("encoder", ["Linear", "Gauss"])
+def test_torchscript_matches_decoder(tmp_path, encoder):
+    model, x, expected = build(encoder)
+    traced = export_torchscript(model, x, str(tmp_path / "model.pt"))
+    loaded = torch.jit.load(str(tmp_path / "model.pt"))
+    with torch.no_grad():
+        for result in [model(x), traced(x), loaded(x)]:
+            diff = pose_difference(expected, result)
+            assert diff["pos(m)"] < 1e-5 and diff["ori(deg)"] < 1e-3
+
+
+def test_onnx_dynamic_batch(tmp_path):
+    ort = pytest.importorskip("onnxruntime")
+    model, x, expected = build("Linear")
+    path = export_onnx(model, x[:1], str(tmp_path / "model.onnx"))
+    session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+    pos, quat = session.run(None, {"image": x.numpy()})
+    assert pos.shape == (2, 3) and quat.shape == (2, 4)
+    diff = pose_difference(expected, (pos, quat))
+    assert diff["pos(m)"] < 1e-4 and diff["ori(deg)"] < 1e-2
@@ -0,0 +1,43 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import numpy as np
+import torch
+import albumentations as A
+
+from MobileSPEEDNetv3.utils.config import get_config
+from MobileSPEEDNetv3.utils.flare import SunFlareBank
+from MobileSPEEDNetv3.utils.batch_augment import BatchPhotometricAugment
+
+
+def test_bank_matches_sun_flare_overlay():
+    # 只有光源时, 光晕库的 img * (1 - a) + c 应与RandomSunFlare逐层混合的结果一致
+    config = get_config()
+    config["SunFlare"].update(bank_size=1, bank_scale=1.0, num_circles=[0, 0], intensity=[1.0, 1.0])
+    bank = SunFlareBank(config)
+    a = bank.coverage[0, 600:1800, 960:2880].astype(np.float64)
+    c = bank.color[0, 600:1800, 960:2880].astype(np.float64)
+    for value in [0, 100, 200]:
+        image = np.full((1200, 1920), value, dtype=np.uint8)
+        expected = A.functional.add_sun_flare_overlay(image, (960, 600), 500, (255, 255, 255), [])
+        result = value * (1 - a / 255) + c
+        # 参考实现逐层截断为uint8, 远离光源处也会偏暗1个灰度
+        assert np.abs(result - expected).mean() < 3 and np.abs(result - expected).max() < 30
+
+
+def test_bank_apply_and_batch_blend():
+    config = get_config()
+    config["SunFlare"].update(bank_size=4, bank_scale=0.125)
+    bank = SunFlareBank(config)
+    image = np.full((600, 960), 50, dtype=np.uint8)
+    a = bank.apply(image, np.random.RandomState(3))
+    b = bank.apply(image, np.random.RandomState(3))
+    assert a.shape == image.shape and a.dtype == np.uint8
+    assert np.array_equal(a, b) and (a >= image).all() and a.max() > 200
+    height, width = config["imgsz"]
+    augment = BatchPhotometricAugment(config, p=0.0, flare_p=1.0, bank=bank)
+    images = torch.full((4, 1, height, width), 50, dtype=torch.uint8)
+    x = augment(images, torch.Generator().manual_seed(0))
+    y = augment(images, torch.Generator().manual_seed(0))
+    assert torch.equal(x, y) and (x >= 50 / 255 - 1e-6).all()
+    assert (x.flatten(1).amax(dim=1) > 0.8).all()
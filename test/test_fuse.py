@@ -0,0 +1,43 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import torch
+from torch import nn
+
+from MobileSPEEDNetv3.model import Mobile_SPEEDv3, LightSPEED
+from MobileSPEEDNetv3.utils.config import get_config
+
+
+def randomize_bn(model):
+    # 随机的BN统计量, 使折叠前后的差异可见
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.0)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.2, 0.2)
+    return model.eval()
+
+
+@torch.no_grad()
+def check_fuse(model, shape):
+    x = torch.randint(0, 256, shape, dtype=torch.uint8)
+    expected = model(x)
+    report = model.fuse_for_inference(imgsz=list(shape[2:]), verbose=False)
+    assert report["fused_bn"] > 0 and report["deployed"] > 0
+    assert not any(isinstance(module, nn.BatchNorm2d) for module in model.modules())
+    for a, b in zip(model(x), expected):
+        torch.testing.assert_close(a, b, atol=1e-5, rtol=1e-4)
+
+
+def test_fuse_mobile_speed():
+    config = get_config()
+    config["pretrained"] = False
+    torch.manual_seed(0)
+    check_fuse(randomize_bn(Mobile_SPEEDv3(config)), (2, 1, 128, 192))
+
+
+def test_fuse_light_speed():
+    config = get_config()
+    torch.manual_seed(0)
+    check_fuse(randomize_bn(LightSPEED(config)), (2, 3, 128, 192))
@@ -0,0 +1,150 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+# 性能回归测试, 默认跳过: SPEED_PERF=1 python -m pytest -q test/test_perf.py
+# 每个组件的最短耗时与perf_baseline.json中本机的记录比较, 超过基线的 (1 + 容差) 倍时失败;
+# 本机没有记录的组件跳过, 在空闲的机器上用SPEED_PERF_UPDATE=1记录或覆盖本机的基线
+
+import os
+import json
+import time
+import platform
+import itertools
+import pytest
+import numpy as np
+import torch
+
+from MobileSPEEDNetv3.model import Mobile_SPEEDv3, LightSPEED
+from MobileSPEEDNetv3.utils.config import get_config
+from MobileSPEEDNetv3.utils.dataset import Speed, prepare_Speed
+from MobileSPEEDNetv3.utils.loss import PoseLoss, EulerLoss, OriLoss
+from MobileSPEEDNetv3.utils.quaternion import quat_normalize
+from MobileSPEEDNetv3.utils.synthetic import generate
+from MobileSPEEDNetv3.utils.utils import OriEncoderDecoder, OriEncoderDecoderGauss, warp_boxes
+
+
+pytestmark = pytest.mark.skipif(os.environ.get("SPEED_PERF") != "1", reason="set SPEED_PERF=1 to run the performance tests")
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "perf_baseline.json")
+# 各组件的容差, 按名称前缀匹配, 面向专用的测试机器: 前向与数据读取计时稳定, 微秒级的小算子受调度与缓存的影响更大
+# 共享的机器上负载随时间变化, 同一组件前后可以相差1.5倍以上, 需要设置SPEED_PERF_TOLERANCE放宽所有组件的容差
+TOLERANCE = {"forward": 0.5, "speed_getitem": 0.5, "Linear": 0.6, "Gauss": 0.6, "": 1.0}
+UPDATE = os.environ.get("SPEED_PERF_UPDATE") == "1"
+# 前向测试的输入尺寸, batch 32时[480, 768]在CPU上太慢
+IMGSZ = [240, 384]
+
+
+def machine() -> str:
+    # 基线按CPU型号与可用核数区分, 不同机器的耗时不可比
+    name = platform.machine()
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            name = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), name)
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    return f"{name} x{cores}"
+
+
+def tolerance(name: str) -> float:
+    if "SPEED_PERF_TOLERANCE" in os.environ:
+        return float(os.environ["SPEED_PERF_TOLERANCE"])
+    return next(value for prefix, value in TOLERANCE.items() if name.startswith(prefix))
+
+
+def check_budget(name: str, ms: float):
+    baseline = json.load(open(BASELINE, "r", encoding="utf-8")) if os.path.exists(BASELINE) else {}
+    records = baseline.setdefault(machine(), {})
+    # 只有显式要求时才写入基线, 避免测试改动仓库中的文件或与刚记录的结果比较
+    if UPDATE:
+        records[name] = round(ms, 4)
+        with open(BASELINE, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        return
+    if name not in records:
+        pytest.skip(f"no baseline for {name} on {machine()}, record one with SPEED_PERF_UPDATE=1")
+    budget = records[name] * (1 + tolerance(name))
+    assert ms <= budget, f"{name}: {ms:.3f}ms > {budget:.3f}ms (baseline {records[name]:.3f}ms, tolerance {tolerance(name):.0%})"
+
+
+def measure(fn, repeat: int = 20, number: int = 1, warmup: int = 3) -> float:
+    # 每次计时连续调用number次, 返回repeat次中单次调用的最短耗时(ms), 与timeit相同, 最短耗时受其他进程的干扰最小
+    # 微秒级的小算子用较多、较短的计时, 其他进程的负载随时间变化, 更容易取到不受干扰的一次
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append(time.perf_counter() - start)
+    return min(times) / number * 1e3
+
+
+@pytest.fixture(scope="module")
+def speed(tmp_path_factory):
+    # 合成数据集上的Speed, 只读磁盘, 不缓存图片
+    data_dir = tmp_path_factory.mktemp("speed")
+    generate(str(data_dir), 16)
+    config = get_config()
+    config["data_dir"] = str(data_dir)
+    config["ram"] = False
+    config["workers"] = 0
+    prepare_Speed(config)
+    return config
+
+
+@pytest.mark.parametrize("mode", ["train", "val", "self_supervised_train"])
+def test_speed_getitem(speed, mode):
+    np.random.seed(0)
+    dataset = Speed(mode)
+    index = itertools.cycle(range(len(dataset)))
+    check_budget(f"speed_getitem_{mode}", measure(lambda: dataset[next(index)], repeat=30))
+
+
+@pytest.mark.parametrize("encoder", ["Linear", "Gauss"])
+def test_ori_encoder_decoder(encoder):
+    torch.manual_seed(0)
+    ori_encoder_decoder = OriEncoderDecoder(5, 0.1, 2) if encoder == "Linear" else OriEncoderDecoderGauss(5, 1, 5)
+    ori = quat_normalize(torch.randn(32, 4))
+    encoded = ori_encoder_decoder.encode_ori_batch(ori)
+    check_budget(f"{encoder}_encode_b32", measure(lambda: ori_encoder_decoder.encode_ori_batch(ori), repeat=100, number=20))
+    check_budget(f"{encoder}_decode_b32", measure(lambda: ori_encoder_decoder.decode_ori_batch(*encoded), repeat=100, number=20))
+
+
+@pytest.mark.parametrize("num", [1, 32])
+def test_warp_boxes(num):
+    rng = np.random.default_rng(0)
+    boxes = np.sort(rng.uniform(0, 768, (num, 4)).reshape(num, 2, 2), axis=1).reshape(num, 4)
+    M = np.eye(3) + rng.normal(0, 1e-3, (3, 3))
+    check_budget(f"warp_boxes_{num}", measure(lambda: warp_boxes(boxes, M, 768, 480), repeat=200, number=100))
+
+
+@pytest.mark.parametrize("loss, loss_type", [(PoseLoss, loss_type) for loss_type in ["MAE", "MSE", "Huber", "Log_Cosh"]]
+                         + [(EulerLoss, loss_type) for loss_type in ["CrossEntropy", "Focal", "JS_Divergence", "KL_Divergence"]]
+                         + [(OriLoss, "Arccos")])
+def test_loss(loss, loss_type):
+    torch.manual_seed(0)
+    if loss is PoseLoss:
+        pre, label = torch.randn(32, 3), torch.randn(32, 3)
+    elif loss is EulerLoss:
+        pre, label = torch.randn(32, 77).softmax(dim=1), torch.randn(32, 77).softmax(dim=1)
+    else:
+        pre, label = quat_normalize(torch.randn(32, 4)), quat_normalize(torch.randn(32, 4))
+    criterion = loss(loss_type)
+    check_budget(f"loss_{loss_type}_b32", measure(lambda: criterion(pre, label), repeat=200, number=100))
+
+
+@pytest.mark.parametrize("batch", [1, 32])
+@pytest.mark.parametrize("name", ["Mobile_SPEEDv3", "LightSPEED"])
+@torch.no_grad()
+def test_forward(name, batch):
+    config = get_config()
+    config["pretrained"] = False
+    config["imgsz"] = IMGSZ
+    torch.manual_seed(0)
+    if name == "Mobile_SPEEDv3":
+        model, channels = Mobile_SPEEDv3(config).eval(), 1
+    else:
+        model, channels = LightSPEED(config).eval(), 3
+    x = torch.randint(0, 256, (batch, channels, *IMGSZ), dtype=torch.uint8)
+    repeat, warmup = (10, 2) if batch == 1 else (3, 1)
+    check_budget(f"forward_{name}_b{batch}", measure(lambda: model(x), repeat, warmup=warmup))
@@ -0,0 +1,96 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import json
+import time
+import pytest
+import torch
+import lightning as L
+from torch import nn
+from torch.utils.data import Dataset, DataLoader
+
+from MobileSPEEDNetv3.utils.profiler import StageTimer, StepProfiler
+
+
+class SlowData(Dataset):
+    # 每个样本在worker中"解码"10ms, 模型计算很快, 训练一定处于数据饥饿
+    # 验证集的worker编号同样从0开始, 另记一个"warp"阶段, 不应出现在训练集的统计中
+    def __init__(self, timer: StageTimer, split: str = "train"):
+        self.timer = timer
+        self.split = split
+
+    def __len__(self):
+        return 16
+
+    def __getitem__(self, index):
+        with self.timer.stage("decode", self.split):
+            time.sleep(0.01)
+        if self.split == "val":
+            with self.timer.stage("warp", self.split):
+                time.sleep(0.01)
+        with self.timer.stage("to_tensor", self.split):
+            x = torch.randn(4)
+        return x, x.sum(0, keepdim=True)
+
+
+class TinyModule(L.LightningModule):
+    def __init__(self):
+        super().__init__()
+        self.model = nn.Linear(4, 1)
+
+    def forward(self, x):
+        return self.model(x)
+
+    def training_step(self, batch, batch_idx):
+        x, y = batch
+        return nn.functional.mse_loss(self(x), y)
+
+    def validation_step(self, batch, batch_idx):
+        x, y = batch
+        self.log("val_loss", nn.functional.mse_loss(self(x), y))
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=0.01)
+
+
+class TinyDataModule(L.LightningDataModule):
+    def __init__(self):
+        super().__init__()
+        self.stage_timer = StageTimer(workers=1, capacity=64)
+
+    def train_dataloader(self):
+        return DataLoader(SlowData(self.stage_timer), batch_size=4, num_workers=1, persistent_workers=True)
+
+    def val_dataloader(self):
+        return DataLoader(SlowData(self.stage_timer, "val"), batch_size=4, num_workers=1, persistent_workers=True)
+
+
+def test_step_profiler(tmp_path):
+    profiler = StepProfiler(dirpath=str(tmp_path), trace_steps=3, starvation=0.5)
+    trainer = L.Trainer(accelerator="cpu", max_epochs=1, callbacks=[profiler], logger=False,
+                        enable_checkpointing=False, enable_progress_bar=False, enable_model_summary=False)
+    with pytest.warns(UserWarning, match="data starvation"):
+        trainer.fit(TinyModule(), datamodule=TinyDataModule())
+    stats = profiler.summary()
+    assert stats["data_wait_share"] > 0.5
+    assert all(stats[f"{phase}_ms"] >= 0 for phase in StepProfiler.phases)
+    assert trainer.callback_metrics["profile/worker_decode_ms"] >= 10
+    assert trainer.callback_metrics["profile/worker_decode_share"] > 0.9
+    assert "profile/worker_warp_ms" not in trainer.callback_metrics
+    assert profiler.stage_timer.summary("val")["warp_ms"] >= 10
+    events = json.load(open(tmp_path / "trace.json"))["traceEvents"]
+    steps = [event for event in events if event.get("cat") == "step"]
+    assert len(steps) == 3 * len(StepProfiler.phases)
+    # worker的阶段来自另一个进程, 时间戳与主进程对齐并落在trace的时间范围内
+    workers = [event for event in events if event.get("cat") == "worker" and event["tid"] == 1]
+    assert workers and {event["name"] for event in workers} == {"decode", "to_tensor"}
+    threads = {event["tid"]: event["args"]["name"] for event in events if event["name"] == "thread_name"}
+    assert threads[1] == "train worker 0" and threads.get(3, "val worker 0") == "val worker 0"
+    assert steps[0]["ts"] <= workers[0]["ts"] <= steps[-1]["ts"] + steps[-1]["dur"]
+
+
+def test_stage_timer_disabled():
+    timer = StageTimer(workers=2, enable=False)
+    with timer.stage("decode"):
+        pass
+    assert timer.summary() == {}
@@ -0,0 +1,81 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import torch
+
+from MobileSPEEDNetv3.module.Lightning_MobileSPEEDv3 import LightningMobileSPEEDv3, load_checkpoint
+from MobileSPEEDNetv3.model.quantize import QuantizedSPEED
+from MobileSPEEDNetv3.utils.config import get_config, merge_config
+from MobileSPEEDNetv3.utils.dataset import unpack_label
+from test_quantize import legacy_config
+
+
+def output_of(model, module, x):
+    # 记录某个子模块的输出, 量化张量反量化后返回
+    outputs = []
+    handle = module.register_forward_hook(lambda m, inputs, output: outputs.append(output.dequantize() if output.is_quantized else output.clone()))
+    with torch.no_grad():
+        model(x)
+    handle.remove()
+    return outputs[0]
+
+
+def test_qat_finetune_and_export(tmp_path):
+    config = get_config()
+    config["pretrained"] = False
+    config["accelerator"] = "cpu"
+    config["imgsz"] = [128, 192]
+    torch.manual_seed(0)
+    float_module = LightningMobileSPEEDv3(config)
+    torch.save({"state_dict": float_module.state_dict(), "hyper_parameters": {"config": config}}, tmp_path / "float.ckpt")
+    config["QAT"]["enable"] = True
+    config["QAT"]["ckpt"] = str(tmp_path / "float.ckpt")
+    module = LightningMobileSPEEDv3(config)
+    assert isinstance(module.model, QuantizedSPEED)
+    x = torch.randint(0, 256, (2, 1, 128, 192), dtype=torch.uint8)
+    labels = unpack_label({"label": torch.tensor([[0.1, 0.2, 8.0, 1, 0, 0, 0, 10, 10, 50, 50],
+                                                  [0.0, -0.3, 12.0, 0.5, 0.5, 0.5, 0.5, 10, 10, 50, 50]])})
+    optimizer = module.configure_optimizers()["optimizer"]
+    module.train()
+    losses = []
+    for i in range(3):
+        loss = module.training_step((x, labels), i)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    assert losses[-1] < losses[0]
+    module.on_train_epoch_start()
+    module.eval()
+    # 导出的INT8卷积与fake-quant卷积一致(随机权重下激活很小, 只比较第一个量化卷积)
+    quantized = module.export_int8(str(tmp_path / "int8.pt"))
+    expected = output_of(module.model, dict(module.model.graph.named_modules())["model.stages.0.0.0"], x)
+    result = output_of(quantized, dict(quantized.graph.named_modules())["model.stages.0.0.0"], x)
+    assert (expected - result).norm() / expected.norm() < 0.05
+    # QAT的checkpoint不需要浮点checkpoint就能加载
+    torch.save({"state_dict": module.state_dict(), "hyper_parameters": {"config": config}}, tmp_path / "qat.ckpt")
+    (tmp_path / "float.ckpt").unlink()
+    loaded = load_checkpoint(str(tmp_path / "qat.ckpt"))
+    assert isinstance(loaded.model, QuantizedSPEED)
+
+
+def test_qat_from_legacy_checkpoint(tmp_path):
+    # 本系列之前的浮点checkpoint: 配置中没有QAT等新增的配置项
+    config = legacy_config()
+    torch.manual_seed(0)
+    module = LightningMobileSPEEDv3({**get_config(), "pretrained": False, "imgsz": [128, 192]})
+    torch.save({"state_dict": module.state_dict(), "hyper_parameters": {"config": config},
+                "pytorch-lightning_version": "2.0.0"}, tmp_path / "legacy.ckpt")
+    # Lightning按保存的配置重建模块
+    float_module = LightningMobileSPEEDv3.load_from_checkpoint(str(tmp_path / "legacy.ckpt"), map_location="cpu")
+    assert float_module.config["QAT"]["enable"] is False
+    assert "quantize" in float_module.config["Rotate"]
+    # 以旧checkpoint的配置开始QAT微调
+    config = merge_config(legacy_config())
+    config["QAT"]["enable"] = True
+    config["QAT"]["ckpt"] = str(tmp_path / "legacy.ckpt")
+    module = LightningMobileSPEEDv3(config)
+    assert isinstance(module.model, QuantizedSPEED)
+    x = torch.randint(0, 256, (2, 1, 128, 192), dtype=torch.uint8)
+    with torch.no_grad():
+        assert all(torch.isfinite(output).all() for output in module.eval()(x))
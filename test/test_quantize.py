@@ -0,0 +1,89 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import copy
+import torch
+from torch import nn
+
+from MobileSPEEDNetv3.model import Mobile_SPEEDv3
+from MobileSPEEDNetv3.model.quantize import quantize_ptq, model_size
+from MobileSPEEDNetv3.module.Lightning_MobileSPEEDv3 import LightningMobileSPEEDv3, load_checkpoint
+from MobileSPEEDNetv3.utils.config import get_config
+from MobileSPEEDNetv3.utils.dataset import Speed, SpeedDataModule
+from MobileSPEEDNetv3.utils.synthetic import generate
+
+
+# 本系列改动之前的base.yaml中没有的配置项, 旧的checkpoint中保存的配置缺少这些键
+LEGACY_MISSING = ["self_supervised_views", "cache_dir", "reduced_decode", "transport", "channels_last", "threads",
+                  "interop_threads", "pin_cores", "worker_cores", "Profile", "QAT", "SunFlare", "batch_photometric",
+                  "batch_warp", ("Rotate", "quantize"), ("Rotate", "remap_cache")]
+
+
+def legacy_config() -> dict:
+    # 与旧版本base.yaml布局相同的配置
+    config = get_config()
+    config["pretrained"] = False
+    config["imgsz"] = [128, 192]
+    for key in LEGACY_MISSING:
+        if isinstance(key, tuple):
+            del config[key[0]][key[1]]
+        else:
+            del config[key]
+    return config
+
+
+def output_of(model, module, x):
+    # 记录某个子模块的输出, 量化张量反量化后返回
+    outputs = []
+    handle = module.register_forward_hook(lambda m, inputs, output: outputs.append(output.dequantize() if output.is_quantized else output.clone()))
+    with torch.no_grad():
+        model(x)
+    handle.remove()
+    return outputs[0]
+
+
+def test_ptq_mobile_speed(tmp_path):
+    config = get_config()
+    config["pretrained"] = False
+    torch.manual_seed(0)
+    model = Mobile_SPEEDv3(config).eval()
+    # 平滑的随机图片, 接近真实图片的激活分布
+    x = nn.functional.interpolate(torch.rand(4, 1, 16, 24), size=(128, 192), mode="bilinear")
+    x = (x * 255).to(torch.uint8)
+    quantized = quantize_ptq(model, [x[:2], x[2:]])
+    assert model.deploy is False
+    modules = dict(quantized.graph.named_modules())
+    assert isinstance(modules["model.stages.0.0.0"], torch.ao.nn.quantized.Conv2d)
+    assert type(modules["model.expand2rgb_conv.0"]) is nn.Conv2d
+    # 随机权重下误差逐层累积, 只检查第一个量化卷积的校准是否合理
+    fused = copy.deepcopy(model)
+    fused.fuse_for_inference(imgsz=[128, 192], verbose=False)
+    expected = output_of(fused, fused.stages[0][0][0], x)
+    result = output_of(quantized, modules["model.stages.0.0.0"], x)
+    assert (expected - result).norm() / expected.norm() < 0.05
+    for a, b in zip(model(x), quantized(x)):
+        assert a.shape == b.shape and b.dtype == torch.float32
+    assert model_size(quantized) < model_size(model) / 2
+    # INT8模型可以trace为TorchScript
+    with torch.no_grad():
+        torch.jit.trace(quantized, x[:1]).save(str(tmp_path / "int8.pt"))
+
+
+def test_load_legacy_checkpoint(tmp_path):
+    # 旧checkpoint的嵌套配置(如Rotate)缺少新键时用默认值补全, quantize.py的验证集数据可以直接创建
+    generate(str(tmp_path / "speed"), 4)
+    config = legacy_config()
+    config["data_dir"] = str(tmp_path / "speed")
+    config["ram"] = False
+    config["workers"] = 0
+    torch.manual_seed(0)
+    module = LightningMobileSPEEDv3({**get_config(), "pretrained": False, "imgsz": [128, 192]})
+    torch.save({"state_dict": module.state_dict(), "hyper_parameters": {"config": config}}, tmp_path / "legacy.ckpt")
+    loaded = load_checkpoint(str(tmp_path / "legacy.ckpt"))
+    assert loaded.config["Rotate"]["quantize"] == get_config()["Rotate"]["quantize"]
+    # checkpoint中的值保持不变
+    assert loaded.config["imgsz"] == [128, 192] and loaded.config["Rotate"]["img_angle"] == config["Rotate"]["img_angle"]
+    datamodule = SpeedDataModule(loaded.config)
+    datamodule.setup("validate")
+    image, _ = Speed("val")[0]
+    assert image.shape == (1, 128, 192)
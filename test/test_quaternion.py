@@ -0,0 +1,55 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import numpy as np
+import torch
+
+from scipy.spatial.transform import Rotation as R
+
+from MobileSPEEDNetv3.utils.quaternion import quat_canonical, quat_multiply, quat_to_matrix, matrix_to_quat, quat_to_euler_yxz, euler_yxz_to_quat
+
+
+def random_quat(n, seed=0):
+    # scipy为[x, y, z, w], 转为标签使用的[w, x, y, z]
+    q = R.random(n, random_state=seed).as_quat()
+    return np.concatenate([q[:, 3:], q[:, :3]], axis=1)
+
+
+def to_scipy(q):
+    return R.from_quat(np.concatenate([q[:, 1:], q[:, :1]], axis=1))
+
+
+def from_scipy(rotation):
+    q = rotation.as_quat(canonical=True)
+    return np.concatenate([q[:, 3:], q[:, :3]], axis=1)
+
+
+def test_matrix_matches_scipy():
+    q = random_quat(1000)
+    np.testing.assert_allclose(quat_to_matrix(q), to_scipy(q).as_matrix(), atol=1e-12)
+    np.testing.assert_allclose(matrix_to_quat(to_scipy(q).as_matrix()), from_scipy(to_scipy(q)), atol=1e-12)
+
+
+def test_euler_matches_scipy():
+    q = random_quat(1000)
+    yaw, pitch, roll = quat_to_euler_yxz(q)
+    np.testing.assert_allclose(np.stack([yaw, pitch, roll], -1), to_scipy(q).as_euler("YXZ", degrees=True), atol=1e-9)
+    euler = np.random.default_rng(0).uniform(-180, 180, (1000, 3))
+    euler[:, 1] /= 2
+    q = euler_yxz_to_quat(euler[:, 0], euler[:, 1], euler[:, 2])
+    np.testing.assert_allclose(quat_canonical(q), from_scipy(R.from_euler("YXZ", euler, degrees=True)), atol=1e-12)
+
+
+def test_multiply_matches_scipy():
+    q1, q2 = random_quat(1000, 0), random_quat(1000, 1)
+    expected = from_scipy(to_scipy(q1) * to_scipy(q2))
+    np.testing.assert_allclose(quat_canonical(quat_multiply(q1, q2)), expected, atol=1e-12)
+
+
+def test_torch_matches_numpy():
+    q = random_quat(100)
+    q_t = torch.from_numpy(q)
+    np.testing.assert_allclose(quat_to_matrix(q_t).numpy(), quat_to_matrix(q), atol=1e-12)
+    np.testing.assert_allclose(matrix_to_quat(quat_to_matrix(q_t)).numpy(), matrix_to_quat(quat_to_matrix(q)), atol=1e-12)
+    for a, b in zip(quat_to_euler_yxz(q_t), quat_to_euler_yxz(q)):
+        np.testing.assert_allclose(a.numpy(), b, atol=1e-9)
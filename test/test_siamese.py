@@ -0,0 +1,103 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import time
+import pytest
+import numpy as np
+import torch
+
+from MobileSPEEDNetv3.module.Lightning_MobileSPEEDv3 import LightningMobileSPEEDv3
+from MobileSPEEDNetv3.utils.config import get_config
+from MobileSPEEDNetv3.utils.dataset import Speed, SpeedDataModule, prepare_Speed
+from MobileSPEEDNetv3.utils.synthetic import generate
+
+
+def get_module():
+    config = get_config()
+    config["pretrained"] = False
+    config["accelerator"] = "cpu"
+    config["self_supervised"] = True
+    torch.manual_seed(0)
+    return LightningMobileSPEEDv3(config).eval()
+
+
+def best_time(fn, repeat=10):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@torch.no_grad()
+def test_forward_views_matches_two_passes():
+    module = get_module()
+    views = [torch.randint(0, 256, (2, 1, 96, 160), dtype=torch.uint8) for _ in range(2)]
+    outputs = module.forward_views(views)
+    for view, output in zip(views, outputs):
+        for a, b in zip(output, module(view)):
+            torch.testing.assert_close(a, b, atol=1e-5, rtol=1e-4)
+    losses, _ = module.consistency_losses(outputs)
+    assert all(torch.isfinite(loss) for loss in losses)
+
+
+@torch.no_grad()
+def test_forward_views_faster_than_two_passes():
+    # 小输入时逐层的调度开销占主导, 一次2B前向应快于两次B前向
+    module = get_module()
+    views = [torch.randint(0, 256, (1, 1, 64, 96), dtype=torch.uint8) for _ in range(2)]
+    module.forward_views(views)
+    single = best_time(lambda: module.forward_views(views))
+    separate = best_time(lambda: [module(view) for view in views])
+    assert single < separate
+
+
+def test_multi_view_target_at_border(tmp_path):
+    # 贴在图片角上的目标会被平移/旋转移出图片, Albumentations丢弃bbox后仍应生成K个视图
+    generate(str(tmp_path), 2)
+    config = get_config()
+    config["data_dir"] = str(tmp_path)
+    config["imgsz"] = [240, 384]
+    config["ram"] = False
+    config["workers"] = 0
+    config["transport"] = "uint8"
+    prepare_Speed(config)
+    speed = Speed("self_supervised_train")
+    image = np.random.RandomState(0).randint(0, 256, (300, 480), dtype=np.uint8)
+    for seed in range(20):
+        np.random.seed(seed)
+        views = speed.multi_view(image, [0.0, 0.0, 4.0, 4.0])
+        assert views.shape == (config["self_supervised_views"], 1, 240, 384)
+
+
+def test_multi_view_photometric_before_crop(tmp_path, monkeypatch):
+    # batch_photometric开启时自监督视图仍在worker中先做像素增强再裁剪与丢弃块, 批次级像素增强不再处理视图
+    generate(str(tmp_path), 2)
+    config = get_config()
+    config["data_dir"] = str(tmp_path)
+    config["imgsz"] = [240, 384]
+    config["ram"] = False
+    config["workers"] = 0
+    config["transport"] = "uint8"
+    config["self_supervised"] = True
+    config["batch_photometric"] = True
+    datamodule = SpeedDataModule(config)
+    speed = Speed("self_supervised_train")
+    order = []
+    pixel = speed.A_transform[1]
+    speed.A_transform = [speed.A_transform[0], lambda **kwargs: order.append("pixel") or pixel(**kwargs)]
+    monkeypatch.setattr("MobileSPEEDNetv3.utils.dataset.CropAndPadInplace", lambda view, bbox: order.append("crop") or view)
+    views = speed.multi_view(np.random.RandomState(0).randint(0, 256, (300, 480), dtype=np.uint8), [100.0, 80.0, 300.0, 200.0])
+    assert order == ["pixel", "crop"] * config["self_supervised_views"]
+    batch = torch.from_numpy(np.stack([views, views]))
+    for view, result in zip(batch.unbind(1), datamodule.on_after_batch_transfer(batch, 0)):
+        assert torch.equal(view, result)
+
+
+def test_single_view_rejected():
+    config = get_config()
+    config["self_supervised"] = True
+    config["self_supervised_views"] = 1
+    with pytest.raises(ValueError, match="self_supervised_views"):
+        SpeedDataModule(config)
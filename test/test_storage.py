@@ -0,0 +1,82 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import os
+import json
+import numpy as np
+import multiprocessing as mp
+
+from MobileSPEEDNetv3.utils.config import get_config
+from MobileSPEEDNetv3.utils.dataset import Speed, prepare_Speed
+from MobileSPEEDNetv3.utils.storage import LabelTable, MemmapImageStore
+from MobileSPEEDNetv3.utils.synthetic import generate
+
+
+def test_prepare_releases_shared_memory(tmp_path):
+    # 重复调用prepare_Speed时释放上一次的共享内存, 已取出的图片仍可读取
+    generate(str(tmp_path), 4)
+    config = get_config()
+    config["data_dir"] = str(tmp_path)
+    config["imgsz"] = [240, 384]
+    config["ram"] = True
+    config["workers"] = 0
+    prepare_Speed(config)
+    store = Speed.img_store
+    name = store.shm.name.lstrip("/")
+    image = store.get(Speed.img_name[0])
+    expected = image.copy()
+    assert os.path.exists(f"/dev/shm/{name}")
+    prepare_Speed(config)
+    assert Speed.img_store is not store
+    assert not os.path.exists(f"/dev/shm/{name}")
+    np.testing.assert_array_equal(image, expected)
+    del image
+    store.close()
+    assert store.shm is None
+    Speed.img_store.close()
+
+
+def compile_labels(label_file, path, repeat):
+    for _ in range(repeat):
+        LabelTable.compile(label_file, path, 1920, 1200)
+
+
+def test_label_table_concurrent_compile(tmp_path):
+    # DDP的多个rank同时编译同一个标签表, 临时文件互不覆盖, 结果完整且不留临时文件
+    label_file = tmp_path / "train_label.json"
+    labels = {f"img{i:06d}.jpg": {"pos": [0.0, 0.0, 10.0 + i], "ori": [1.0, 0.0, 0.0, 0.0], "bbox": [10, 20, 300, 400]} for i in range(64)}
+    json.dump(labels, open(label_file, "w"))
+    path = tmp_path / "cache" / "train_label.npz"
+    processes = [mp.get_context("fork").Process(target=compile_labels, args=(label_file, path, 20)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    assert LabelTable.exists(path, label_file)
+    table = LabelTable(path)
+    assert table.keys() == list(labels.keys())
+    assert os.listdir(path.parent) == ["train_label.npz"]
+
+
+def test_memmap_conversion_keeps_mapped_file(tmp_path):
+    # 另一个rank重新转换时写入临时文件, 已映射的数据文件不被截断; 完成后数据文件与索引一起替换
+    path = tmp_path / "cache" / "train_images.u8"
+    img_name = [f"img{i:06d}.jpg" for i in range(4)]
+    images = np.random.default_rng(0).integers(0, 256, (4, 48, 64), dtype=np.uint8)
+    store = MemmapImageStore(path, img_name, (48, 64))
+    for name, image in zip(img_name, images):
+        store.put(name, image)
+    store.finalize()
+    assert MemmapImageStore.exists(path, img_name, (48, 64))
+    reader = MemmapImageStore(path)
+    converting = MemmapImageStore(path, img_name, (48, 64))
+    np.testing.assert_array_equal(reader.get(img_name[0]), images[0])
+    for name, image in zip(img_name, images[::-1]):
+        converting.put(name, image)
+    converting.finalize()
+    np.testing.assert_array_equal(reader.get(img_name[0]), images[0])
+    np.testing.assert_array_equal(MemmapImageStore(path).get(img_name[0]), images[-1])
+    # 中断的转换删除临时文件, 不影响已有的数据文件
+    MemmapImageStore(path, img_name, (48, 64)).close()
+    assert sorted(os.listdir(path.parent)) == ["train_images.json", "train_images.u8"]
@@ -0,0 +1,46 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import json
+import numpy as np
+
+from MobileSPEEDNetv3.utils.config import get_config
+from MobileSPEEDNetv3.utils.dataset import Speed, SpeedDataModule, unpack_label
+from MobileSPEEDNetv3.utils.synthetic import generate, project, TARGET_VERTICES, K
+from MobileSPEEDNetv3.utils.utils import Camera
+
+
+def test_generate_labels(tmp_path):
+    labels = generate(str(tmp_path), 4, workers=2)
+    # 多进程与单进程的结果相同
+    assert labels == generate(str(tmp_path / "single"), 4)
+    assert json.load(open(tmp_path / "train_label.json")) == labels
+    assert K[0, 0] == Camera.fx and K[0, 2] == Camera.width / 2
+    for filename, label in labels.items():
+        assert (tmp_path / "images/train" / filename).exists()
+        pos, ori, bbox = np.array(label["pos"]), np.array(label["ori"]), label["bbox"]
+        assert abs(np.linalg.norm(ori) - 1) < 1e-9 and ori[0] >= 0
+        # bbox为目标顶点投影的外接框, 目标中心的投影在bbox内
+        uv, _ = project(TARGET_VERTICES, pos, ori)
+        assert np.allclose([*np.floor(uv.min(axis=0)), *np.ceil(uv.max(axis=0))], bbox)
+        center = K @ pos
+        assert bbox[0] <= center[0] / center[2] <= bbox[2] and bbox[1] <= center[1] / center[2] <= bbox[3]
+
+
+def test_synthetic_speed(tmp_path):
+    generate(str(tmp_path), 8)
+    config = get_config()
+    config["data_dir"] = str(tmp_path)
+    config["imgsz"] = [240, 384]
+    config["ram"] = False
+    config["workers"] = 0
+    config["transport"] = "uint8"
+    datamodule = SpeedDataModule(config)
+    datamodule.setup("validate")
+    image, y = Speed("val")[0]
+    assert image.shape == (1, 240, 384)
+    # 验证集不做几何增强, bbox按比例缩放到imgsz
+    label = json.load(open(tmp_path / "train_label.json"))[y["filename"]]
+    labels = unpack_label({"label": y["label"][None]})
+    assert np.allclose(labels["pos"][0], label["pos"], atol=1e-5)
+    assert np.allclose(labels["bbox"][0], np.array(label["bbox"]) / 5, atol=1)
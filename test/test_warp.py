@@ -0,0 +1,105 @@
+import sys
+sys.path.insert(0, sys.path[0]+"/../")
+
+import pytest
+import cv2 as cv
+import numpy as np
+import albumentations as A
+
+from MobileSPEEDNetv3.utils.config import get_config
+from MobileSPEEDNetv3.utils.dataset import Speed, AugmentationStats, prepare_Speed
+from MobileSPEEDNetv3.utils.utils import Camera, rotate_image, rotate_cam, resize, warp_boxes, bbox_in_image
+
+
+def albumentations_resize(image, bbox, config):
+    transformed = A.Compose([A.Resize(height=config["imgsz"][0], width=config["imgsz"][1])],
+                            bbox_params=A.BboxParams(format="pascal_voc", label_fields=["category_ids"]))(image=image, bboxes=[bbox], category_ids=[1])
+    return transformed["image"], list(transformed["bboxes"][0])
+
+
+def sequential_warp(image, pos, ori, bbox, config, camera):
+    # 旧的逐步warp流程: resize -> 缩放增强 -> 旋转增强 -> resize
+    if config["resize_first"]:
+        image, bbox = albumentations_resize(image, bbox, config)
+    if np.random.rand() < config["Resize"]["p"]:
+        for _ in range(6):
+            image_w, pos_w, ori_w, M = resize(image, pos, ori, camera, config["Resize"]["ratio"])
+            bbox_w = warp_boxes(np.array([bbox]), M, height=image.shape[0], width=image.shape[1]).tolist()[0]
+            if 10 < np.linalg.norm(pos_w) < 40:
+                image, pos, ori, bbox = image_w, pos_w, ori_w, bbox_w
+                break
+    dice = np.random.rand()
+    bbox_area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    for _ in range(6):
+        if dice <= config["Rotate"]["p"]:
+            image_w, pos_w, ori_w, M = rotate_image(image, pos, ori, camera.SK, camera.SK_inv, config["Rotate"]["img_angle"])
+        else:
+            image_w, pos_w, ori_w, M = rotate_cam(image, pos, ori, camera.SK, camera.SK_inv, config["Rotate"]["cam_angle"])
+        bbox_w = warp_boxes(np.array([bbox]), M, height=image.shape[0], width=image.shape[1]).tolist()[0]
+        if bbox_in_image(bbox_w, bbox_area):
+            image, pos, ori, bbox = image_w, pos_w, ori_w, bbox_w
+            break
+    if not config["resize_first"]:
+        image, bbox = albumentations_resize(image, bbox, config)
+    return image, pos, ori, bbox
+
+
+def texture(seed=0):
+    # 平滑的随机纹理, 两条流程的插值位置相差不到一个像素, 像素差异很小
+    noise = np.random.default_rng(seed).normal(size=(Camera.height, Camera.width)).astype(np.float32)
+    image = cv.GaussianBlur(noise, (0, 0), 16)
+    return np.clip((image - image.mean()) / image.std() * 40 + 128, 0, 255).astype(np.uint8)
+
+
+@pytest.fixture
+def make_speed(monkeypatch):
+    # 替换Speed的类属性, 测试结束后由monkeypatch恢复
+    def make(config):
+        monkeypatch.setattr(Speed, "config", config, raising=False)
+        monkeypatch.setattr(Speed, "camera", Camera(config), raising=False)
+        monkeypatch.setattr(Speed, "aug_stats", AugmentationStats(0))
+        speed = Speed.__new__(Speed)
+        speed.mode = "train"
+        speed.remap_cache = None
+        return speed
+    return make
+
+
+def test_single_warp_matches_sequential(make_speed):
+    image = texture()
+    for resize_first in [False, True]:
+        for rotate_p in [0.0, 1.0]:
+            config = get_config()
+            config["resize_first"] = resize_first
+            config["reduced_decode"] = False
+            config["Resize"]["p"] = 1.0
+            config["Rotate"]["p"] = rotate_p
+            speed = make_speed(config)
+            for seed in range(10):
+                pos = np.array([0.5, -0.3, 12.0])
+                ori = np.array([0.5, 0.5, 0.5, 0.5])
+                bbox = [800.0, 500.0, 1100.0, 700.0]
+                np.random.seed(seed)
+                image_a, pos_a, ori_a, bbox_a = speed.warp(image, pos, ori, bbox)
+                np.random.seed(seed)
+                image_b, pos_b, ori_b, bbox_b = sequential_warp(image, pos, ori, bbox, config, Speed.camera)
+                assert image_a.shape == image_b.shape
+                np.testing.assert_allclose(pos_a, pos_b, atol=1e-9)
+                np.testing.assert_allclose(ori_a, ori_b, atol=1e-9)
+                # 单次warp只在最后取整
+                np.testing.assert_allclose(bbox_a, bbox_b, atol=1)
+                # 两条流程都有内容的区域内比较像素, 去掉黑边附近插值不同的像素;
+                # 逐步流程多插值一次且resize以像素中心对齐, 差异为亚像素级, 错开的warp平均相差约45
+                valid = cv.erode(((image_a > 0) & (image_b > 0)).astype(np.uint8), np.ones((5, 5), np.uint8)).astype(bool)
+                assert valid.mean() > 0.2
+                diff = np.abs(image_a.astype(np.int16) - image_b.astype(np.int16))[valid]
+                assert diff.mean() < 4 and np.percentile(diff, 99) <= 12, (seed, diff.mean(), np.percentile(diff, 99))
+
+
+def test_quantize_requires_bounded_remap_cache():
+    # 量化旋转角度时remap表缓存必须有上限, 配置错误在修改Speed的类属性之前报错
+    config = get_config()
+    config["Rotate"]["quantize"] = 5.0
+    config["Rotate"]["remap_cache"] = 0
+    with pytest.raises(ValueError, match="remap_cache"):
+        prepare_Speed(config)
@@ -9,6 +9,8 @@ import argparse
 
 from MobileSPEEDNetv3.utils.config import get_config
 from MobileSPEEDNetv3.utils.dataset import SpeedDataModule
+from MobileSPEEDNetv3.utils.cpu import configure_cpu
+from MobileSPEEDNetv3.utils.profiler import StepProfiler
 from MobileSPEEDNetv3.module.Lightning_MobileSPEEDv3 import LightningMobileSPEEDv3
 
 from lightning.pytorch import Trainer
@@ -44,6 +46,10 @@ if __name__ == "__main__":
     parser.add_argument("--Augmentationp", type=float, default=config["Augmentation"]["p"], help="augmentp")
     parser.add_argument("--debug", action="store_true", help="debug", default=config["debug"])
     parser.add_argument("--resize_first", action="store_true", help="resize_first", default=config["resize_first"])
+    parser.add_argument("--cpu", action="store_true", help="cpu training profile: bf16 autocast, channels_last, threads and core pinning")
+    parser.add_argument("--profile", action="store_true", help="step time breakdown and trace.json", default=config["Profile"]["enable"])
+    parser.add_argument("--qat", action="store_true", help="quantization aware training", default=config["QAT"]["enable"])
+    parser.add_argument("--qat_ckpt", type=str, default=config["QAT"]["ckpt"], help="float checkpoint for QAT")
     
     args = parser.parse_args()
     
@@ -62,10 +68,24 @@ if __name__ == "__main__":
     config["Augmentation"]["p"] = args.Augmentationp
     config["debug"] = args.debug
     config["resize_first"] = args.resize_first
+    if args.cpu:
+        config["accelerator"] = "cpu"
+        config["precision"] = "mix"
+        config["channels_last"] = True
+    config["Profile"]["enable"] = args.profile
+    config["QAT"]["enable"] = args.qat
+    config["QAT"]["ckpt"] = args.qat_ckpt
+    if config["QAT"]["enable"]:
+        # QAT只微调QAT.epoch轮, fake-quant需要FP32
+        config["epoch"] = config["QAT"]["epoch"]
+        config["precision"] = "full"
     
     config["name"] = f"{config['backbone']}-{config['encoder']}_{config['stride']}_{config['n']}_{config['s']}-{config['Rotate']['img_angle']}_{config['Rotate']['cam_angle']}_{config['Rotate']['p']}-{config['Resize']['ratio']}_{config['Resize']['p']}-{config['CropAndPad']['p']}-{config['DropBlockSafe']['p']}-{config['Augmentation']['p']}"
     
     torch.set_float32_matmul_precision("high")
+    # CPU训练: 按workers设置计算线程数并把计算线程与worker绑定到不同的核, 需要在创建DataLoader之前
+    if config["accelerator"] == "cpu":
+        print(f"configure_cpu: {configure_cpu(config)}")
     
     dirpath = f"./result/{config['name']}-{time.strftime('%Y-%m-%d %H-%M-%S', time.localtime())}"
     # 判断是否存在路径 若不存在则创建
@@ -101,12 +121,22 @@ if __name__ == "__main__":
     elif config["summary"] == "default":
         summary = ModelSummary(max_depth=3)
     callbacks = [lr_monitor, checkpoint, summary, bar]
+    # step耗时分解与数据饥饿警告
+    if config["Profile"]["enable"]:
+        callbacks.append(StepProfiler(dirpath=dirpath,
+                                      trace_steps=config["Profile"]["trace_steps"],
+                                      starvation=config["Profile"]["starvation"],
+                                      sync=config["Profile"]["sync"]))
 
     # ===================plugins=================
     plugins = []
     # 精度
     if config["precision"] == "mix":
-        precision = MixedPrecision(precision="16-mixed", device="cuda" if config["accelerator"] == "gpu" else config["accelerator"])
+        # CPU的autocast使用bf16
+        if config["accelerator"] == "cpu":
+            precision = MixedPrecision(precision="bf16-mixed", device="cpu")
+        else:
+            precision = MixedPrecision(precision="16-mixed", device="cuda")
     elif config["precision"] == "full":
         precision = Precision()
     elif config["precision"] == "double":
@@ -171,6 +201,8 @@ if __name__ == "__main__":
     # ====================训练====================
     if config["train"]:
         trainer.fit(model=module, datamodule=dataloader)
+        if config["QAT"]["enable"]:
+            module.export_int8(os.path.join(dirpath, "int8.torchscript.pt"))
 
     # ====================验证====================
     if config["val"]: